@@ -0,0 +1,113 @@
+"""Concurrency benchmark of the login, location and service request endpoints.
+
+Runs the same scenario against a server started with a fixed number of
+workers, so the numbers of two revisions (e.g. before and after the async
+views) can be compared:
+
+    gunicorn delivery.asgi:application -k uvicorn.workers.UvicornWorker -w 2
+    python benchmarks/async_views.py --url http://localhost:8000/api --concurrency 200
+
+The users are created through the API the first time the benchmark runs.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from latency import latency_summary
+
+
+async def ensure_user(client, username, password, is_driver=False):
+    """Register the user if it does not exist yet and return its access token."""
+
+    await client.post('/register/', json={
+        'username': username,
+        'password': password,
+        'is_driver': is_driver,
+        'plate': f'BEN{username[-3:]}' if is_driver else '',
+    })
+    response = await client.post('/login/', json={'username': username, 'password': password})
+    response.raise_for_status()
+    return response.json()['access_token']
+
+
+async def timed(latencies, errors, request):
+    """Await the request, recording its latency and whether it failed."""
+
+    start = time.perf_counter()
+    try:
+        response = await request
+        if response.status_code >= 500:
+            errors.append(response.status_code)
+    except httpx.HTTPError as error:
+        errors.append(type(error).__name__)
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_scenario(client, name, requests_factory, concurrency, total):
+    """Send ``total`` requests keeping ``concurrency`` of them in flight."""
+
+    latencies, errors = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(i):
+        async with semaphore:
+            await timed(latencies, errors, requests_factory(i))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'scenario': name,
+        'requests': total,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'rps': round(total / elapsed, 1),
+        **latency_summary(latencies),
+    }
+
+
+async def main(options):
+    limits = httpx.Limits(max_connections=options.concurrency)
+    async with httpx.AsyncClient(base_url=options.url, limits=limits, timeout=60) as client:
+        password = 'benchmark-password'
+        customer_token = await ensure_user(client, 'benchmark_customer', password)
+        driver_token = await ensure_user(client, 'benchmark_driver001', password, is_driver=True)
+
+        customer = {'Authorization': f'Bearer {customer_token}'}
+        driver = {'Authorization': f'Bearer {driver_token}'}
+        location = {'address': 'Benchmark', 'latitude': 4.6, 'longitude': -74.1}
+        await client.post('/locations/', json=location, headers=customer)
+
+        scenarios = [
+            ('login', lambda i: client.post('/login/', json={
+                'username': 'benchmark_customer', 'password': password
+            })),
+            ('location_create', lambda i: client.post('/locations/', json=location, headers=driver)),
+            ('location_list', lambda i: client.get('/locations/', headers=customer)),
+            # The customer keeps an active service, so this measures the checks
+            # that run before a driver is reserved.
+            ('service_request', lambda i: client.post('/delivery/', headers=customer)),
+        ]
+
+        results = [
+            await run_scenario(client, name, factory, options.concurrency, options.requests)
+            for name, factory in scenarios
+        ]
+
+    print(json.dumps(results, indent=2))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000/api')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    asyncio.run(main(parser.parse_args()))
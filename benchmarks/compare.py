@@ -0,0 +1,55 @@
+"""Compare two load test results, e.g. of a base and a head commit.
+
+Prints the change of every metric per endpoint and exits with status 1
+when a latency percentile grows, or the requests per second drop, more
+than --threshold percent:
+
+    python benchmarks/compare.py results/base.json results/head.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+LATENCIES = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def change(base, head):
+    if not base:
+        return 0.0
+    return (head - base) / base * 100
+
+
+def main(options):
+    with open(options.base) as base_file, open(options.head) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+
+    print(f"{'endpoint':<24}{'metric':<8}{base.get('commit') or 'base':>12}{head.get('commit') or 'head':>12}{'change':>10}")
+    regressions = []
+
+    for endpoint in sorted(set(base['endpoints']) | set(head['endpoints'])):
+        if endpoint not in base['endpoints'] or endpoint not in head['endpoints']:
+            print(f'{endpoint:<24}only in one of the results')
+            continue
+
+        for metric in LATENCIES + ('rps',):
+            before = base['endpoints'][endpoint][metric]
+            after = head['endpoints'][endpoint][metric]
+            percent = change(before, after)
+            print(f'{endpoint:<24}{metric:<8}{before:>12}{after:>12}{percent:>+9.1f}%')
+
+            # Latency regresses when it grows, throughput when it drops.
+            worse = percent if metric in LATENCIES else -percent
+            if worse > options.threshold:
+                regressions.append(f'{endpoint} {metric} {percent:+.1f}%')
+
+    if regressions:
+        print('\nRegressions:\n' + '\n'.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=10, help='Allowed worsening, in percent')
+    main(parser.parse_args())
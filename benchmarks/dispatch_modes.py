@@ -0,0 +1,89 @@
+"""Greedy vs batch dispatch on synthetic peak traffic, without database.
+
+The greedy dispatch serves the requests one by one, scanning the free
+drivers for the nearest one like the 'python' search backend. The batch
+dispatch computes the distance matrix of the whole window at once and
+solves the assignment. Both report the total pickup distance and the
+assignments per second:
+
+    python benchmarks/dispatch_modes.py --requests 200 --drivers 300
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'delivery'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'delivery.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from services.dispatch import optimal_assignment  # noqa: E402
+from services.utils import haversine_many, haversine_matrix  # noqa: E402
+
+
+def greedy_dispatch(pickups, drivers):
+    """Assign each pickup, in arrival order, its nearest free driver."""
+
+    free = np.ones(len(drivers), dtype=bool)
+    total = 0.0
+    for latitude, longitude in pickups:
+        distances = haversine_many(latitude, longitude, drivers[:, 0], drivers[:, 1])
+        distances[~free] = np.inf
+        column = int(np.argmin(distances))
+        free[column] = False
+        total += distances[column]
+    return total
+
+
+def batch_dispatch(pickups, drivers):
+    """Assign every pickup at once minimising the total distance."""
+
+    distances = haversine_matrix(pickups[:, 0], pickups[:, 1], drivers[:, 0], drivers[:, 1])
+    return sum(distances[row, column] for row, column in optimal_assignment(distances))
+
+
+def measure(function, pickups, drivers, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        total = function(pickups, drivers)
+        best = min(best, time.perf_counter() - started)
+    return {
+        'distance_km': round(float(total), 2),
+        'seconds': round(best, 4),
+        'assignments_per_second': round(len(pickups) / best, 1),
+    }
+
+
+def main(options):
+    rng = np.random.default_rng(options.seed)
+    # Points inside a ~20 km box around Bogotá.
+    box = np.array([[4.55, 4.75], [-74.2, -74.0]])
+    pickups = np.column_stack([rng.uniform(*box[0], options.requests), rng.uniform(*box[1], options.requests)])
+    drivers = np.column_stack([rng.uniform(*box[0], options.drivers), rng.uniform(*box[1], options.drivers)])
+
+    greedy = measure(greedy_dispatch, pickups, drivers, options.repeat)
+    batch = measure(batch_dispatch, pickups, drivers, options.repeat)
+
+    print(json.dumps({
+        'requests': options.requests,
+        'drivers': options.drivers,
+        'greedy': greedy,
+        'batch': batch,
+        'saved_km': round(greedy['distance_km'] - batch['distance_km'], 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--drivers', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,87 @@
+"""Lookup latency of the ETA providers.
+
+Builds a synthetic memory-mapped travel time matrix of --cells x --cells
+grid cells and times single lookups of the constant speed and the grid
+matrix providers at random points:
+
+    python benchmarks/eta_lookup.py --cells 60 --lookups 100000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'delivery'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'delivery.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from services.eta import ConstantSpeedETAProvider, GridMatrixETAProvider  # noqa: E402
+
+
+def build_matrix(path, cells, cell_degrees, rng):
+    """Write a random travel time matrix like the one of the build_eta_matrix command."""
+
+    count = cells * cells
+    matrix = np.lib.format.open_memmap(f'{path}.npy', mode='w+', dtype=np.float32, shape=(count, count))
+    for start in range(0, count, 512):
+        matrix[start:start + 512] = rng.uniform(1, 60, (min(512, count - start), count))
+    matrix.flush()
+
+    with open(f'{path}.json', 'w') as metadata_file:
+        json.dump({'min_lat': 4.5, 'min_lon': -74.2, 'cell_degrees': cell_degrees, 'rows': cells, 'cols': cells},
+                  metadata_file)
+
+
+def measure(provider, trips):
+    started = time.perf_counter()
+    for distance_km, origin, destination in trips:
+        provider.estimate(distance_km, origin, destination)
+    elapsed = time.perf_counter() - started
+    return {'lookups': len(trips), 'microseconds_per_lookup': round(elapsed / len(trips) * 1e6, 3)}
+
+
+def main(options):
+    rng = np.random.default_rng(options.seed)
+    cell_degrees = 0.005
+    extent = options.cells * cell_degrees
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'eta')
+        build_matrix(path, options.cells, cell_degrees, rng)
+
+        points = np.column_stack([
+            rng.uniform(4.5, 4.5 + extent, (options.lookups, 2)),
+            rng.uniform(-74.2, -74.2 + extent, (options.lookups, 2)),
+        ])
+        trips = [
+            (5.0, (float(lat1), float(lon1)), (float(lat2), float(lon2)))
+            for lat1, lat2, lon1, lon2 in points
+        ]
+
+        grid = GridMatrixETAProvider(path)
+        # Warm up, so the timed pass reads the matrix from the page cache like a running server.
+        measure(grid, trips)
+        results = {
+            'cells': options.cells * options.cells,
+            'matrix_mb': round(grid.minutes.nbytes / 2**20, 1),
+            'constant_speed': measure(ConstantSpeedETAProvider(), trips),
+            'grid_matrix': measure(grid, trips),
+        }
+        del grid
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cells', type=int, default=60, help='Cells per side of the grid')
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,21 @@
+"""Latency percentiles shared by the benchmarks, so their results are comparable."""
+import math
+
+
+def percentile(sorted_values, rank):
+    """Nearest-rank percentile of the sorted latencies, in milliseconds."""
+
+    index = max(math.ceil(rank / 100 * len(sorted_values)) - 1, 0)
+    return round(sorted_values[index] * 1000, 2)
+
+
+def latency_summary(latencies):
+    """p50, p95, p99 and maximum of the latencies in seconds, in milliseconds."""
+
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': round(latencies[-1] * 1000, 2),
+    }
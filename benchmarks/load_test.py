@@ -0,0 +1,203 @@
+"""Load test of the API with the main user flows.
+
+Virtual users run these scenarios against a running server until
+--duration seconds pass:
+
+* register/login: every driver and customer registers and logs in.
+* location pings: drivers send their position every --ping-interval seconds.
+* dispatch and close: customers send their location, request a service,
+  poll its status while it is pending and close it.
+
+Latency percentiles (p50/p95/p99), requests per second and status codes
+of every endpoint are written to --output, together with the commit of the
+tree, so runs of two commits can be compared with compare.py:
+
+    benchmarks/run_server.sh &
+    python benchmarks/load_test.py --output results/$(git rev-parse --short HEAD).json
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import httpx
+
+from latency import latency_summary
+
+
+class Recorder:
+    """Latencies and status codes of the requests, grouped by endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.status_codes = defaultdict(Counter)
+        self.windows = {}
+
+    async def request(self, client, endpoint, method, url, **kwargs):
+        """Send the request, recording it under the endpoint name; returns None on connection errors."""
+
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as error:
+            self.status_codes[endpoint][type(error).__name__] += 1
+            response = None
+        else:
+            self.status_codes[endpoint][str(response.status_code)] += 1
+        finished = time.perf_counter()
+        self.latencies[endpoint].append(finished - started)
+
+        # Throughput is measured while the endpoint is being called.
+        first_started, _ = self.windows.get(endpoint, (started, finished))
+        self.windows[endpoint] = (min(first_started, started), finished)
+        return response
+
+    def report(self):
+        report = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            codes = self.status_codes[endpoint]
+            first_started, last_finished = self.windows[endpoint]
+            report[endpoint] = {
+                'requests': len(latencies),
+                'errors': sum(count for code, count in codes.items() if not code.isdigit() or int(code) >= 500),
+                'rps': round(len(latencies) / max(last_finished - first_started, 1e-9), 2),
+                **latency_summary(latencies),
+                'status_codes': dict(codes),
+            }
+        return report
+
+
+def random_point(rng, options):
+    min_lat, min_lon, max_lat, max_lon = options.bbox
+    return {'latitude': rng.uniform(min_lat, max_lat), 'longitude': rng.uniform(min_lon, max_lon)}
+
+
+async def sign_up(client, recorder, username, is_driver):
+    """Register and log in a user, returning its authorization headers or None."""
+
+    password = 'load-test-password'
+    await recorder.request(client, 'POST /register/', 'POST', '/register/', json={
+        'username': username,
+        'password': password,
+        'is_driver': is_driver,
+        'plate': username[-8:].upper() if is_driver else '',
+    })
+    response = await recorder.request(client, 'POST /login/', 'POST', '/login/', json={
+        'username': username, 'password': password
+    })
+    if response is None or response.status_code != 200:
+        return None
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+async def driver_pings(client, recorder, headers, rng, options, deadline):
+    """Send the position of a driver until the deadline."""
+
+    while time.monotonic() < deadline:
+        await recorder.request(client, 'POST /locations/', 'POST', '/locations/', headers=headers, json={
+            'address': 'Load test', **random_point(rng, options)
+        })
+        await asyncio.sleep(options.ping_interval * rng.uniform(0.5, 1.5))
+
+
+async def customer_services(client, recorder, headers, rng, options, deadline):
+    """Request, follow and close services until the deadline."""
+
+    while time.monotonic() < deadline:
+        await recorder.request(client, 'POST /locations/', 'POST', '/locations/', headers=headers, json={
+            'address': 'Load test', **random_point(rng, options)
+        })
+        response = await recorder.request(client, 'POST /delivery/', 'POST', '/delivery/', headers=headers)
+
+        if response is not None and response.status_code == 202:
+            # Queued until a driver is free, the status is polled instead of retrying.
+            for _ in range(options.max_polls):
+                await asyncio.sleep(options.poll_interval)
+                status = await recorder.request(
+                    client, 'GET /delivery/status/', 'GET', '/delivery/status/', headers=headers
+                )
+                if status is None or status.status_code != 200 or status.json()['status'] != 'pending':
+                    break
+
+        await asyncio.sleep(options.service_seconds * rng.uniform(0.5, 1.5))
+        await recorder.request(client, 'POST /endservice/', 'POST', '/endservice/', headers=headers)
+        await asyncio.sleep(options.think_time * rng.uniform(0.5, 1.5))
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(options):
+    rng = random.Random(options.seed)
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=options.connections)
+    started_at = datetime.now(timezone.utc).isoformat()
+
+    async with httpx.AsyncClient(base_url=options.url, limits=limits, timeout=options.timeout) as client:
+        started = time.perf_counter()
+
+        # Users of previous runs are not reused, so every run starts from the same state.
+        users = [(f'load_{run_id}_driver{i:05d}', True) for i in range(options.drivers)]
+        users += [(f'load_{run_id}_customer{i:05d}', False) for i in range(options.customers)]
+        semaphore = asyncio.Semaphore(options.connections)
+
+        async def limited_sign_up(username, is_driver):
+            async with semaphore:
+                return await sign_up(client, recorder, username, is_driver)
+
+        headers = await asyncio.gather(*(limited_sign_up(username, is_driver) for username, is_driver in users))
+        drivers = [h for h, (_, is_driver) in zip(headers, users) if h and is_driver]
+        customers = [h for h, (_, is_driver) in zip(headers, users) if h and not is_driver]
+
+        deadline = time.monotonic() + options.duration
+        await asyncio.gather(
+            *(driver_pings(client, recorder, h, random.Random(rng.random()), options, deadline) for h in drivers),
+            *(customer_services(client, recorder, h, random.Random(rng.random()), options, deadline) for h in customers),
+        )
+        elapsed = time.perf_counter() - started
+
+    results = {
+        'commit': current_commit(),
+        'started_at': started_at,
+        'url': options.url,
+        'options': {key: value for key, value in vars(options).items() if key not in ('url', 'output')},
+        'elapsed_seconds': round(elapsed, 2),
+        'endpoints': recorder.report(),
+    }
+
+    print(json.dumps(results['endpoints'], indent=2))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000/api')
+    parser.add_argument('--drivers', type=int, default=50)
+    parser.add_argument('--customers', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=60, help='Seconds the scenarios run after signing up')
+    parser.add_argument('--connections', type=int, default=100, help='Maximum simultaneous connections')
+    parser.add_argument('--bbox', type=float, nargs=4, default=[4.55, -74.2, 4.75, -74.0],
+                        metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'))
+    parser.add_argument('--ping-interval', type=float, default=2, help='Seconds between driver locations')
+    parser.add_argument('--service-seconds', type=float, default=5, help='Seconds a service stays active')
+    parser.add_argument('--think-time', type=float, default=2, help='Seconds between services of a customer')
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--max-polls', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    asyncio.run(main(parser.parse_args()))
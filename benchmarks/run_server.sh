@@ -0,0 +1,21 @@
+#!/bin/bash
+# Runs the API like the container does, against a local PostgreSQL, for the load tests.
+# The connection uses the POSTGRES_* variables of settings.py (defaults: localhost:5432).
+#
+#   WORKERS=4 PORT=8000 benchmarks/run_server.sh
+
+set -e
+
+cd "$(dirname "$0")/../delivery"
+
+python manage.py migrate --noinput
+python manage.py manage_location_partitions
+
+# Metrics of every worker are written here and added up by /metrics.
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/delivery-prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+exec gunicorn delivery.asgi:application \
+    -k uvicorn.workers.UvicornWorker \
+    --workers "${WORKERS:-4}" \
+    --bind "0.0.0.0:${PORT:-8000}"
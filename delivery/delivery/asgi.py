@@ -13,4 +13,23 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'delivery.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up, the stream uses the models.
+from services.streams import location_stream  # noqa: E402
+
+LOCATION_STREAM_PATH = '/api/ws/locations/'
+
+
+async def application(scope, receive, send):
+    """Serve the driver location WebSocket and hand everything else to Django."""
+
+    if scope['type'] == 'websocket':
+        if scope['path'] == LOCATION_STREAM_PATH:
+            return await location_stream(scope, receive, send)
+
+        # Unknown WebSocket paths are rejected during the handshake.
+        await receive()
+        return await send({'type': 'websocket.close'})
+
+    return await django_application(scope, receive, send)
@@ -46,13 +46,21 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'services.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
 }
 AUTH_USER_MODEL = 'services.User'
+AUTHENTICATION_BACKENDS = ['services.authentication.PasswordExecutorBackend']
+LIST_PAGE_SIZE = 100  # Default page size of the driver and location lists
+PASSWORD_HASHING_WORKERS = 4  # Threads hashing passwords for the async login
+# Users authenticated by a token are cached for a few seconds, in process memory and
+# optionally in a cache of CACHES shared by the workers. Changes of the user invalidate it.
+AUTH_USER_CACHE_SIZE = 10000
+AUTH_USER_CACHE_TTL_SECONDS = 30
+AUTH_USER_CACHE_BACKEND = None
 # SimpleJWT Config
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),  # Token expires in 15 minutes
@@ -62,7 +70,79 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
 
+# Nearest driver search: 'index' (in-memory grid), 'python' (NumPy scan of
+# every available driver) or 'database' (ranked by PostgreSQL).
+DRIVER_SEARCH_BACKEND = 'index'
+DRIVER_SEARCH_RADII_KM = (1, 5, 25, 125)  # Bounding boxes tried by the 'database' backend
+
+DISPATCH_CANDIDATES = 10  # Nearest drivers tried when the first ones are being reserved
+
+# Dispatch of service requests: 'greedy' assigns the nearest driver when the request
+# is created, 'batch' queues it until the dispatch_pending_requests command assigns
+# the pending requests of each window minimising the total pickup distance.
+DISPATCH_MODE = 'greedy'
+DISPATCH_BATCH_WINDOW_SECONDS = 2
+DISPATCH_BATCH_MAX_SIZE = 500
+# In 'greedy' mode requests without a free driver are queued too, and dispatched by a
+# background thread when a driver is freed or sends its location.
+DISPATCH_IN_BACKGROUND = True  # False runs that dispatch in the request thread
+
+# Travel time estimation. The default provider assumes 30 km/h in straight line; to use
+# the travel times of a road graph, build them with the build_eta_matrix command and set:
+# ETA_PROVIDER = 'services.eta.GridMatrixETAProvider'
+# ETA_PROVIDER_OPTIONS = {'path': BASE_DIR / 'eta_matrix'}
+ETA_PROVIDER = 'services.eta.ConstantSpeedETAProvider'
+ETA_PROVIDER_OPTIONS = {}
+
+# In-memory index of available drivers used by the 'index' backend. Every worker process
+# keeps its own index, updated by the writes of that process and reloaded from the
+# database after DRIVER_INDEX_MAX_AGE_SECONDS. Until then a driver freed or moved through
+# another worker is missing, or at its old position, in this one: its candidates are
+# confirmed against DriverState and a search without candidates is answered by the database.
+DRIVER_INDEX_CELL_DEGREES = 0.01   # Grid cell side (~1.1 km at the equator)
+DRIVER_INDEX_MAX_AGE_SECONDS = 60  # Reload from the database after this time
+
+# Location history partitioning (see the manage_location_partitions command) and ingestion.
+LOCATION_PARTITION_DAYS = 7        # 1 for daily or 7 for weekly partitions
+LOCATION_RETENTION_DAYS = 90       # Locations older than this are dropped
+LOCATION_RECENT_DAYS = 7           # Window searched first for the latest location of a user
+LOCATION_BATCH_MAX_SIZE = 5000     # Locations accepted by POST /locations/batch/
+LOCATION_BATCH_MAX_AGE_HOURS = 24  # Oldest created_at accepted for a location of a batch
+LOCATION_BATCH_MAX_CLOCK_SKEW_SECONDS = 60  # Tolerance for the clocks of the clients ahead of the server
+LOCATION_STREAM_FLUSH_SECONDS = 5  # Latest streamed fix of each driver saved once per interval
+
+# Daily service stats of GET /stats/drivers/<id>/ and /stats/customers/<id>/, kept up to
+# date as services are created and closed (rebuilt by the rebuild_service_stats command).
+STATS_DEFAULT_DAYS = 30  # Period returned without from and to
+STATS_MAX_DAYS = 366
+
+# GET /metrics answers the addresses of METRICS_ALLOWED_IPS (by REMOTE_ADDR, the address of
+# the proxy if there is one) and requests with the "Authorization: Bearer <METRICS_TOKEN>"
+# header, to be set in the Prometheus scrape config. Anyone else gets a 403.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# The active services, pending requests and idle drivers are counted in the database at
+# most once per interval in each process, set it to the scrape interval.
+METRICS_STATE_MAX_AGE_SECONDS = 15
+
+# SQL and latency instrumentation of each view (services.middleware.InstrumentationMiddleware),
+# added to the Prometheus metrics of /metrics. Requests slower than the threshold are logged with their queries.
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_SLOW_REQUEST_MS = 500
+INSTRUMENTATION_SLOW_QUERIES_LOGGED = 50  # Queries of a slow request included in the log
+
+# cProfile of single requests (services.middleware.ProfilingMiddleware), for requests with
+# the X-Profile header printed by the profiling_token command or a random sample of them.
+# Profiles are written to the directory and added up per view by aggregate_profiles.
+PROFILING_ENABLED = False
+PROFILING_SAMPLE_RATE = 0.0  # Fraction of the requests profiled without the header
+PROFILING_TOKEN_MAX_AGE_SECONDS = 3600
+PROFILING_DIRECTORY = BASE_DIR / 'profiles'
+PROFILING_SUMMARY_FUNCTIONS = 30  # Functions in the summary saved with each profile
+
 MIDDLEWARE = [
+    'services.middleware.InstrumentationMiddleware',
+    'services.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -16,7 +16,9 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from services.views import Metrics
 
 urlpatterns = [
     path('api/', include('services.urls')),
+    path('metrics', Metrics.as_view(), name='metrics'),
 ]
@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ServicesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'services'
+
+    def ready(self):
+        # Keep the in-memory driver index in sync with the database writes.
+        from . import signals  # noqa: F401
+
+        # Time the queries of every connection, including the ones of the threads
+        # running the ORM of the async views, which are opened before any request.
+        if getattr(settings, 'INSTRUMENTATION_ENABLED', False):
+            from .middleware import install_query_recorder
+            from django.db.backends.signals import connection_created
+            connection_created.connect(install_query_recorder)
@@ -0,0 +1,160 @@
+import asyncio
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import verify_password
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+# Bounded pool hashing passwords, so PBKDF2 does not block the event loop nor the ORM thread.
+password_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'PASSWORD_HASHING_WORKERS', 4),
+    thread_name_prefix='password-hashing'
+)
+
+
+class PasswordExecutorBackend(ModelBackend):
+    """Model backend whose async authentication hashes the password in password_executor.
+
+    The user is read and the upgraded hashes are saved by the async ORM, so
+    django.contrib.auth.aauthenticate keeps firing user_login_failed and
+    upgrading the hashes while the hashing itself runs in the bounded pool.
+    """
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            user = await UserModel._default_manager.aget_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Hash anyway, so the response time does not reveal whether the user exists.
+            await loop.run_in_executor(password_executor, UserModel().set_password, password)
+            return None
+
+        is_correct, must_update = await loop.run_in_executor(
+            password_executor, verify_password, password, user.password
+        )
+
+        if is_correct and must_update:
+            # Rehash with the preferred hasher, as AbstractBaseUser.check_password does.
+            await loop.run_in_executor(password_executor, user.set_password, password)
+            await user.asave(update_fields=['password'])
+
+        if is_correct and self.user_can_authenticate(user):
+            return user
+        return None
+
+
+class UserCache:
+    """Size bounded LRU of authenticated users whose entries expire after ``ttl_seconds``.
+
+    When ``backend`` names a cache of CACHES, users missing from the process
+    memory are also looked up there, so processes share the users loaded by
+    the others. Invalidations only reach the memory of the process that runs
+    them and the shared backend, the memory of other processes expires with
+    the TTL.
+    """
+
+    def __init__(self, max_size=10000, ttl_seconds=30, backend=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def _key(self, user_id):
+        return f'auth-user:{user_id}'
+
+    def get(self, user_id):
+        """Return a copy of the cached user, or None if it is missing or expired."""
+
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                user, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._users.move_to_end(user_id)
+                    # Views may change the user, so each request gets its own copy.
+                    return copy.copy(user)
+                del self._users[user_id]
+
+        if self.backend is None:
+            return None
+
+        user = caches[self.backend].get(self._key(user_id))
+        if user is not None:
+            self._remember(user_id, user)
+        return user
+
+    def _remember(self, user_id, user):
+        with self._lock:
+            self._users[user_id] = (copy.copy(user), time.monotonic() + self.ttl_seconds)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def set(self, user_id, user):
+        user_id = str(user_id)
+        self._remember(user_id, user)
+        if self.backend is not None:
+            caches[self.backend].set(self._key(user_id), user, self.ttl_seconds)
+
+    def invalidate(self, user_id):
+        """Forget the user, so the next request reads it again from the database."""
+
+        user_id = str(user_id)
+        with self._lock:
+            self._users.pop(user_id, None)
+        if self.backend is not None:
+            caches[self.backend].delete(self._key(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+user_cache = UserCache(
+    max_size=getattr(settings, 'AUTH_USER_CACHE_SIZE', 10000),
+    ttl_seconds=getattr(settings, 'AUTH_USER_CACHE_TTL_SECONDS', 30),
+    backend=getattr(settings, 'AUTH_USER_CACHE_BACKEND', None),
+)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWT authentication that resolves the user of the token from user_cache before the database."""
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = user_cache.get(user_id) if user_id is not None else None
+
+        if user is None:
+            user = super().get_user(validated_token)
+            user_cache.set(user_id, user)
+            return user
+
+        # The user was active when cached, but tokens issued before a password
+        # change must still be rejected.
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+
+        return user
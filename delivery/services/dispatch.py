@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from scipy.optimize import linear_sum_assignment
+from .metrics import PICKUP_DISTANCE_KM
+from .models import DriverState, ServiceRequest
+from .stats import record_services_assigned
+from .utils import estimated_time, haversine_matrix, nearest_drivers
+
+logger = logging.getLogger(__name__)
+
+
+def optimal_assignment(distances):
+    """Pairs (row, column) of the distance matrix with the minimum total distance.
+
+    Solved with the Hungarian method, the matrix can have more columns than
+    rows and then every row gets a column.
+    """
+
+    rows, columns = linear_sum_assignment(distances)
+    return list(zip(rows.tolist(), columns.tolist()))
+
+def greedy_assignment(distances):
+    """Pairs (row, column) chosen like the per request dispatch: each row, in order, takes its nearest free column."""
+
+    distances = np.array(distances, dtype=np.float64)
+    pairs = []
+
+    for row in range(min(distances.shape)):
+        column = int(np.argmin(distances[row]))
+        pairs.append((row, column))
+        distances[:, column] = np.inf
+
+    return pairs
+
+def pickup_point(service):
+    """(latitude, longitude) of the pickup location saved in the service request."""
+
+    return service.pickup_latitude, service.pickup_longitude
+
+def dispatch_pending_requests(max_size=None):
+    """Assign drivers to the pending service requests in one transaction.
+
+    The oldest pending requests and the nearby free drivers are locked with
+    SELECT ... FOR UPDATE SKIP LOCKED, their distance matrix is computed at
+    once and the assignment with the minimum total pickup distance is saved.
+    Requests without a driver stay pending for the next batch. Returns the
+    stats of the batch, with the total distance the greedy dispatch would
+    have needed for the same requests and drivers.
+    """
+
+    max_size = max_size or getattr(settings, 'DISPATCH_BATCH_MAX_SIZE', 500)
+    started = time.perf_counter()
+
+    with transaction.atomic():
+        services = list(
+            ServiceRequest.objects
+            .select_for_update(skip_locked=True)
+            .filter(driver__isnull=True, is_completed=False)
+            .order_by('created_at')[:max_size]
+        )
+        pickups = [pickup_point(service) for service in services]
+
+        candidate_ids = set()
+        k = getattr(settings, 'DISPATCH_CANDIDATES', 10)
+        for latitude, longitude in pickups:
+            candidate_ids.update(driver['user_id'] for driver in nearest_drivers(latitude, longitude, k=k))
+
+        drivers = list(
+            DriverState.objects
+            .select_for_update(skip_locked=True, of=('self',))
+            .filter(driver_id__in=candidate_ids, is_busy=False, driver__is_driver=True)
+            .values_list('driver_id', 'latitude', 'longitude')
+        ) if candidate_ids else []
+
+        assigned = []
+        distance_km = greedy_distance_km = 0.0
+
+        if services and drivers:
+            # With more requests than drivers the oldest ones are served first.
+            pickups = pickups[:len(drivers)]
+            pickup_lats, pickup_lons = zip(*pickups)
+            _, driver_lats, driver_lons = zip(*drivers)
+            distances = haversine_matrix(pickup_lats, pickup_lons, driver_lats, driver_lons)
+
+            for row, column in optimal_assignment(distances):
+                service = services[row]
+                service.driver_id = drivers[column][0]
+                service.distance_km = round(float(distances[row, column]), 2)
+                service.time_minutes = estimated_time(
+                    float(distances[row, column]),
+                    origin=(drivers[column][1], drivers[column][2]),
+                    destination=pickups[row]
+                )
+                # Saved one by one, so the signals mark each driver busy.
+                service.save(update_fields=['driver', 'distance_km', 'time_minutes'])
+                assigned.append(service)
+                distance_km += float(distances[row, column])
+                PICKUP_DISTANCE_KM.observe(float(distances[row, column]))
+
+            record_services_assigned(assigned)
+
+            greedy_distance_km = sum(
+                float(distances[row, column]) for row, column in greedy_assignment(distances)
+            )
+
+    elapsed = time.perf_counter() - started
+
+    return {
+        'pending': len(services),
+        'drivers': len(drivers),
+        'assigned': len(assigned),
+        'distance_km': round(distance_km, 2),
+        'greedy_distance_km': round(greedy_distance_km, 2),
+        'saved_km': round(greedy_distance_km - distance_km, 2),
+        'seconds': round(elapsed, 4),
+        'assignments_per_second': round(len(assigned) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+class BackgroundDispatcher:
+    """Dispatches the pending requests in a background thread when a driver may have become available.
+
+    Requests for a dispatch arriving while one is already queued are merged
+    into it, so a burst of driver locations costs a single dispatch. With
+    the DISPATCH_IN_BACKGROUND setting disabled the dispatch runs in the
+    calling thread.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dispatch')
+        self._queued = False
+        self._lock = threading.Lock()
+
+    def schedule(self):
+        """Dispatch once the current transaction commits, if requests are dispatched as drivers free up."""
+
+        if getattr(settings, 'DISPATCH_MODE', 'greedy') != 'greedy':
+            return
+        transaction.on_commit(self._submit)
+
+    def _submit(self):
+        if not getattr(settings, 'DISPATCH_IN_BACKGROUND', True):
+            dispatch_pending_requests()
+            return
+
+        with self._lock:
+            if self._queued:
+                return
+            self._queued = True
+        self._executor.submit(self._run)
+
+    def _run(self):
+        # Reset before dispatching, so drivers freed during the dispatch queue another one.
+        with self._lock:
+            self._queued = False
+        try:
+            dispatch_pending_requests()
+        except Exception:
+            logger.exception('Dispatch of the pending service requests failed')
+        finally:
+            connection.close()
+
+
+dispatcher = BackgroundDispatcher()
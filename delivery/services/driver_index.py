@@ -0,0 +1,197 @@
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+
+
+class DriverIndex:
+    """In-memory grid of the positions of available drivers.
+
+    The world is split in square cells of ``cell_degrees`` side and every idle
+    driver is stored in the cell that contains its latest location, so a
+    nearest driver query only visits the cells around the pickup point.
+    The index lives in the process memory and is considered cold (it must be
+    reloaded from the database) until ``load`` is called or after
+    ``max_age_seconds`` without a reload.
+    """
+
+    def __init__(self, cell_degrees=0.01, max_age_seconds=60):
+        self.cell_degrees = cell_degrees
+        self.max_age_seconds = max_age_seconds
+        self._cells = defaultdict(dict)
+        self._positions = {}
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, driver_id):
+        return driver_id in self._positions
+
+    @property
+    def is_warm(self):
+        """True if the index was loaded recently enough to answer queries."""
+        return (
+            self._loaded_at is not None
+            and time.monotonic() - self._loaded_at < self.max_age_seconds
+        )
+
+    def _cell(self, latitude, longitude):
+        return (
+            math.floor(latitude / self.cell_degrees),
+            math.floor(longitude / self.cell_degrees)
+        )
+
+    def _insert(self, driver_id, latitude, longitude):
+        self._discard(driver_id)
+        cell = self._cell(latitude, longitude)
+        self._cells[cell][driver_id] = (latitude, longitude)
+        self._positions[driver_id] = (latitude, longitude, cell)
+
+    def _discard(self, driver_id):
+        position = self._positions.pop(driver_id, None)
+        if position is None:
+            return
+        cell = position[2]
+        drivers = self._cells[cell]
+        drivers.pop(driver_id, None)
+        if not drivers:
+            del self._cells[cell]
+
+    def load(self, positions):
+        """Replace the content of the index with (driver_id, latitude, longitude) tuples.
+
+        The new grid is built before taking the lock, so searches and updates
+        do not wait for the rows (e.g. a queryset) to be read.
+        """
+
+        grid_positions = {
+            driver_id: (latitude, longitude, self._cell(latitude, longitude))
+            for driver_id, latitude, longitude in positions
+        }
+        cells = defaultdict(dict)
+        for driver_id, (latitude, longitude, cell) in grid_positions.items():
+            cells[cell][driver_id] = (latitude, longitude)
+
+        with self._lock:
+            self._cells = cells
+            self._positions = grid_positions
+            self._loaded_at = time.monotonic()
+
+    def clear(self):
+        """Empty the index and mark it as cold."""
+
+        with self._lock:
+            self._cells.clear()
+            self._positions.clear()
+            self._loaded_at = None
+
+    def update(self, driver_id, latitude, longitude):
+        """Add an available driver or move it to its new position."""
+
+        with self._lock:
+            self._insert(driver_id, latitude, longitude)
+
+    def remove(self, driver_id):
+        """Remove a driver that is no longer available."""
+
+        with self._lock:
+            self._discard(driver_id)
+
+    def _ring(self, row, col, radius):
+        """Cells at Chebyshev distance ``radius`` of the (row, col) cell."""
+
+        if radius == 0:
+            yield (row, col)
+            return
+        for c in range(col - radius, col + radius + 1):
+            yield (row - radius, c)
+            yield (row + radius, c)
+        for r in range(row - radius + 1, row + radius):
+            yield (r, col - radius)
+            yield (r, col + radius)
+
+    def _drivers_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """Drivers stored in the cells overlapping the box, or None if that means visiting more cells than drivers."""
+
+        min_row, min_col = self._cell(min_lat, min_lon)
+        max_row, max_col = self._cell(max_lat, max_lon)
+
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._positions):
+            return None
+
+        drivers = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                drivers.extend(self._cells.get((row, col), {}).items())
+        return drivers
+
+    def search(self, latitude, longitude, k=1, radius_km=None):
+        """Return up to k (distance_km, driver_id, latitude, longitude) tuples, nearest first.
+
+        Also returns the number of drivers whose distance was computed.
+        """
+
+        from .utils import bounding_box, haversine_distance
+
+        with self._lock:
+            if not self._positions:
+                return [], 0
+
+            if radius_km is not None:
+                min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+                max_ring = math.ceil(max(max_lat - min_lat, max_lon - min_lon) / 2 / self.cell_degrees)
+            else:
+                max_ring = None
+
+            # Grow rings of cells around the pickup point until k drivers are found.
+            row, col = self._cell(latitude, longitude)
+            found = {}
+            ring = 0
+            while len(found) < k and (2 * ring + 1) ** 2 <= len(self._positions):
+                if max_ring is not None and ring > max_ring:
+                    break
+                for cell in self._ring(row, col, ring):
+                    found.update(self._cells.get(cell, {}))
+                ring += 1
+
+            # A closer driver can still sit in a cell outside the rings, so scan
+            # every cell that intersects the circle reaching the k-th candidate.
+            if len(found) >= k:
+                reach = heapq.nsmallest(k, (
+                    haversine_distance(latitude, longitude, lat, lon)
+                    for lat, lon in found.values()
+                ))[-1]
+                if radius_km is not None:
+                    reach = min(reach, radius_km)
+            else:
+                reach = radius_km
+
+            drivers = None
+            if reach is not None:
+                drivers = self._drivers_in_box(*bounding_box(latitude, longitude, reach))
+            if drivers is None:
+                drivers = [
+                    (driver_id, (lat, lon))
+                    for driver_id, (lat, lon, _) in self._positions.items()
+                ]
+
+            candidates = (
+                (haversine_distance(latitude, longitude, lat, lon), driver_id, lat, lon)
+                for driver_id, (lat, lon) in drivers
+            )
+            if radius_km is not None:
+                candidates = (candidate for candidate in candidates if candidate[0] <= radius_km)
+
+            nearest = heapq.nsmallest(k, candidates, key=lambda candidate: candidate[0])
+            scanned = (len(found) if len(found) >= k else 0) + len(drivers)
+            return nearest, scanned
+
+
+driver_index = DriverIndex(
+    cell_degrees=getattr(settings, 'DRIVER_INDEX_CELL_DEGREES', 0.01),
+    max_age_seconds=getattr(settings, 'DRIVER_INDEX_MAX_AGE_SECONDS', 60),
+)
@@ -0,0 +1,92 @@
+import json
+import math
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class ETAProvider:
+    """Estimates the travel time (in minutes) of a driver to a pickup point.
+
+    ``origin`` and ``destination`` are (latitude, longitude) tuples and can be
+    None when only the straight-line distance is known.
+    """
+
+    def estimate(self, distance_km, origin=None, destination=None):
+        raise NotImplementedError
+
+
+class ConstantSpeedETAProvider(ETAProvider):
+    """Straight-line distance at a constant average speed."""
+
+    def __init__(self, speed_kmh=30):
+        self.speed_kmh = speed_kmh
+
+    def estimate(self, distance_km, origin=None, destination=None):
+        time_hours = distance_km / self.speed_kmh
+        time_minutes = int(time_hours * 60)
+
+        return max(time_minutes, 1)
+
+
+class GridMatrixETAProvider(ETAProvider):
+    """Travel times between the cells of a grid, precomputed on a road graph.
+
+    The matrix built by the build_eta_matrix command is memory-mapped, so
+    it is shared by the processes through the page cache and a lookup is
+    just two cell computations and an array read. Trips starting or ending
+    outside the grid, or between cells not connected by the road graph, are
+    estimated by the ``fallback`` provider.
+    """
+
+    def __init__(self, path, fallback=None):
+        with open(f'{path}.json') as metadata_file:
+            metadata = json.load(metadata_file)
+
+        self.min_lat = metadata['min_lat']
+        self.min_lon = metadata['min_lon']
+        self.cell_degrees = metadata['cell_degrees']
+        self.rows = metadata['rows']
+        self.cols = metadata['cols']
+        self.minutes = np.load(f'{path}.npy', mmap_mode='r')
+        self.fallback = fallback or ConstantSpeedETAProvider()
+
+    def cell(self, latitude, longitude):
+        """Index in the matrix of the cell containing the point, or None outside the grid."""
+
+        row = math.floor((latitude - self.min_lat) / self.cell_degrees)
+        col = math.floor((longitude - self.min_lon) / self.cell_degrees)
+
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            return None
+        return row * self.cols + col
+
+    def estimate(self, distance_km, origin=None, destination=None):
+        if origin is not None and destination is not None:
+            source = self.cell(*origin)
+            target = self.cell(*destination)
+
+            if source is not None and target is not None:
+                minutes = float(self.minutes[source, target])
+                if math.isfinite(minutes):
+                    return max(math.ceil(minutes), 1)
+
+        return self.fallback.estimate(distance_km, origin, destination)
+
+
+_provider = None
+_provider_key = None
+
+def get_eta_provider():
+    """Provider configured in the ETA_PROVIDER and ETA_PROVIDER_OPTIONS settings, built once per configuration."""
+
+    global _provider, _provider_key
+
+    path = getattr(settings, 'ETA_PROVIDER', 'services.eta.ConstantSpeedETAProvider')
+    options = getattr(settings, 'ETA_PROVIDER_OPTIONS', {})
+    key = (path, json.dumps(options, sort_keys=True, default=str))
+
+    if key != _provider_key:
+        _provider = import_string(path)(**options)
+        _provider_key = key
+    return _provider
@@ -0,0 +1,46 @@
+import io
+import pstats
+from collections import defaultdict
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = 'Adds up the request profiles captured by ProfilingMiddleware and shows the top functions of each view'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default=getattr(settings, 'PROFILING_DIRECTORY', settings.BASE_DIR / 'profiles'),
+                            help='Directory of the .prof files')
+        parser.add_argument('--view',
+                            help='Only the views containing this text, e.g. "POST-delivery"')
+        parser.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'ncalls'],
+                            help='Order of the functions')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Functions shown per view')
+        parser.add_argument('--output',
+                            help='Also write the aggregated profile of each view to <output>.<view>.prof')
+
+    def handle(self, *args, **options):
+        directory = Path(options['directory'])
+        if not directory.is_dir():
+            raise CommandError(f'{directory} does not exist.')
+
+        # Profiles are named <view>.<time>.<id>.prof by the middleware.
+        profiles = defaultdict(list)
+        for path in sorted(directory.glob('*.prof')):
+            view = path.name.split('.')[0]
+            if options['view'] is None or options['view'] in view:
+                profiles[view].append(path)
+
+        if not profiles:
+            raise CommandError(f'No profiles found in {directory}.')
+
+        for view, paths in sorted(profiles.items()):
+            stats = pstats.Stats(*map(str, paths), stream=io.StringIO())
+            stats.sort_stats(options['sort']).print_stats(options['limit'])
+
+            self.stdout.write(self.style.SUCCESS(f'{view}: {len(paths)} profiles, {stats.total_tt:.3f} s profiled'))
+            self.stdout.write(stats.stream.getvalue())
+
+            if options['output']:
+                stats.dump_stats(f"{options['output']}.{view}.prof")
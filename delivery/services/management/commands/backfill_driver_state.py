@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from services.models import DriverState, Location, ServiceRequest
+
+class Command(BaseCommand):
+    help = 'Rebuilds the driver state table from the latest driver locations and active services'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per query')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        active_services = dict(
+            ServiceRequest.objects
+            .filter(is_completed=False, driver__isnull=False)
+            .values_list('driver_id', 'id')
+        )
+
+        latest_locations = (
+            Location.objects
+            .filter(user__is_driver=True)
+            .order_by('user', '-created_at')
+            .distinct('user')
+            .values_list('user_id', 'latitude', 'longitude', 'created_at')
+        )
+
+        states = []
+        total = 0
+
+        for driver_id, latitude, longitude, created_at in latest_locations.iterator(chunk_size=batch_size):
+            states.append(DriverState(
+                driver_id=driver_id,
+                latitude=latitude,
+                longitude=longitude,
+                last_seen=created_at,
+                is_busy=driver_id in active_services,
+                current_service_id=active_services.get(driver_id)
+            ))
+
+            if len(states) == batch_size:
+                total += self.save_states(states)
+                states = []
+
+        total += self.save_states(states)
+
+        self.stdout.write(self.style.SUCCESS(f'¡{total} driver states rebuilt!'))
+
+    def save_states(self, states):
+        """Insert or overwrite the state of a batch of drivers."""
+
+        DriverState.objects.bulk_create(
+            states,
+            update_conflicts=True,
+            unique_fields=['driver'],
+            update_fields=['latitude', 'longitude', 'last_seen', 'is_busy', 'current_service']
+        )
+        return len(states)
@@ -0,0 +1,126 @@
+import csv
+import json
+import math
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from services.utils import haversine_matrix
+
+class Command(BaseCommand):
+    help = 'Builds the cell to cell travel time matrix of GridMatrixETAProvider from a road graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('graph',
+                            help='CSV of road segments with columns from_lat, from_lon, to_lat, to_lon, minutes')
+        parser.add_argument('output',
+                            help='Path of the matrix, written as <output>.npy and <output>.json')
+        parser.add_argument('--cell-degrees', type=float, default=0.01,
+                            help='Grid cell side in degrees')
+        parser.add_argument('--bbox', type=float, nargs=4, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                            help='Area covered by the grid, the bounds of the graph by default')
+        parser.add_argument('--two-way', action='store_true',
+                            help='Every segment can be driven in both directions')
+        parser.add_argument('--max-snap-km', type=float, default=1.0,
+                            help='Cells farther than this from the road graph are left to the fallback provider')
+        parser.add_argument('--access-speed-kmh', type=float, default=30,
+                            help='Speed between the centre of a cell and its nearest graph node')
+        parser.add_argument('--batch-size', type=int, default=256,
+                            help='Cells whose shortest paths are computed at once')
+
+    def handle(self, *args, **options):
+        nodes, graph = self.read_graph(options['graph'], options['two_way'])
+        node_points = np.array(list(nodes), dtype=np.float64)
+
+        if options['bbox']:
+            min_lat, min_lon, max_lat, max_lon = options['bbox']
+        else:
+            min_lat, min_lon = node_points.min(axis=0)
+            max_lat, max_lon = node_points.max(axis=0)
+
+        cell_degrees = options['cell_degrees']
+        rows = max(math.ceil((max_lat - min_lat) / cell_degrees), 1)
+        cols = max(math.ceil((max_lon - min_lon) / cell_degrees), 1)
+
+        # Each cell is reached through the graph node nearest to its centre.
+        centres_lat = min_lat + (np.arange(rows) + 0.5) * cell_degrees
+        centres_lon = min_lon + (np.arange(cols) + 0.5) * cell_degrees
+        centres = np.array([(lat, lon) for lat in centres_lat for lon in centres_lon])
+        cell_nodes, access_minutes = self.snap(centres, node_points, options)
+
+        matrix = np.lib.format.open_memmap(
+            f"{options['output']}.npy", mode='w+', dtype=np.float32, shape=(len(centres), len(centres))
+        )
+
+        for start in range(0, len(centres), options['batch_size']):
+            sources = cell_nodes[start:start + options['batch_size']]
+            minutes = np.full((len(sources), len(centres)), np.inf)
+            snapped = sources >= 0
+
+            if snapped.any():
+                node_minutes = dijkstra(graph, indices=sources[snapped])
+                reachable = cell_nodes >= 0
+                minutes[np.ix_(snapped, reachable)] = (
+                    node_minutes[:, cell_nodes[reachable]]
+                    + access_minutes[start:start + len(sources)][snapped, np.newaxis]
+                    + access_minutes[np.newaxis, reachable]
+                )
+
+            matrix[start:start + len(sources)] = minutes
+
+        matrix.flush()
+
+        with open(f"{options['output']}.json", 'w') as metadata_file:
+            json.dump({
+                'min_lat': float(min_lat),
+                'min_lon': float(min_lon),
+                'cell_degrees': cell_degrees,
+                'rows': rows,
+                'cols': cols,
+            }, metadata_file)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'¡Travel times between {rows * cols} cells computed on a graph of {len(nodes)} nodes!'
+        ))
+
+    def read_graph(self, path, two_way):
+        """Nodes of the graph, mapped to their index, and its sparse matrix of minutes."""
+
+        nodes = {}
+        edges = {}
+
+        def node(latitude, longitude):
+            return nodes.setdefault((round(float(latitude), 7), round(float(longitude), 7)), len(nodes))
+
+        with open(path, newline='') as graph_file:
+            for segment in csv.DictReader(graph_file):
+                source = node(segment['from_lat'], segment['from_lon'])
+                target = node(segment['to_lat'], segment['to_lon'])
+                minutes = float(segment['minutes'])
+
+                pairs = [(source, target), (target, source)] if two_way else [(source, target)]
+                for pair in pairs:
+                    # Keep the fastest of parallel segments.
+                    edges[pair] = min(minutes, edges.get(pair, math.inf))
+
+        if not edges:
+            raise CommandError('The road graph has no segments.')
+
+        sources, targets = zip(*edges)
+        graph = csr_matrix((list(edges.values()), (sources, targets)), shape=(len(nodes), len(nodes)))
+        return nodes, graph
+
+    def snap(self, centres, node_points, options):
+        """Nearest graph node of each cell centre (-1 if too far) and the minutes to reach it."""
+
+        cell_nodes = np.empty(len(centres), dtype=np.int64)
+        distances = np.empty(len(centres))
+
+        for start in range(0, len(centres), options['batch_size']):
+            chunk = centres[start:start + options['batch_size']]
+            chunk_distances = haversine_matrix(chunk[:, 0], chunk[:, 1], node_points[:, 0], node_points[:, 1])
+            cell_nodes[start:start + len(chunk)] = chunk_distances.argmin(axis=1)
+            distances[start:start + len(chunk)] = chunk_distances.min(axis=1)
+
+        cell_nodes[distances > options['max_snap_km']] = -1
+        return cell_nodes, distances / options['access_speed_kmh'] * 60
@@ -1,29 +1,133 @@
+import csv
+import io
+import random
+import string
+import uuid
+from datetime import timedelta
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
-from services.models import User, Location
+from django.db import connection, transaction
+from django.utils import timezone
+from services.models import DriverState, User, Location
 from faker import Faker
 
 class Command(BaseCommand):
-    help = 'Generates 20 drivers with false addresses'
+    help = 'Generates drivers and customers with false addresses, in bulk for performance tests'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=20,
+                            help='Number of drivers to generate')
+        parser.add_argument('--customers', type=int, default=0,
+                            help='Number of customers to generate, with one location each')
+        parser.add_argument('--locations-per-driver', type=int, default=1,
+                            help='Locations of each driver, the newest one is its current position')
+        parser.add_argument('--bbox', type=float, nargs=4, default=[-90, -180, 90, 180],
+                            metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                            help='Area of the generated locations')
+        parser.add_argument('--days', type=float, default=1,
+                            help='Locations are spread over this number of past days')
+        parser.add_argument('--seed', type=int,
+                            help='Seed of the random data: it repeats the coordinates, addresses, plates and ages '
+                                 'of the locations, while usernames, ids and timestamps are new on every run')
+        parser.add_argument('--password', default='password123',
+                            help='Password of every generated user')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Users written per transaction')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
         fake = Faker()
+        fake.seed_instance(options['seed'])
+
+        # Faker is slow for millions of rows, so addresses are drawn from a pool.
+        self.addresses = [fake.address().replace('\n', ', ') for _ in range(1000)]
+        # Hashing is the slowest step of creating a user, so it is done only once.
+        self.password = make_password(options['password'])
+        self.options = options
+        self.now = timezone.now()
+
+        # Usernames are unique per run, so the command can be run again on the same database.
+        prefix = uuid.uuid4().hex[:8]
+        batch_size = options['batch_size']
+        locations = 0
+
+        for role, total, locations_per_user in [
+            ('driver', options['drivers'], options['locations_per_driver']),
+            ('customer', options['customers'], 1),
+        ]:
+            for start in range(0, total, batch_size):
+                usernames = [f'{prefix}_{role}{i}' for i in range(start, min(start + batch_size, total))]
+                locations += self.create_users(usernames, role == 'driver', locations_per_user)
 
-        # Create 20 drivers
-        for _ in range(20):
-            # Create driver user
-            user = User.objects.create(
-                username=fake.user_name(),
-                password=fake.password(),
-                plate=fake.license_plate(),
-                is_driver=True
+        self.stdout.write(self.style.SUCCESS(
+            f"¡{options['drivers']} drivers and {options['customers']} customers "
+            f"with {locations} false addresses generated!"
+        ))
+
+    def create_users(self, usernames, is_driver, locations_per_user):
+        """Insert a batch of users with their locations, and the current position of the drivers."""
+
+        users = [
+            User(
+                username=username,
+                password=self.password,
+                plate=self.plate() if is_driver else '',
+                is_driver=is_driver
             )
-            
-            # Create a dummy address for each driver
-            Location.objects.create(
-                user=user,
-                address=fake.address(),
-                latitude=fake.latitude(),
-                longitude=fake.longitude()
+            for username in usernames
+        ]
+        locations = [
+            (user.id, *self.location())
+            for user in users
+            for _ in range(locations_per_user)
+        ]
+
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            self.copy_locations(locations)
+
+            if is_driver:
+                # The current position of each driver is its newest location.
+                latest = {}
+                for user_id, address, latitude, longitude, created_at in locations:
+                    if user_id not in latest or created_at > latest[user_id][2]:
+                        latest[user_id] = (latitude, longitude, created_at)
+
+                DriverState.objects.bulk_create([
+                    DriverState(driver_id=user_id, latitude=latitude, longitude=longitude, last_seen=created_at)
+                    for user_id, (latitude, longitude, created_at) in latest.items()
+                ])
+
+        return len(locations)
+
+    def copy_locations(self, locations):
+        """Write the locations with COPY, which also keeps their created_at (bulk_create would overwrite it)."""
+
+        rows = io.StringIO()
+        writer = csv.writer(rows)
+        for user_id, address, latitude, longitude, created_at in locations:
+            writer.writerow([uuid.uuid4(), user_id, address, latitude, longitude, created_at.isoformat()])
+        rows.seek(0)
+
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {Location._meta.db_table} (id, user_id, address, latitude, longitude, created_at) '
+                'FROM STDIN WITH (FORMAT csv)',
+                rows
             )
 
-        self.stdout.write(self.style.SUCCESS('¡20 drivers with false addresses generated!'))
\ No newline at end of file
+    def location(self):
+        """Random (address, latitude, longitude, created_at) inside the bounding box and the period."""
+
+        min_lat, min_lon, max_lat, max_lon = self.options['bbox']
+        return (
+            self.random.choice(self.addresses),
+            self.random.uniform(min_lat, max_lat),
+            self.random.uniform(min_lon, max_lon),
+            self.now - timedelta(days=self.random.uniform(0, self.options['days']))
+        )
+
+    def plate(self):
+        letters = ''.join(self.random.choices(string.ascii_uppercase, k=3))
+        digits = ''.join(self.random.choices(string.digits, k=3))
+        return letters + digits
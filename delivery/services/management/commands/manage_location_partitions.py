@@ -0,0 +1,108 @@
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+PARENT_TABLE = 'services_location'
+DEFAULT_PARTITION = 'services_location_default'
+BOUND_PATTERN = r"FROM \('([^']+)'\) TO \('([^']+)'\)"
+FIRST_MONDAY = date(1970, 1, 5)
+
+def period_start(day, period_days):
+    """First day of the partition period containing day (weekly periods start on Monday)."""
+    return day - timedelta(days=(day - FIRST_MONDAY).days % period_days)
+
+class Command(BaseCommand):
+    help = 'Creates the upcoming location partitions and drops the ones older than the retention window'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=4,
+                            help='Number of future partitions to create')
+        parser.add_argument('--retention-days', type=int, default=settings.LOCATION_RETENTION_DAYS,
+                            help='Locations older than this number of days are removed')
+        parser.add_argument('--keep-detached', action='store_true',
+                            help='Detach the old partitions without dropping them')
+
+    def handle(self, *args, **options):
+        period_days = settings.LOCATION_PARTITION_DAYS
+        partitions = self.get_partitions()
+
+        # Create the partition of the current period and the upcoming ones.
+        first_day = period_start(timezone.now().date(), period_days)
+        created = 0
+
+        for i in range(options['ahead'] + 1):
+            lower = self.to_datetime(first_day + timedelta(days=period_days * i))
+            upper = lower + timedelta(days=period_days)
+
+            # Skip periods already covered, e.g. after changing LOCATION_PARTITION_DAYS.
+            if any(lower < end and start < upper for start, end in partitions.values()):
+                continue
+
+            name = f'{PARENT_TABLE}_p{lower:%Y%m%d}'
+            self.create_partition(name, lower, upper)
+            partitions[name] = (lower, upper)
+            created += 1
+
+        # Remove the partitions entirely older than the retention window.
+        cutoff = timezone.now() - timedelta(days=options['retention_days'])
+        removed = 0
+
+        for name, (lower, upper) in sorted(partitions.items()):
+            if upper > cutoff:
+                continue
+
+            with connection.cursor() as cursor:
+                cursor.execute(f'ALTER TABLE {PARENT_TABLE} DETACH PARTITION {connection.ops.quote_name(name)}')
+                if not options['keep_detached']:
+                    cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
+            removed += 1
+
+        # Rows that landed in the default partition are deleted instead.
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at < %s', [cutoff])
+            deleted = cursor.rowcount
+
+        self.stdout.write(self.style.SUCCESS(
+            f'¡{created} partitions created, {removed} partitions removed and {deleted} old locations deleted!'
+        ))
+
+    def to_datetime(self, day):
+        return datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+
+    def get_partitions(self):
+        """Dated partitions of the location table with their (lower, upper) bounds."""
+
+        # The bounds are cast by PostgreSQL: their text ('2026-10-12 00:00:00+00')
+        # has a short offset that datetime.fromisoformat rejects before Python 3.11.
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT child.relname, bounds[1]::timestamptz, bounds[2]::timestamptz
+                FROM pg_inherits
+                JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                CROSS JOIN LATERAL regexp_match(pg_get_expr(child.relpartbound, child.oid), %s) AS bounds
+                WHERE parent.relname = %s AND bounds IS NOT NULL
+            """, [BOUND_PATTERN, PARENT_TABLE])
+            return {name: (lower, upper) for name, lower, upper in cursor.fetchall()}
+
+    def create_partition(self, name, lower, upper):
+        """Create a partition, moving into it the rows of its period stored in the default partition."""
+
+        name = connection.ops.quote_name(name)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS)')
+            cursor.execute(
+                f'INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s',
+                [lower, upper]
+            )
+            cursor.execute(
+                f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s',
+                [lower, upper]
+            )
+            cursor.execute(
+                f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+            )
@@ -0,0 +1,8 @@
+from django.core.management.base import BaseCommand
+from services.middleware import profiling_token
+
+class Command(BaseCommand):
+    help = 'Prints a signed value of the X-Profile header, which has ProfilingMiddleware profile the request'
+
+    def handle(self, *args, **options):
+        self.stdout.write(profiling_token())
@@ -0,0 +1,22 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from services.stats import rebuild_daily_stats
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily service stats of customers and drivers from the service requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', type=date.fromisoformat,
+                            help='First day rebuilt (YYYY-MM-DD), the first service by default')
+        parser.add_argument('--to', dest='end', type=date.fromisoformat,
+                            help='Last day rebuilt (YYYY-MM-DD), the last service by default')
+
+    def handle(self, *args, **options):
+        start, end = options['start'], options['end']
+
+        if start and end and start > end:
+            raise CommandError('--from cannot be later than --to.')
+
+        rebuilt = rebuild_daily_stats(start, end)
+
+        self.stdout.write(self.style.SUCCESS(f'¡{rebuilt} daily stats rebuilt!'))
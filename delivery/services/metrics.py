@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from django.conf import settings
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+# With gunicorn every worker has its own counters. Setting PROMETHEUS_MULTIPROC_DIR
+# (to an empty directory, before the workers start) makes them write the values to
+# memory-mapped files there, and /metrics adds up the files of every worker.
+
+DRIVER_SEARCH_SECONDS = Histogram(
+    'delivery_driver_search_seconds',
+    'Time to find the nearest available drivers',
+    ['backend'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+DRIVER_SEARCH_CANDIDATES = Histogram(
+    'delivery_driver_search_candidates',
+    'Drivers whose distance was computed in a nearest driver search (rows ranked by the database backend)',
+    ['backend'],
+    buckets=(1, 10, 100, 1000, 10000, 100000, 1000000),
+)
+DISPATCH_SECONDS = Histogram(
+    'delivery_dispatch_seconds',
+    'Time to assign a driver to a new service request, or to queue it without one',
+    ['outcome'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+SERVICE_REQUESTS = Counter(
+    'delivery_service_requests',
+    'Service requests created, by outcome: assigned a driver, queued because no driver was free '
+    'or batched for the dispatch of pending requests',
+    ['outcome'],
+)
+PICKUP_DISTANCE_KM = Histogram(
+    'delivery_pickup_distance_km',
+    'Distance from the assigned driver to the pickup point, on creation or by the dispatch of pending requests',
+    buckets=(0.25, 0.5, 1, 2, 5, 10, 25, 50, 100),
+)
+SERVICES_CLOSED = Counter(
+    'delivery_services_closed',
+    'Service requests closed by their customer or driver',
+)
+REQUEST_SECONDS = Histogram(
+    'delivery_request_seconds',
+    'Wall time of the requests measured by the instrumentation middleware, by view',
+    ['view'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    'delivery_request_queries',
+    'SQL queries run by each instrumented request, by view',
+    ['view'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+REQUEST_SQL_SECONDS = Counter(
+    'delivery_request_sql_seconds',
+    'Time spent in SQL queries by the instrumented requests, by view',
+    ['view'],
+)
+REQUEST_RENDER_SECONDS = Counter(
+    'delivery_request_render_seconds',
+    'Time spent rendering the responses of the instrumented requests, by view',
+    ['view'],
+)
+SLOW_REQUESTS = Counter(
+    'delivery_slow_requests',
+    'Instrumented requests slower than INSTRUMENTATION_SLOW_REQUEST_MS, by view',
+    ['view'],
+)
+
+
+def record_dispatch(outcome, started, distance_km=None):
+    """Count a service request dispatched from ``started`` (a perf_counter time)."""
+
+    DISPATCH_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+    SERVICE_REQUESTS.labels(outcome).inc()
+    if distance_km is not None:
+        PICKUP_DISTANCE_KM.observe(distance_km)
+
+def record_request(view, metrics, wall_seconds, slow):
+    """Add the queries and timings of an instrumented request to the counters of its view."""
+
+    REQUEST_SECONDS.labels(view).observe(wall_seconds)
+    REQUEST_QUERIES.labels(view).observe(metrics.queries)
+    REQUEST_SQL_SECONDS.labels(view).inc(metrics.sql_seconds)
+    REQUEST_RENDER_SECONDS.labels(view).inc(metrics.render_seconds)
+    if slow:
+        SLOW_REQUESTS.labels(view).inc()
+
+
+class ServiceStateCollector:
+    """Active services, pending requests and idle drivers, read from the database on scrapes.
+
+    Being shared by every worker, they are counted once instead of being
+    tracked as gauges of each process. The counts are kept for
+    METRICS_STATE_MAX_AGE_SECONDS, so scrapes more frequent than that do not
+    query the database.
+    """
+
+    def __init__(self):
+        self._gauges = None
+        self._read_at = None
+        self._lock = threading.Lock()
+
+    def collect(self):
+        for name, documentation, value in self.gauges():
+            yield GaugeMetricFamily(name, documentation, value=value)
+
+    def gauges(self):
+        max_age = getattr(settings, 'METRICS_STATE_MAX_AGE_SECONDS', 15)
+
+        with self._lock:
+            if self._gauges is None or time.monotonic() - self._read_at >= max_age:
+                self._gauges = self.read_gauges()
+                self._read_at = time.monotonic()
+            return self._gauges
+
+    def read_gauges(self):
+        from .models import DriverState, ServiceRequest
+
+        services = ServiceRequest.objects.filter(is_completed=False)
+        return [
+            ('delivery_active_services', 'Service requests with a driver assigned and not closed',
+             services.filter(driver__isnull=False).count()),
+            ('delivery_pending_services', 'Service requests waiting for a free driver',
+             services.filter(driver__isnull=True).count()),
+            ('delivery_idle_drivers', 'Drivers with a known position and no active service',
+             DriverState.objects.filter(is_busy=False, driver__is_driver=True).count()),
+        ]
+
+    def clear(self):
+        """Read the counts again on the next scrape."""
+
+        with self._lock:
+            self._gauges = None
+
+
+service_state = ServiceStateCollector()
+state_registry = CollectorRegistry(auto_describe=False)
+state_registry.register(service_state)
+
+def latest_metrics():
+    """Metrics in the Prometheus text format, of every worker in multiprocess mode."""
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry) + generate_latest(state_registry)
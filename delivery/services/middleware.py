@@ -0,0 +1,240 @@
+import cProfile
+import io
+import logging
+import pstats
+import random
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+from django.db import connections
+from django.db.backends.signals import connection_created
+from .metrics import record_request
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetrics:
+    """SQL queries and timings of a request."""
+
+    def __init__(self, max_queries):
+        self.started = time.perf_counter()
+        self.max_queries = max_queries
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        # Only the first queries are kept for the slow request log.
+        self.query_log = []
+
+    def __call__(self, execute, sql, params, many, context):
+        """Execute wrapper timing the queries of the request."""
+
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.sql_seconds += elapsed
+            if len(self.query_log) < self.max_queries:
+                self.query_log.append((sql, elapsed))
+
+
+# Metrics of the request being handled. Context variables follow the request into
+# the threads of sync_to_async, where the ORM of the async views runs.
+current_request_metrics = ContextVar('current_request_metrics', default=None)
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, timing the query if a request is being instrumented."""
+
+    metrics = current_request_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+def request_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return f"{request.method} {match.view_name if match else 'unresolved'}"
+
+
+class InstrumentationMiddleware:
+    """Records the SQL queries, SQL time, rendering time and wall time of each request.
+
+    The counters are added per view to the Prometheus metrics served by
+    /metrics and requests slower than INSTRUMENTATION_SLOW_REQUEST_MS are
+    logged with their queries. It is
+    removed from the middleware chain unless INSTRUMENTATION_ENABLED is set.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'INSTRUMENTATION_ENABLED', False):
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+        self.slow_seconds = getattr(settings, 'INSTRUMENTATION_SLOW_REQUEST_MS', 500) / 1000
+        self.max_queries = getattr(settings, 'INSTRUMENTATION_SLOW_QUERIES_LOGGED', 50)
+
+        # Connections opened later get the wrapper when they are created (the
+        # receiver is also connected on startup, see ServicesConfig.ready).
+        connection_created.connect(install_query_recorder)
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        metrics = RequestMetrics(self.max_queries)
+        token = current_request_metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request_metrics.reset(token)
+        self.record(request, response, metrics)
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics(self.max_queries)
+        token = current_request_metrics.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request_metrics.reset(token)
+        self.record(request, response, metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        """Time the rendering of the REST framework responses, which happens after this hook."""
+
+        metrics = current_request_metrics.get()
+        if metrics is not None:
+            started = time.perf_counter()
+
+            def rendered(response):
+                metrics.render_seconds += time.perf_counter() - started
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def record(self, request, response, metrics):
+        wall_seconds = time.perf_counter() - metrics.started
+        view = request_view_name(request)
+        slow = wall_seconds >= self.slow_seconds
+
+        record_request(view, metrics, wall_seconds, slow)
+
+        if slow:
+            logger.warning(
+                'Slow request %s %s (%s): %.1f ms, %d queries in %.1f ms, rendered in %.1f ms\n%s',
+                request.method, request.path, view, wall_seconds * 1000, metrics.queries,
+                metrics.sql_seconds * 1000, metrics.render_seconds * 1000,
+                '\n'.join(f'  {elapsed * 1000:.1f} ms  {sql}' for sql, elapsed in metrics.query_log)
+            )
+
+
+PROFILING_SALT = 'services.middleware.profiling'
+
+def profiling_token():
+    """Value of the X-Profile header that has a request profiled, valid for PROFILING_TOKEN_MAX_AGE_SECONDS."""
+
+    return signing.TimestampSigner(salt=PROFILING_SALT).sign('profile')
+
+
+class ProfilingMiddleware:
+    """Runs sampled requests under cProfile, saving a profile and a summary of each one.
+
+    A request is profiled if it has an X-Profile header signed by
+    profiling_token() or, at random, for a PROFILING_SAMPLE_RATE fraction of
+    the requests. Its <view>.<time>.<id>.prof file and the .txt summary of
+    the top functions are written to PROFILING_DIRECTORY, and the id is
+    returned in the X-Profile-Id header. The aggregate_profiles command adds
+    up the profiles of each view. Requests not sampled run as usual and the
+    middleware is removed from the chain unless PROFILING_ENABLED is set.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+        self.token_max_age = getattr(settings, 'PROFILING_TOKEN_MAX_AGE_SECONDS', 3600)
+        self.directory = Path(getattr(settings, 'PROFILING_DIRECTORY', settings.BASE_DIR / 'profiles'))
+        self.summary_functions = getattr(settings, 'PROFILING_SUMMARY_FUNCTIONS', 30)
+
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        if not self.is_sampled(request):
+            return self.get_response(request)
+        return self.profile(request, lambda: self.get_response(request))
+
+    async def __acall__(self, request):
+        if not self.is_sampled(request):
+            return await self.get_response(request)
+
+        # The rest of the chain is driven from a thread under the profiler. The
+        # sync_to_async calls of the view (the ORM, the serializers, the rendering)
+        # come back to that thread, so they are profiled with it.
+        return await sync_to_async(self.profile)(request, lambda: async_to_sync(self.get_response)(request))
+
+    def is_sampled(self, request):
+        token = request.META.get('HTTP_X_PROFILE')
+        if token is not None:
+            try:
+                signing.TimestampSigner(salt=PROFILING_SALT).unsign(token, max_age=self.token_max_age)
+                return True
+            except signing.BadSignature:
+                pass
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile(self, request, get_response):
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = get_response()
+        finally:
+            profiler.disable()
+        wall_seconds = time.perf_counter() - started
+
+        view = request_view_name(request)
+        profile_id = '.'.join([
+            re.sub(r'[^\w-]', '-', view),
+            timezone.now().strftime('%Y%m%dT%H%M%S'),
+            uuid.uuid4().hex[:8],
+        ])
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(self.directory / f'{profile_id}.prof')
+
+        summary = io.StringIO()
+        summary.write(f'{view} {request.get_full_path()}: {response.status_code} in {wall_seconds * 1000:.1f} ms\n')
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(self.summary_functions)
+        (self.directory / f'{profile_id}.txt').write_text(summary.getvalue())
+
+        response['X-Profile-Id'] = profile_id
+        return response
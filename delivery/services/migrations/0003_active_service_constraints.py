@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:41
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def complete_duplicated_active_services(apps, schema_editor):
+    """Close all but the newest active service of each driver and customer, so the constraints can be created."""
+
+    ServiceRequest = apps.get_model('services', 'ServiceRequest')
+
+    for field in ('driver_id', 'customer_id'):
+        seen = set()
+        active_services = (
+            ServiceRequest.objects
+            .filter(is_completed=False)
+            .order_by(field, '-created_at')
+            .values_list('id', field)
+        )
+        duplicated_ids = []
+        for service_id, user_id in active_services:
+            if user_id in seen:
+                duplicated_ids.append(service_id)
+            seen.add(user_id)
+
+        ServiceRequest.objects.filter(id__in=duplicated_ids).update(
+            is_completed=True, close_service_at=timezone.now()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0002_location_lat_lon_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(complete_duplicated_active_services, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='servicerequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_completed', False)), fields=('driver',), name='unique_active_service_per_driver'),
+        ),
+        migrations.AddConstraint(
+            model_name='servicerequest',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_completed', False)), fields=('customer',), name='unique_active_service_per_customer'),
+        ),
+    ]
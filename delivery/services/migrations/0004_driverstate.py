@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0003_active_service_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DriverState',
+            fields=[
+                ('driver', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('last_seen', models.DateTimeField()),
+                ('is_busy', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='location',
+            name='location_lat_lon_idx',
+        ),
+        migrations.AddField(
+            model_name='driverstate',
+            name='current_service',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='services.servicerequest'),
+        ),
+        migrations.AddIndex(
+            model_name='driverstate',
+            index=models.Index(condition=models.Q(('is_busy', False)), fields=['latitude', 'longitude'], name='driverstate_idle_lat_lon_idx'),
+        ),
+    ]
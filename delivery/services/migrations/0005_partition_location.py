@@ -0,0 +1,69 @@
+from django.db import migrations
+
+
+def rebuild_location_table(partition_clause, primary_key, extra_statements=''):
+    """SQL recreating services_location with its data, indexes and foreign keys."""
+
+    return f"""
+    DO $$
+    DECLARE
+        index_definitions text[];
+        foreign_keys text[];
+        statement text;
+    BEGIN
+        SELECT coalesce(array_agg(indexdef), '{{}}') INTO index_definitions
+        FROM pg_indexes
+        WHERE schemaname = current_schema()
+          AND tablename = 'services_location'
+          AND indexname <> 'services_location_pkey';
+
+        SELECT coalesce(array_agg(format(
+            'ALTER TABLE services_location ADD CONSTRAINT %I %s', conname, pg_get_constraintdef(oid)
+        )), '{{}}') INTO foreign_keys
+        FROM pg_constraint
+        WHERE conrelid = 'services_location'::regclass AND contype = 'f';
+
+        ALTER TABLE services_location RENAME TO services_location_old;
+        ALTER TABLE services_location_old RENAME CONSTRAINT services_location_pkey TO services_location_old_pkey;
+
+        CREATE TABLE services_location (LIKE services_location_old INCLUDING DEFAULTS) {partition_clause};
+        ALTER TABLE services_location ADD CONSTRAINT services_location_pkey PRIMARY KEY ({primary_key});
+        {extra_statements}
+
+        INSERT INTO services_location SELECT * FROM services_location_old;
+        DROP TABLE services_location_old;
+
+        FOREACH statement IN ARRAY index_definitions LOOP
+            EXECUTE statement;
+        END LOOP;
+        FOREACH statement IN ARRAY foreign_keys LOOP
+            EXECUTE statement;
+        END LOOP;
+    END $$;
+    """
+
+
+class Migration(migrations.Migration):
+    """Range partition the location history by created_at.
+
+    Every existing row goes to the default partition; the
+    manage_location_partitions command creates the dated partitions and
+    drops the old ones. PostgreSQL requires the partition key in the primary
+    key, so the table key becomes (id, created_at) while the model keeps
+    using id.
+    """
+
+    dependencies = [
+        ('services', '0004_driverstate'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            rebuild_location_table(
+                'PARTITION BY RANGE (created_at)',
+                'id, created_at',
+                'CREATE TABLE services_location_default PARTITION OF services_location DEFAULT;'
+            ),
+            rebuild_location_table('', 'id'),
+        ),
+    ]
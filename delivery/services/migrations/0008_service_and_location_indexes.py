@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# The single column foreign key indexes are covered by the composite indexes
+# starting with the same column. They are dropped by name, since AlterField
+# would also drop the partial unique indexes of the active services.
+FOREIGN_KEY_INDEXES = [
+    ('services_location', 'services_location_user_id_467bb1fc', 'user_id'),
+    ('services_servicerequest', 'services_servicerequest_customer_id_4e375274', 'customer_id'),
+    ('services_servicerequest', 'services_servicerequest_driver_id_6acccc7f', 'driver_id'),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0007_batch_dispatch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['customer', 'is_completed'], name='servicerequest_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['driver', 'is_completed'], name='servicerequest_driver_idx'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql=f'DROP INDEX IF EXISTS {index}',
+                    reverse_sql=f'CREATE INDEX {index} ON {table} ({column})',
+                )
+                for table, index, column in FOREIGN_KEY_INDEXES
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='location',
+                    name='user',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='servicerequest',
+                    name='customer',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='requests', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='servicerequest',
+                    name='driver',
+                    field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+    ]
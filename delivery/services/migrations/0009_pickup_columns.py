@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0008_service_and_location_indexes'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='servicerequest',
+            old_name='pickup_location',
+            new_name='pickup_location_json',
+        ),
+        migrations.AlterField(
+            model_name='servicerequest',
+            name='pickup_location_json',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='pickup_location',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='services.location'),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='pickup_address',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='pickup_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='pickup_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:40
+
+from django.db import migrations
+
+BATCH_SIZE = 5000
+
+
+def decode_pickup_locations(apps, schema_editor):
+    """Copy the pickup location saved as a JSON string into the new columns, in batches of services."""
+
+    table = apps.get_model('services', 'ServiceRequest')._meta.db_table
+    last_id = None
+
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            # `#>> '{}'` is the text of the JSON string (or of the object of newer rows),
+            # which is parsed again as JSON.
+            cursor.execute(f"""
+                WITH batch AS (
+                    SELECT id, (pickup_location_json #>> '{{}}')::jsonb AS pickup
+                    FROM {table}
+                    WHERE %s::uuid IS NULL OR id > %s::uuid
+                    ORDER BY id
+                    LIMIT %s
+                ), decoded AS (
+                    UPDATE {table} AS service
+                    SET pickup_location_id = NULLIF(batch.pickup ->> 'id', '')::uuid,
+                        pickup_latitude = (batch.pickup ->> 'latitude')::float,
+                        pickup_longitude = (batch.pickup ->> 'longitude')::float,
+                        pickup_address = coalesce(batch.pickup ->> 'address', '')
+                    FROM batch
+                    WHERE service.id = batch.id
+                )
+                SELECT id FROM batch ORDER BY id DESC LIMIT 1
+            """, [last_id, last_id, BATCH_SIZE])
+
+            row = cursor.fetchone()
+            if row is None:
+                return
+            last_id = row[0]
+
+
+def encode_pickup_locations(apps, schema_editor):
+    table = apps.get_model('services', 'ServiceRequest')._meta.db_table
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {table}
+            SET pickup_location_json = jsonb_build_object(
+                'id', pickup_location_id,
+                'address', pickup_address,
+                'latitude', pickup_latitude,
+                'longitude', pickup_longitude
+            )
+        """)
+
+
+class Migration(migrations.Migration):
+
+    # Every batch of the data migration is committed on its own, so only this
+    # step runs outside of a transaction.
+    atomic = False
+
+    dependencies = [
+        ('services', '0009_pickup_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(decode_pickup_locations, encode_pickup_locations),
+    ]
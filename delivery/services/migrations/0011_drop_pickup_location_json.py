@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0010_decode_pickup_locations'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='servicerequest',
+            name='pickup_location_json',
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['pickup_latitude', 'pickup_longitude'], name='servicerequest_pickup_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0011_drop_pickup_location_json'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyServiceStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('services', models.IntegerField(default=0)),
+                ('completed', models.IntegerField(default=0)),
+                ('distance_km', models.FloatField(default=0)),
+                ('eta_minutes', models.IntegerField(default=0)),
+                ('eta_services', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day'), name='unique_daily_stats_per_user')],
+            },
+        ),
+    ]
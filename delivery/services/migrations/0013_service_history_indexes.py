@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0012_daily_service_stats'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='servicerequest',
+            name='servicerequest_customer_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='servicerequest',
+            name='servicerequest_driver_idx',
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['customer', '-created_at', '-id'], include=('is_completed', 'pickup_address', 'distance_km', 'time_minutes', 'close_service_at', 'driver'), name='servicerequest_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['driver', '-created_at', '-id'], include=('is_completed', 'pickup_address', 'distance_km', 'time_minutes', 'close_service_at', 'customer'), name='servicerequest_driver_idx'),
+        ),
+    ]
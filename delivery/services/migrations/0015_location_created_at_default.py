@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:43
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('services', '0014_pickup_location_do_nothing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='location',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
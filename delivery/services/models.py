@@ -2,6 +2,7 @@ import uuid
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 class User(AbstractUser):
     """Custom user model with uuid management"""
@@ -10,26 +11,138 @@ class User(AbstractUser):
     is_driver = models.BooleanField(default=False)
     plate = models.CharField(max_length=8, blank=True, null=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta(AbstractUser.Meta):
+        swappable = 'AUTH_USER_MODEL'
+        indexes = [
+            # Keyset pagination of the driver list.
+            models.Index(
+                fields=['created_at', 'id'],
+                condition=models.Q(is_driver=True),
+                name='user_driver_created_id_idx'
+            ),
+        ]
     
 class Location(models.Model):
     """Model for storing location data"""
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Indexed by location_user_created_id_idx, which also serves the latest location.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     address = models.CharField(max_length=255)
     latitude = models.FloatField()
     longitude = models.FloatField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # A default instead of auto_now_add, so the batches buffered by the clients keep their time.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the location history of a user.
+            models.Index(fields=['user', 'created_at', 'id'], name='location_user_created_id_idx'),
+        ]
+
+# Columns of a service returned by its history, besides the customer and driver.
+HISTORY_COLUMNS = ['is_completed', 'pickup_address', 'distance_km', 'time_minutes', 'close_service_at']
 
 class ServiceRequest(models.Model):
     """Model for delivery requested by a customer"""
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    customer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='requests')
-    pickup_location = models.JSONField()
-    driver = models.ForeignKey(User, on_delete=models.CASCADE)
-    distance_km = models.FloatField()
-    time_minutes = models.IntegerField()
+    customer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='requests', db_index=False)
+    # Location of the customer when the service was requested. The primary key of the
+    # partitioned location table includes created_at, so the database cannot enforce the
+    # foreign key, and old partitions are dropped: the pickup point is copied in the service.
+    # The reference is left as is when the location is deleted, so locations keep being
+    # deleted in bulk instead of being loaded to clear it.
+    pickup_location = models.ForeignKey(
+        Location, on_delete=models.DO_NOTHING, blank=True, null=True, db_constraint=False, related_name='+'
+    )
+    pickup_latitude = models.FloatField(blank=True, null=True)
+    pickup_longitude = models.FloatField(blank=True, null=True)
+    pickup_address = models.CharField(max_length=255, blank=True, default='')
+    # Pending requests of the batch dispatch wait without a driver.
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True, db_index=False)
+    distance_km = models.FloatField(blank=True, null=True)
+    time_minutes = models.IntegerField(blank=True, null=True)
     is_completed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
-    close_service_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    close_service_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # A driver and a customer can only have one active service at a time.
+            models.UniqueConstraint(
+                fields=['driver'],
+                condition=models.Q(is_completed=False),
+                name='unique_active_service_per_driver'
+            ),
+            models.UniqueConstraint(
+                fields=['customer'],
+                condition=models.Q(is_completed=False),
+                name='unique_active_service_per_customer'
+            ),
+        ]
+        indexes = [
+            # The services of a customer or driver, newest first, for the keyset pagination
+            # of their history. They include the listed columns so the page is read with an
+            # index only scan. The active services are also found through the unique indexes above.
+            models.Index(
+                fields=['customer', '-created_at', '-id'],
+                include=HISTORY_COLUMNS + ['driver'],
+                name='servicerequest_customer_idx'
+            ),
+            models.Index(
+                fields=['driver', '-created_at', '-id'],
+                include=HISTORY_COLUMNS + ['customer'],
+                name='servicerequest_driver_idx'
+            ),
+            # Demand by area, bounding box of the pickup points.
+            models.Index(fields=['pickup_latitude', 'pickup_longitude'], name='servicerequest_pickup_idx'),
+            # Queue of requests waiting for the batch dispatch.
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(driver__isnull=True, is_completed=False),
+                name='servicerequest_pending_idx'
+            ),
+        ]
+
+class DriverState(models.Model):
+    """Current position and availability of a driver, one row per driver"""
+
+    driver = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='state')
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    last_seen = models.DateTimeField()
+    is_busy = models.BooleanField(default=False)
+    current_service = models.ForeignKey(
+        ServiceRequest, on_delete=models.SET_NULL, blank=True, null=True, related_name='+'
+    )
+
+    class Meta:
+        indexes = [
+            # Bounding box prefilter of the database driver search.
+            models.Index(
+                fields=['latitude', 'longitude'],
+                condition=models.Q(is_busy=False),
+                name='driverstate_idle_lat_lon_idx'
+            ),
+        ]
+
+class DailyServiceStats(models.Model):
+    """Services of a customer or driver in a day, added up as they are created and closed"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_stats', db_index=False)
+    day = models.DateField()
+    # Services requested by the customer or assigned to the driver, by day of creation.
+    services = models.IntegerField(default=0)
+    # Services closed, with their pickup distance and estimated time, by day of closing.
+    completed = models.IntegerField(default=0)
+    distance_km = models.FloatField(default=0)
+    eta_minutes = models.IntegerField(default=0)
+    eta_services = models.IntegerField(default=0)  # Closed services with an estimated time
+
+    class Meta:
+        constraints = [
+            # Target of the upserts of the counters, also serves the days of a user.
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_daily_stats_per_user'),
+        ]
@@ -0,0 +1,116 @@
+import base64
+import binascii
+import uuid
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination on (created_at, id), oldest first or, with newest_first, newest first.
+
+    Every page is read with an index range scan starting at the last row of
+    the previous page, so deep pages cost the same as the first one. The
+    body keeps being the plain list of results and the link to the next page
+    is sent in the ``Link`` header, with ``rel="next"``.
+    """
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def __init__(self, newest_first=False):
+        self.newest_first = newest_first
+        self.page_size = getattr(settings, 'LIST_PAGE_SIZE', 100)
+        self.next_cursor = None
+        self.is_first_page = True
+        self.request = None
+
+    def encode_cursor(self, row):
+        position = f'{row.created_at.isoformat()}|{row.id}'
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, request):
+        """Return the (created_at, id) position of the cursor, or None for the first page."""
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            created_at, row_id = base64.urlsafe_b64decode(encoded.encode()).decode().split('|')
+            position = (parse_datetime(created_at), uuid.UUID(row_id))
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if position[0] is None:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_page_queryset(self, queryset, request):
+        """Order the queryset by (created_at, id) and keep the rows after the cursor, plus one to detect a next page."""
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.is_first_page = request.query_params.get(self.cursor_query_param) is None
+        position = self.decode_cursor(request)
+
+        if self.newest_first:
+            queryset = queryset.order_by('-created_at', '-id')
+        else:
+            queryset = queryset.order_by('created_at', 'id')
+
+        if position is not None:
+            created_at, row_id = position
+            # The created_at__gte (or __lte) bound keeps the range scan on the index.
+            if self.newest_first:
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=row_id),
+                    created_at__lte=created_at
+                )
+            else:
+                queryset = queryset.filter(
+                    Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=row_id),
+                    created_at__gte=created_at
+                )
+        return queryset[:self.page_size + 1]
+
+    def get_page(self, rows):
+        if len(rows) > self.page_size:
+            rows = rows[:self.page_size]
+            self.next_cursor = self.encode_cursor(rows[-1])
+        return rows
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.get_page(list(self.get_page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """Async version of paginate_queryset."""
+        return self.get_page([row async for row in self.get_page_queryset(queryset, request)])
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data, status=None):
+        headers = {}
+        next_link = self.get_next_link()
+        if next_link is not None:
+            headers['Link'] = f'<{next_link}>; rel="next"'
+        return Response(data, status=status, headers=headers)
@@ -1,3 +1,6 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
 from .models import User, Location, ServiceRequest
 
@@ -49,6 +52,37 @@ class LocationSerializer(serializers.ModelSerializer):
         
         return Location.objects.filter(user=user)
 
+class LocationBatchItemSerializer(serializers.Serializer):
+    """Serializer for each location of a batch, the user is taken from the request
+
+    created_at is the time the client took the location, the time of the
+    request if it is not sent.
+    """
+
+    address = serializers.CharField(max_length=255)
+    latitude = serializers.FloatField()
+    longitude = serializers.FloatField()
+    created_at = serializers.DateTimeField(required=False)
+
+    def validate_created_at(self, value):
+        now = timezone.now()
+
+        if value > now + timedelta(seconds=settings.LOCATION_BATCH_MAX_CLOCK_SKEW_SECONDS):
+            raise serializers.ValidationError("created_at cannot be in the future.")
+        if value < now - timedelta(hours=settings.LOCATION_BATCH_MAX_AGE_HOURS):
+            raise serializers.ValidationError(
+                f"created_at cannot be older than {settings.LOCATION_BATCH_MAX_AGE_HOURS} hours."
+            )
+
+        return value
+
+class LocationFixSerializer(LocationBatchItemSerializer):
+    """Serializer for each position streamed by a driver, the address is optional"""
+
+    address = serializers.CharField(max_length=255, required=False, allow_blank=True, default='')
+    # Streamed positions are taken when they are saved.
+    created_at = None
+
 class ServiceRequestSerializer(serializers.ModelSerializer):
     """Serializer for service requests"""
 
@@ -57,9 +91,81 @@ class ServiceRequestSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ServiceRequest
-        fields = ('id', 'customer', 'pickup_location', 'driver', 'distance_km', 'time_minutes', 'is_completed', 'created_at', 'close_service_at')
-        read_only_fields = ('id', 'created_at')
+        fields = ('id', 'customer', 'pickup_location', 'pickup_latitude', 'pickup_longitude', 'pickup_address', 'driver', 'distance_km', 'time_minutes', 'is_completed', 'created_at', 'close_service_at')
+        # The pickup point is the latest location of the customer, set by the view.
+        read_only_fields = ('id', 'pickup_location', 'pickup_latitude', 'pickup_longitude', 'pickup_address', 'created_at')
 
     def create(self, validated_data):
         service = ServiceRequest.objects.create(**validated_data)
         return service
+
+class ServiceUserSerializer(serializers.ModelSerializer):
+    """Serializer for the customer or driver of a listed service"""
+
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'plate')
+
+class ServiceHistorySerializer(serializers.ModelSerializer):
+    """Serializer for the services of the history of a customer or driver"""
+
+    status = serializers.SerializerMethodField()
+    customer = ServiceUserSerializer(read_only=True)
+    driver = ServiceUserSerializer(read_only=True)
+
+    class Meta:
+        model = ServiceRequest
+        fields = ('id', 'status', 'customer', 'driver', 'pickup_address', 'distance_km', 'time_minutes', 'created_at', 'close_service_at')
+
+    def get_status(self, service):
+        if service.is_completed:
+            return 'completed'
+        return 'assigned' if service.driver_id else 'pending'
+
+    def to_representation(self, service):
+        data = super().to_representation(service)
+        # close_service_at is also set on creation, it only means something once the service is closed.
+        if not service.is_completed:
+            data['close_service_at'] = None
+        return data
+
+class ServiceHistoryQuerySerializer(serializers.Serializer):
+    """Serializer for the filters of the service history, the role of the user by default"""
+
+    role = serializers.ChoiceField(choices=['customer', 'driver'], required=False)
+    status = serializers.ChoiceField(choices=['pending', 'assigned', 'completed'], required=False)
+
+class NearbyDriversQuerySerializer(serializers.Serializer):
+    """Serializer for the query parameters of the nearby drivers search"""
+
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lon = serializers.FloatField(min_value=-180, max_value=180)
+    k = serializers.IntegerField(min_value=1, max_value=100, default=10)
+    radius_km = serializers.FloatField(min_value=0, required=False)
+
+class CloseServiceRequestSerializer(serializers.Serializer):
+    """Serializer for the optional service to close"""
+
+    id = serializers.UUIDField(required=False)
+
+class ServiceStatsQuerySerializer(serializers.Serializer):
+    """Serializer for the period of the daily service stats, the last STATS_DEFAULT_DAYS by default"""
+
+    to = serializers.DateField(required=False)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # "from" is a Python keyword, so it cannot be declared as an attribute.
+        fields['from'] = serializers.DateField(required=False)
+        return fields
+
+    def validate(self, data):
+        end = data.get('to') or timezone.localdate(timezone.now(), timezone.get_default_timezone())
+        start = data.get('from') or end - timedelta(days=settings.STATS_DEFAULT_DAYS - 1)
+
+        if start > end:
+            raise serializers.ValidationError("from cannot be later than to.")
+        if (end - start).days >= settings.STATS_MAX_DAYS:
+            raise serializers.ValidationError(f"The period can have at most {settings.STATS_MAX_DAYS} days.")
+
+        return {'from': start, 'to': end}
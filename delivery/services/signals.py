@@ -0,0 +1,64 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import User, Location, ServiceRequest, DriverState
+from .authentication import user_cache
+from .dispatch import dispatcher
+from .driver_index import driver_index
+from .utils import index_available_driver, record_driver_positions
+
+
+@receiver(post_save, sender=Location)
+def track_driver_location(sender, instance, created, **kwargs):
+    """Keep the current position of a driver when one of its locations is written."""
+
+    if not instance.user.is_driver:
+        return
+
+    if created:
+        record_driver_positions([instance])
+    # Editing an older location does not move the driver.
+    elif DriverState.objects.filter(
+        driver_id=instance.user_id, last_seen=instance.created_at
+    ).update(latitude=instance.latitude, longitude=instance.longitude):
+        if instance.user_id in driver_index:
+            driver_index.update(instance.user_id, instance.latitude, instance.longitude)
+        else:
+            index_available_driver(instance.user_id)
+
+
+@receiver(post_save, sender=ServiceRequest)
+def track_service_driver(sender, instance, **kwargs):
+    """Mark the driver busy while the service is active and free it once it is completed."""
+
+    # Pending requests of the batch dispatch have no driver yet.
+    if instance.driver_id is None:
+        return
+
+    if not instance.is_completed:
+        DriverState.objects.filter(driver_id=instance.driver_id).update(is_busy=True, current_service=instance)
+        driver_index.remove(instance.driver_id)
+        return
+
+    released = DriverState.objects.filter(
+        driver_id=instance.driver_id, current_service_id=instance.id
+    ).update(is_busy=False, current_service=None)
+
+    if released:
+        index_available_driver(instance.driver_id)
+        # The freed driver can take a request waiting in the queue.
+        dispatcher.schedule()
+
+
+@receiver(post_delete, sender=User)
+def unindex_deleted_driver(sender, instance, **kwargs):
+    """Forget drivers whose account was deleted."""
+
+    driver_index.remove(instance.id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Authenticate the next request of a changed or deleted user with its current data."""
+
+    user_cache.invalidate(instance.id)
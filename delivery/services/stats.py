@@ -0,0 +1,151 @@
+from collections import Counter
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import DailyServiceStats, ServiceRequest
+
+# Daily rollups of the services of each customer and driver. The counters are added
+# by upserts when a service is created, assigned and closed, so reading the stats of
+# a period costs one indexed row per day instead of grouping the service table.
+
+COUNTERS = ('services', 'completed', 'distance_km', 'eta_minutes', 'eta_services')
+
+
+def stats_day(value):
+    """Day of a datetime in the time zone of the settings, the one the rollups are kept in."""
+
+    return timezone.localdate(value, timezone.get_default_timezone())
+
+def upsert_sql(rows_sql):
+    """INSERT adding the (user_id, day, *COUNTERS) rows of a query to the rollup of each user and day.
+
+    Postgres rejects an upsert changing the same row twice, so the rows must
+    have distinct (user_id, day) pairs.
+    """
+
+    table = DailyServiceStats._meta.db_table
+    updates = ', '.join(f'{name} = {table}.{name} + EXCLUDED.{name}' for name in COUNTERS)
+    return (
+        f"INSERT INTO {table} (user_id, day, {', '.join(COUNTERS)}) {rows_sql} "
+        f"ON CONFLICT (user_id, day) DO UPDATE SET {updates}"
+    )
+
+def completed_rows_sql(source, day_sql):
+    """Rows counting the closed services of ``source`` for their customer and driver on ``day_sql``."""
+
+    return f"""
+        SELECT users.user_id, {day_sql}, 0, 1, coalesce(distance_km, 0), coalesce(time_minutes, 0),
+               (time_minutes IS NOT NULL)::int
+        FROM {source} CROSS JOIN LATERAL (VALUES (customer_id), (driver_id)) AS users (user_id)
+        WHERE users.user_id IS NOT NULL
+    """
+
+def add_services(keys):
+    """Count a service for each (user_id, day) pair, in a single upsert."""
+
+    counts = Counter(keys)
+    if not counts:
+        return
+
+    rows = ', '.join(['(%s, %s::date, %s, 0, 0, 0, 0)'] * len(counts))
+    params = [value for (user_id, day), count in counts.items() for value in (user_id, day, count)]
+
+    with connection.cursor() as cursor:
+        cursor.execute(upsert_sql(f'VALUES {rows}'), params)
+
+def record_service_created(service):
+    """Count a new service for its customer and, if it has one, its driver."""
+
+    day = stats_day(service.created_at)
+    add_services([(user_id, day) for user_id in (service.customer_id, service.driver_id) if user_id])
+
+def record_services_assigned(services):
+    """Count the services assigned by the dispatch of pending requests for their drivers."""
+
+    add_services([(service.driver_id, stats_day(service.created_at)) for service in services])
+
+def rebuild_daily_stats(start=None, end=None):
+    """Recompute the rollups of the days from ``start`` to ``end`` (every day by default) from the services.
+
+    The table is locked until the rollups are rebuilt, so the upserts of the
+    services created or closed meanwhile wait and are added on top of them.
+    Returns the number of rollups written.
+    """
+
+    table = DailyServiceStats._meta.db_table
+    tz = timezone.get_default_timezone()
+
+    # Services created or closed in the period, by their timestamps.
+    created_filter = closed_filter = day_filter = 'true'
+    params = {'time_zone': settings.TIME_ZONE}
+    if start is not None:
+        params['start'] = start
+        params['start_at'] = timezone.make_aware(datetime.combine(start, time.min), tz)
+        created_filter = 'created_at >= %(start_at)s'
+        closed_filter = 'close_service_at >= %(start_at)s'
+        day_filter = 'day >= %(start)s'
+    if end is not None:
+        params['end'] = end
+        params['end_at'] = timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz)
+        created_filter += ' AND created_at < %(end_at)s'
+        closed_filter += ' AND close_service_at < %(end_at)s'
+        day_filter += ' AND day <= %(end)s'
+
+    services = ServiceRequest._meta.db_table
+    sql = f"""
+        WITH created AS (
+            SELECT customer_id, driver_id, (created_at AT TIME ZONE %(time_zone)s)::date AS day
+            FROM {services} WHERE {created_filter}
+        ), closed AS (
+            SELECT customer_id, driver_id, distance_km, time_minutes,
+                   (close_service_at AT TIME ZONE %(time_zone)s)::date AS day
+            FROM {services} WHERE is_completed AND {closed_filter}
+        ), events (user_id, day, {', '.join(COUNTERS)}) AS (
+            SELECT users.user_id, day, 1, 0, 0::float, 0, 0
+            FROM created CROSS JOIN LATERAL (VALUES (customer_id), (driver_id)) AS users (user_id)
+            WHERE users.user_id IS NOT NULL
+            UNION ALL
+            {completed_rows_sql('closed', 'day')}
+        )
+        INSERT INTO {table} (user_id, day, {', '.join(COUNTERS)})
+        SELECT user_id, day, {', '.join(f'sum({name})' for name in COUNTERS)}
+        FROM events GROUP BY user_id, day
+    """
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+        cursor.execute(f'DELETE FROM {table} WHERE {day_filter}', params)
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+def daily_stats(user, start, end):
+    """Stats of each day from ``start`` to ``end`` of a customer or driver, and their totals."""
+
+    rollups = {
+        rollup['day']: rollup
+        for rollup in DailyServiceStats.objects
+        .filter(user=user, day__range=(start, end))
+        .values('day', *COUNTERS)
+    }
+    empty = dict.fromkeys(COUNTERS, 0)
+
+    days = []
+    totals = Counter()
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        counters = rollups.get(day, empty)
+        totals.update({name: counters[name] for name in COUNTERS})
+        days.append({'day': day, **stats_summary(counters)})
+
+    return {'days': days, 'totals': stats_summary(totals)}
+
+def stats_summary(counters):
+    average_eta = counters['eta_minutes'] / counters['eta_services'] if counters['eta_services'] else None
+
+    return {
+        'services': counters['services'],
+        'completed': counters['completed'],
+        'distance_km': round(counters['distance_km'], 2),
+        'average_eta_minutes': round(average_eta, 1) if average_eta is not None else None,
+    }
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from .authentication import CachedJWTAuthentication
+from .models import Location
+from .serializers import LocationFixSerializer
+from .utils import record_driver_positions
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close codes sent when the handshake is rejected, and to the drivers
+# whose fixes could not be saved.
+CLOSE_UNAUTHENTICATED = 4001
+CLOSE_FORBIDDEN = 4003
+CLOSE_SAVE_FAILED = 1011
+
+
+def save_locations(fixes):
+    locations = [Location(user_id=driver_id, **fix) for driver_id, fix in fixes.items()]
+
+    with transaction.atomic():
+        Location.objects.bulk_create(locations)
+        record_driver_positions(locations)
+
+def save_location_fixes(fixes):
+    """Persist the latest fix of each driver and make it its current position.
+
+    The fixes are saved in one transaction. If it fails, e.g. because a driver
+    was deleted meanwhile, they are saved again one driver at a time and the
+    ones failing again are dropped. Returns the ids of their drivers.
+    """
+
+    try:
+        save_locations(fixes)
+        return []
+    except DatabaseError:
+        logger.warning('Saving the fixes of %d drivers failed, saving them one by one', len(fixes), exc_info=True)
+
+    failed = []
+    for driver_id, fix in fixes.items():
+        try:
+            save_locations({driver_id: fix})
+        except DatabaseError:
+            logger.exception('Dropped the location fix of driver %s', driver_id)
+            failed.append(driver_id)
+    return failed
+
+
+class LocationCoalescer:
+    """Keeps only the latest fix of each driver and persists them once per interval.
+
+    The drivers whose fix could not be saved are added to ``rejected``.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.rejected = set()
+        self._pending = {}
+        self._task = None
+
+    def add(self, driver_id, fix):
+        """Replace the pending fix of the driver, scheduling a flush if none is waiting."""
+
+        self._pending[driver_id] = fix
+
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Saving the location fixes failed')
+
+    async def flush(self):
+        """Write the pending fixes in one transaction."""
+
+        pending, self._pending = self._pending, {}
+        if pending:
+            self.rejected.update(await sync_to_async(save_location_fixes)(pending))
+
+
+class DriverLocationStream:
+    """ASGI application receiving the position of a driver over a WebSocket.
+
+    The access token is read from the ``Authorization: Bearer`` header of the
+    handshake or from the ``token`` query parameter. Every text frame is a
+    JSON object with ``latitude``, ``longitude`` and an optional ``address``.
+    The socket of a driver whose fix could not be saved is closed on its next
+    frame.
+    """
+
+    def __init__(self, interval):
+        self.coalescer = LocationCoalescer(interval)
+        self.authentication = CachedJWTAuthentication()
+
+    def get_raw_token(self, scope):
+        for name, value in scope.get('headers', []):
+            if name == b'authorization':
+                return self.authentication.get_raw_token(value)
+
+        tokens = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        return tokens[0].encode() if tokens else None
+
+    async def authenticate(self, scope):
+        """Return the user of the access token, or None if it is missing or invalid."""
+
+        try:
+            raw_token = self.get_raw_token(scope)
+            if raw_token is None:
+                return None
+
+            validated_token = self.authentication.get_validated_token(raw_token)
+            return await sync_to_async(self.authentication.get_user)(validated_token)
+        except (AuthenticationFailed, InvalidToken, TokenError):
+            return None
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        user = await self.authenticate(scope)
+
+        if user is None:
+            await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHENTICATED})
+            return
+
+        if not user.is_driver:
+            await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+            return
+
+        await send({'type': 'websocket.accept'})
+        self.coalescer.rejected.discard(user.id)
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'websocket.disconnect':
+                return
+
+            if user.id in self.coalescer.rejected:
+                self.coalescer.rejected.discard(user.id)
+                await send({'type': 'websocket.close', 'code': CLOSE_SAVE_FAILED})
+                return
+
+            if message['type'] == 'websocket.receive':
+                errors = self.receive_fix(user, message.get('text'))
+                if errors:
+                    await send({'type': 'websocket.send', 'text': json.dumps({'errors': errors})})
+
+    def receive_fix(self, user, text):
+        """Validate a frame and queue it, returning its errors if it is invalid."""
+
+        try:
+            data = json.loads(text or '')
+        except ValueError:
+            return {'detail': 'Frames must be JSON objects.'}
+
+        if not isinstance(data, dict):
+            return {'detail': 'Frames must be JSON objects.'}
+
+        serializer = LocationFixSerializer(data=data)
+
+        if not serializer.is_valid():
+            return serializer.errors
+
+        self.coalescer.add(user.id, serializer.validated_data)
+        return None
+
+
+location_stream = DriverLocationStream(interval=getattr(settings, 'LOCATION_STREAM_FLUSH_SECONDS', 5))
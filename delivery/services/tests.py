@@ -1,11 +1,44 @@
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from concurrent.futures import ThreadPoolExecutor
+from delivery.asgi import application
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from datetime import timedelta
+from django.utils import timezone
+from io import StringIO
+from unittest import mock
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from django.contrib.auth import get_user_model
-from .models import Location, ServiceRequest
+from django.contrib.auth.hashers import check_password, make_password, verify_password
+from django.contrib.auth.signals import user_login_failed
+from .models import DailyServiceStats, DriverState, Location, ServiceRequest
+from .authentication import UserCache, user_cache
+from .dispatch import BackgroundDispatcher, dispatch_pending_requests, greedy_assignment, optimal_assignment
+from .driver_index import DriverIndex, driver_index
+from .eta import ConstantSpeedETAProvider, GridMatrixETAProvider, get_eta_provider
+from .management.commands.manage_location_partitions import Command as ManageLocationPartitions
+from .metrics import latest_metrics, service_state
+from .middleware import install_query_recorder, profiling_token
+from .pagination import KeysetPagination
+from .stats import stats_day
+from .streams import location_stream
+from .utils import aauthenticate_user, estimated_time, get_latest_user_location, haversine_distance, haversine_many, haversine_matrix, nearest_driver, nearest_drivers
 from rest_framework_simplejwt.tokens import RefreshToken
+from prometheus_client import REGISTRY
 import json
+import os
+import pstats
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 
 class UserRegistrationTestCase(TestCase):
     
@@ -346,6 +379,33 @@ class ServiceRequestTestCase(TestCase):
         self.assertEqual(response.data['driver']['username'], self.driver_second.username)
         self.assertIsNotNone(response.data['estimated_time_minutes'])
 
+    def test_pickup_location_is_saved(self):
+        """Check that the latest location of the customer is saved as the pickup point of the service."""
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token_customer)
+
+        self.client.post(self.url, {}, format='json')
+
+        service = ServiceRequest.objects.get(customer=self.customer)
+        self.assertEqual(service.pickup_location_id, self.customer_location.id)
+        self.assertEqual((service.pickup_latitude, service.pickup_longitude), (10.0, 10.0))
+        self.assertEqual(service.pickup_address, 'test Address')
+
+    def test_demand_by_area_uses_index(self):
+        """Check that the services picked up inside a bounding box are found through the pickup index."""
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token_customer)
+        self.client.post(self.url, {}, format='json')
+        services = ServiceRequest.objects.filter(
+            pickup_latitude__range=(9.9, 10.1), pickup_longitude__range=(9.9, 10.1)
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+        self.assertEqual(services.count(), 1)
+        self.assertIn('servicerequest_pickup_idx', services.explain())
+
     def test_driver_cannot_create_service_request(self):
         """Check that a driver cannot create a service request."""
 
@@ -380,7 +440,7 @@ class ServiceRequestTestCase(TestCase):
         self.assertIn('must have at least one location', str(response.data))
 
     def test_create_service_request_without_available_drivers(self):
-        """Check failure when no drivers are available."""
+        """Check that the request is queued as pending when no drivers are available."""
 
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token_customer)
 
@@ -389,8 +449,9 @@ class ServiceRequestTestCase(TestCase):
 
         response = self.client.post(self.url, {}, format='json')
 
-        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
-        self.assertIn('No available drivers', str(response.data))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertIsNone(ServiceRequest.objects.get(id=response.data['id']).driver)
 
 class CloseServiceRequestTest(TestCase):
 
@@ -433,12 +494,9 @@ class CloseServiceRequestTest(TestCase):
         self.service_request = ServiceRequest.objects.create(
             customer=self.customer,
             driver=self.driver,
-            pickup_location=json.dumps({
-                "id": "12345678-1234-5678-1234-123456789012",
-                "address":"Test Address",
-                "latitude":4.610819,
-                "longitude":-74.156850
-            }),
+            pickup_latitude=4.610819,
+            pickup_longitude=-74.156850,
+            pickup_address="Test Address",
             time_minutes=15,
             distance_km=10,
             is_completed=False
@@ -459,6 +517,22 @@ class CloseServiceRequestTest(TestCase):
         self.assertEqual(str(response.data['id']), str(self.service_request.id))
         self.assertEqual(response.data['close_service_at'], close_service_at.isoformat())
 
+    def test_close_service_request_after_role_change(self):
+        """Check that a customer who became a driver can still close the service they requested."""
+
+        get_user_model().objects.filter(id=self.customer.id).update(is_driver=True, plate='XYZ789')
+        self.customer.refresh_from_db()
+        self.client.force_authenticate(self.customer)
+
+        response = self.client.post(self.endservice_url, {}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(ServiceRequest.objects.get(id=self.service_request.id).is_completed)
+
+        # A retry of the close gets the same answer, as for any other user.
+        response = self.client.post(self.endservice_url, {'id': self.service_request.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
     def test_close_service_request_driver(self):
         """Check that the driver can close their active service request."""
 
@@ -488,6 +562,47 @@ class CloseServiceRequestTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertEqual(response.data['detail'], "No active service request found.")
 
+    def test_close_releases_driver_in_one_query(self):
+        """Check that the service is closed and its driver freed by a single statement."""
+
+        DriverState.objects.create(
+            driver=self.driver, latitude=4.61, longitude=-74.15, last_seen=timezone.now(),
+            is_busy=True, current_service=self.service_request
+        )
+        self.client.force_authenticate(self.customer)
+
+        with self.assertNumQueries(1):
+            response = self.client.post(self.endservice_url, {}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertFalse(state.is_busy)
+        self.assertIsNone(state.current_service_id)
+
+    def test_close_service_request_by_id(self):
+        """Check that closing a given service is idempotent and only closes services of the user."""
+
+        self.client.force_authenticate(self.driver)
+        other_customer = get_user_model().objects.create(username='customer2')
+
+        response = self.client.post(self.endservice_url, {'id': str(self.service_request.id)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        retry = self.client.post(self.endservice_url, {'id': str(self.service_request.id)}, format='json')
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data, response.data)
+
+        # Without an id only an active service can be closed.
+        response = self.client.post(self.endservice_url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.force_authenticate(other_customer)
+        response = self.client.post(self.endservice_url, {'id': str(self.service_request.id)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.post(self.endservice_url, {'id': 'invalid'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_close_service_request_not_authenticated(self):
         """Check that a non-authenticated user cannot close a service request."""
 
@@ -639,4 +754,2072 @@ class UserDetailTestCase(APITestCase):
         response = self.client.delete(self.user_detail_url)
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-        self.assertFalse(get_user_model().objects.filter(id=self.customer.id).exists())
\ No newline at end of file
+        self.assertFalse(get_user_model().objects.filter(id=self.customer.id).exists())
+
+class DriverIndexTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.random = random.Random(7)
+        self.index = DriverIndex(cell_degrees=0.01)
+        self.positions = [
+            (driver_id, self.random.uniform(4.5, 4.8), self.random.uniform(-74.2, -74.0))
+            for driver_id in range(500)
+        ]
+        self.index.load(self.positions)
+
+    def brute_force(self, latitude, longitude, k):
+        """Reference answer computed over every driver."""
+
+        return sorted(
+            (haversine_distance(latitude, longitude, lat, lon), driver_id)
+            for driver_id, lat, lon in self.positions
+        )[:k]
+
+    def test_rows_are_read_before_locking(self):
+        """Check that searches are not blocked while the rows of a load are read."""
+
+        searches = []
+
+        def positions():
+            # A search from another thread runs while the rows are being read.
+            thread = threading.Thread(target=lambda: searches.append(self.index.search(4.6, -74.1, k=1)))
+            thread.start()
+            thread.join(timeout=5)
+            yield (1000, 4.6, -74.1)
+
+        self.index.load(positions())
+
+        self.assertEqual(len(searches), 1)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.search(4.6, -74.1, k=1)[0][0][1], 1000)
+
+    def test_nearest_matches_brute_force(self):
+        """Check that the grid search returns the same drivers as a full scan."""
+
+        for _ in range(50):
+            latitude = self.random.uniform(4.4, 4.9)
+            longitude = self.random.uniform(-74.3, -73.9)
+
+            for k in (1, 5):
+                result = self.index.search(latitude, longitude, k=k)[0]
+                self.assertEqual(
+                    [driver_id for _, driver_id, _, _ in result],
+                    [driver_id for _, driver_id in self.brute_force(latitude, longitude, k)]
+                )
+
+    def test_nearest_far_away_pickup(self):
+        """Check that a pickup far from every driver still finds the nearest one."""
+
+        result = self.index.search(40.0, -3.0)[0]
+        self.assertEqual(result[0][1], self.brute_force(40.0, -3.0, 1)[0][1])
+
+    def test_nearest_with_radius(self):
+        """Check that drivers outside the radius are not returned."""
+
+        result = self.index.search(4.65, -74.1, k=500, radius_km=2)[0]
+        expected = [item for item in self.brute_force(4.65, -74.1, 500) if item[0] <= 2]
+        self.assertEqual([driver_id for _, driver_id, _, _ in result], [driver_id for _, driver_id in expected])
+
+    def test_update_and_remove(self):
+        """Check that moved and removed drivers are reflected in the queries."""
+
+        self.index.update(0, 10.0, 10.0)
+        nearest, _ = self.index.search(10.0, 10.0)
+        self.assertEqual(nearest[0][1], 0)
+
+        self.index.remove(0)
+        self.assertNotIn(0, self.index)
+        nearest, _ = self.index.search(10.0, 10.0)
+        self.assertNotEqual(nearest[0][1], 0)
+
+    def test_clear_marks_index_cold(self):
+        """Check that a cleared index must be reloaded."""
+
+        self.assertTrue(self.index.is_warm)
+        self.index.clear()
+        self.assertFalse(self.index.is_warm)
+        self.assertEqual(self.index.search(4.65, -74.1)[0], [])
+
+class NearestDriverIndexTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.customer = get_user_model().objects.create_user(username='customer1', password='password123')
+        self.driver_near = get_user_model().objects.create_user(username='driver1', password='password123', is_driver=True)
+        self.driver_far = get_user_model().objects.create_user(username='driver2', password='password123', is_driver=True)
+
+        Location.objects.create(user=self.customer, address='Customer Address', latitude=4.60, longitude=-74.08)
+        Location.objects.create(user=self.driver_near, address='Near Address', latitude=4.61, longitude=-74.08)
+        Location.objects.create(user=self.driver_far, address='Far Address', latitude=4.70, longitude=-74.08)
+
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.customer).access_token))
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def test_cold_index_is_loaded_from_database(self):
+        """Check that the first query warms the index with the available drivers."""
+
+        driver = nearest_driver(4.60, -74.08)
+
+        self.assertEqual(driver['user'], self.driver_near)
+        self.assertTrue(driver_index.is_warm)
+        self.assertIn(self.driver_far.id, driver_index)
+
+    def test_driver_location_updates_index(self):
+        """Check that a new driver location moves the driver inside the warm index."""
+
+        nearest_driver(4.60, -74.08)
+
+        Location.objects.create(user=self.driver_far, address='Moved Address', latitude=4.60, longitude=-74.081)
+
+        self.assertEqual(nearest_driver(4.60, -74.08)['user'], self.driver_far)
+
+    def test_assignment_and_close_update_index(self):
+        """Check that an assigned driver leaves the index and comes back once the service is closed."""
+
+        nearest_driver(4.60, -74.08)
+
+        response = self.client.post(reverse('delivery'), {}, format='json')
+        self.assertEqual(response.data['driver']['username'], self.driver_near.username)
+        self.assertNotIn(self.driver_near.id, driver_index)
+
+        response = self.client.post(reverse('endservice'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(self.driver_near.id, driver_index)
+
+    def test_stale_driver_is_discarded(self):
+        """Check that a driver assigned by another process is skipped and dropped from the index."""
+
+        nearest_driver(4.60, -74.08)
+
+        # A queryset update skips the model signals, as if another worker had assigned the driver.
+        DriverState.objects.filter(driver=self.driver_near).update(is_busy=True)
+
+        self.assertEqual(nearest_driver(4.60, -74.08)['user'], self.driver_far)
+        self.assertNotIn(self.driver_near.id, driver_index)
+
+    def test_driver_freed_by_another_process_is_found(self):
+        """Check that a search without candidates in the index is answered from the database."""
+
+        DriverState.objects.update(is_busy=True)
+        self.assertIsNone(nearest_driver(4.60, -74.08))
+        self.assertTrue(driver_index.is_warm)
+
+        # Freed by a queryset update, as if another worker had closed its service.
+        DriverState.objects.filter(driver=self.driver_far).update(is_busy=False)
+
+        self.assertEqual(nearest_driver(4.60, -74.08)['user'], self.driver_far)
+        self.assertIn(self.driver_far.id, driver_index)
+
+@override_settings(DRIVER_SEARCH_BACKEND='python')
+class VectorizedDistanceTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.random = random.Random(11)
+
+    def test_haversine_many_matches_scalar(self):
+        """Check that the vectorised distance matches the reference implementation."""
+
+        latitudes = [self.random.uniform(-89, 89) for _ in range(1000)]
+        longitudes = [self.random.uniform(-180, 180) for _ in range(1000)]
+
+        for lat, lon in [(4.6, -74.1), (0, 0), (-33.4, 151.2)]:
+            distances = haversine_many(lat, lon, latitudes, longitudes)
+            expected = [haversine_distance(lat, lon, lat2, lon2) for lat2, lon2 in zip(latitudes, longitudes)]
+
+            for distance, reference in zip(distances, expected):
+                self.assertAlmostEqual(distance, reference, places=6)
+
+    def test_nearest_drivers_matches_scalar(self):
+        """Check that the top-k drivers are the ones a full scalar scan would pick, in order."""
+
+        drivers = []
+        for i in range(30):
+            driver = get_user_model().objects.create(username=f'driver{i}', is_driver=True)
+            Location.objects.create(
+                user=driver,
+                address='Driver Address',
+                latitude=self.random.uniform(4.5, 4.8),
+                longitude=self.random.uniform(-74.2, -74.0)
+            )
+            drivers.append(driver)
+
+        # Only the latest location of each driver counts.
+        Location.objects.create(user=drivers[0], address='Moved Address', latitude=4.65, longitude=-74.1)
+
+        expected = sorted(
+            (haversine_distance(4.65, -74.1, location.latitude, location.longitude), location.user_id)
+            for location in (
+                Location.objects.filter(user=driver).order_by('-created_at').first()
+                for driver in drivers
+            )
+        )
+
+        result = nearest_drivers(4.65, -74.1, k=5)
+
+        self.assertEqual([driver['user_id'] for driver in result], [user_id for _, user_id in expected[:5]])
+        self.assertEqual(result[0]['user_id'], drivers[0].id)
+        for driver, (distance, _) in zip(result, expected):
+            self.assertAlmostEqual(driver['distance'], distance, places=6)
+
+    def test_nearest_drivers_k_larger_than_fleet(self):
+        """Check that asking for more drivers than available returns all of them."""
+
+        driver = get_user_model().objects.create(username='driver1', is_driver=True)
+        Location.objects.create(user=driver, address='Driver Address', latitude=4.6, longitude=-74.1)
+
+        self.assertEqual(len(nearest_drivers(4.65, -74.1, k=10)), 1)
+        self.assertEqual(nearest_drivers(4.65, -74.1, k=10)[0]['user_id'], driver.id)
+
+    def test_nearest_drivers_without_drivers(self):
+        """Check that an empty fleet returns no candidates."""
+
+        self.assertEqual(nearest_drivers(4.65, -74.1, k=3), [])
+
+class DriverSearchBackendsTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+        self.random = random.Random(3)
+        self.customer = get_user_model().objects.create(username='customer1')
+
+        # Drivers spread from a few hundred meters to a few hundred kilometers of the pickup.
+        for i in range(40):
+            driver = get_user_model().objects.create(username=f'driver{i}', is_driver=True)
+            spread = 10 ** self.random.uniform(-2.5, 0.5)
+            for _ in range(2):
+                Location.objects.create(
+                    user=driver,
+                    address='Driver Address',
+                    latitude=4.65 + self.random.uniform(-spread, spread),
+                    longitude=-74.1 + self.random.uniform(-spread, spread)
+                )
+
+        # A busy driver right at the pickup point.
+        busy_driver = get_user_model().objects.create(username='busy', is_driver=True)
+        Location.objects.create(user=busy_driver, address='Busy Address', latitude=4.65, longitude=-74.1)
+        ServiceRequest.objects.create(
+            customer=self.customer, driver=busy_driver, distance_km=0, time_minutes=1
+        )
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def search(self, backend, k):
+        with self.settings(DRIVER_SEARCH_BACKEND=backend):
+            return nearest_drivers(4.65, -74.1, k=k)
+
+    def test_backends_return_the_same_drivers(self):
+        """Check that the index and database backends match the Python scan."""
+
+        for k in (1, 3, 10, 40, 50):
+            expected = self.search('python', k)
+
+            for backend in ('index', 'database'):
+                result = self.search(backend, k)
+                self.assertEqual([driver['user_id'] for driver in result], [driver['user_id'] for driver in expected])
+                for driver, reference in zip(result, expected):
+                    self.assertAlmostEqual(driver['distance'], reference['distance'], places=6)
+
+    def test_backends_limit_the_radius(self):
+        """Check that every backend only returns the drivers within the radius."""
+
+        for radius_km in (0.5, 5, 50, 500):
+            with self.settings(DRIVER_SEARCH_BACKEND='python'):
+                expected = nearest_drivers(4.65, -74.1, k=20, radius_km=radius_km)
+            self.assertTrue(all(driver['distance'] <= radius_km for driver in expected))
+
+            for backend in ('index', 'database'):
+                with self.settings(DRIVER_SEARCH_BACKEND=backend):
+                    result = nearest_drivers(4.65, -74.1, k=20, radius_km=radius_km)
+                self.assertEqual([driver['user_id'] for driver in result], [driver['user_id'] for driver in expected])
+
+    @override_settings(DRIVER_SEARCH_BACKEND='database')
+    def test_database_backend_returns_only_k_rows(self):
+        """Check that the database backend only fetches the winning rows."""
+
+        with self.assertNumQueries(1):
+            result = nearest_drivers(4.65, -74.1, k=1)
+
+        self.assertEqual(len(result), 1)
+
+@override_settings(DISPATCH_IN_BACKGROUND=False)
+class ConcurrentDispatchTestCase(TransactionTestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.drivers = []
+        for i in range(5):
+            driver = get_user_model().objects.create(username=f'driver{i}', is_driver=True)
+            Location.objects.create(user=driver, address='Driver Address', latitude=4.6 + i * 0.01, longitude=-74.1)
+            self.drivers.append(driver)
+
+        self.customers = []
+        for i in range(200):
+            customer = get_user_model().objects.create(username=f'customer{i}')
+            Location.objects.create(user=customer, address='Customer Address', latitude=4.6, longitude=-74.1 + i * 0.0001)
+            self.customers.append(customer)
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def dispatch(self, customer):
+        """Request a service as the customer from a worker thread."""
+
+        try:
+            client = APIClient()
+            client.force_authenticate(user=customer)
+            return client.post(reverse('delivery'), {}, format='json').status_code
+        finally:
+            connection.close()
+
+    def test_parallel_dispatches_never_share_a_driver(self):
+        """Check that hundreds of parallel requests assign each driver at most once."""
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            status_codes = list(executor.map(self.dispatch, self.customers))
+
+        self.assertEqual(status_codes.count(status.HTTP_201_CREATED), len(self.drivers))
+        self.assertEqual(status_codes.count(status.HTTP_202_ACCEPTED), len(self.customers) - len(self.drivers))
+
+        active_drivers = list(
+            ServiceRequest.objects.filter(is_completed=False, driver__isnull=False).values_list('driver_id', flat=True)
+        )
+        self.assertEqual(sorted(active_drivers), sorted(driver.id for driver in self.drivers))
+
+    def test_parallel_dispatches_of_one_customer(self):
+        """Check that a customer firing parallel requests only gets one active service."""
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            status_codes = list(executor.map(self.dispatch, [self.customers[0]] * 5))
+
+        self.assertEqual(status_codes.count(status.HTTP_201_CREATED), 1)
+        self.assertEqual(status_codes.count(status.HTTP_400_BAD_REQUEST), 4)
+        self.assertEqual(ServiceRequest.objects.filter(customer=self.customers[0], is_completed=False).count(), 1)
+
+class DriverStateTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.driver = get_user_model().objects.create(username='driver1', is_driver=True)
+        Location.objects.create(user=self.customer, address='Customer Address', latitude=4.60, longitude=-74.08)
+
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.driver).access_token))
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def test_location_updates_driver_state(self):
+        """Check that a new driver location becomes its current position."""
+
+        response = self.client.post(reverse('locations'), {'address': 'First', 'latitude': 4.61, 'longitude': -74.08}, format='json')
+        first_id = response.data['id']
+        self.client.post(reverse('locations'), {'address': 'Second', 'latitude': 4.62, 'longitude': -74.09}, format='json')
+
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertEqual((state.latitude, state.longitude), (4.62, -74.09))
+        self.assertFalse(state.is_busy)
+
+        # Editing an older location does not move the driver.
+        self.client.patch(reverse('location_detail', args=[first_id]), {'latitude': 1.0}, format='json')
+        state.refresh_from_db()
+        self.assertEqual(state.latitude, 4.62)
+
+    def test_deleting_current_location_restores_previous(self):
+        """Check that the driver goes back to its previous location when the current one is deleted."""
+
+        Location.objects.create(user=self.driver, address='First', latitude=4.61, longitude=-74.08)
+        second = Location.objects.create(user=self.driver, address='Second', latitude=4.62, longitude=-74.09)
+
+        self.client.delete(reverse('location_detail', args=[second.id]))
+
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertEqual((state.latitude, state.longitude), (4.61, -74.08))
+
+    def test_deleting_driver_deletes_locations_in_bulk(self):
+        """Check that deleting a driver takes the same queries whatever the size of its location history."""
+
+        now = timezone.now()
+        Location.objects.bulk_create([
+            Location(user=self.driver, address='Street', latitude=4.6, longitude=-74.1, created_at=now - timedelta(minutes=i))
+            for i in range(300)
+        ])
+        Location.objects.create(user=self.driver, address='Current', latitude=4.61, longitude=-74.08)
+        driver_index.update(self.driver.id, 4.61, -74.08)
+        self.client.force_authenticate(self.driver)
+
+        # Lookup of its services, then one DELETE per related table and the user.
+        with self.assertNumQueries(9):
+            response = self.client.delete(reverse('userdetail'))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Location.objects.filter(user_id=self.driver.id).exists())
+        self.assertFalse(DriverState.objects.filter(driver_id=self.driver.id).exists())
+        self.assertNotIn(self.driver.id, driver_index)
+
+    def test_dispatch_and_close_update_driver_state(self):
+        """Check that the driver is busy while assigned and free once the service is closed."""
+
+        Location.objects.create(user=self.driver, address='Driver Address', latitude=4.61, longitude=-74.08)
+
+        customer_client = APIClient()
+        customer_client.force_authenticate(user=self.customer)
+
+        customer_client.post(reverse('delivery'), {}, format='json')
+        service = ServiceRequest.objects.get(customer=self.customer)
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertTrue(state.is_busy)
+        self.assertEqual(state.current_service_id, service.id)
+
+        customer_client.post(reverse('endservice'), {}, format='json')
+        state.refresh_from_db()
+        self.assertFalse(state.is_busy)
+        self.assertIsNone(state.current_service_id)
+
+    def test_backfill_command(self):
+        """Check that the backfill command rebuilds the state from the existing data."""
+
+        Location.objects.create(user=self.driver, address='First', latitude=4.61, longitude=-74.08)
+        Location.objects.create(user=self.driver, address='Second', latitude=4.62, longitude=-74.09)
+        service = ServiceRequest.objects.create(
+            customer=self.customer, driver=self.driver, distance_km=1, time_minutes=2
+        )
+        DriverState.objects.all().delete()
+
+        out = StringIO()
+        call_command('backfill_driver_state', batch_size=1, stdout=out)
+
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertEqual((state.latitude, state.longitude), (4.62, -74.09))
+        self.assertTrue(state.is_busy)
+        self.assertEqual(state.current_service_id, service.id)
+        self.assertIn('1 driver states rebuilt', out.getvalue())
+
+class LocationPartitionTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.user = get_user_model().objects.create(username='customer1')
+
+    def partition_of(self, location):
+        """Name of the partition storing the location."""
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text FROM services_location WHERE id = %s', [location.id])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def create_location(self, days_ago, address='Address'):
+        location = Location.objects.create(user=self.user, address=address, latitude=4.6, longitude=-74.1)
+        Location.objects.filter(id=location.id).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return location
+
+    def test_location_table_is_partitioned(self):
+        """Check that the location history is range partitioned by creation date."""
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'services_location'::regclass")
+            self.assertIsNotNone(cursor.fetchone())
+
+        location = self.create_location(0)
+        self.assertEqual(self.partition_of(location), 'services_location_default')
+
+    def test_partitions_are_created_and_rows_moved(self):
+        """Check that the command creates the current partition and moves its rows out of the default one."""
+
+        location = self.create_location(0)
+
+        out = StringIO()
+        call_command('manage_location_partitions', ahead=2, stdout=out)
+
+        self.assertIn('3 partitions created', out.getvalue())
+        self.assertRegex(self.partition_of(location), r'^services_location_p\d{8}$')
+
+        # New locations go to the dated partitions.
+        self.assertNotEqual(self.partition_of(self.create_location(0)), 'services_location_default')
+
+    def test_partitions_are_read_on_the_next_run(self):
+        """Check that a second run reads the bounds of the partitions created by the first one."""
+
+        call_command('manage_location_partitions', ahead=2, stdout=StringIO())
+
+        out = StringIO()
+        call_command('manage_location_partitions', ahead=3, stdout=out)
+        self.assertIn('1 partitions created, 0 partitions removed', out.getvalue())
+
+        command = ManageLocationPartitions()
+        partitions = command.get_partitions()
+        self.assertEqual(len(partitions), 4)
+        for name, (lower, upper) in partitions.items():
+            self.assertEqual(name, f'services_location_p{lower:%Y%m%d}')
+            self.assertEqual(upper - lower, timedelta(days=settings.LOCATION_PARTITION_DAYS))
+            self.assertEqual(lower.utcoffset(), timedelta(0))
+
+    def test_old_partitions_and_rows_are_removed(self):
+        """Check that the locations older than the retention window are removed."""
+
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() - timedelta(days=200)):
+            call_command('manage_location_partitions', ahead=0, stdout=StringIO())
+
+        old_partitioned = self.create_location(200)
+        old_default = self.create_location(150)
+        recent = self.create_location(1)
+
+        # Run the deferred foreign key checks, as a committed transaction would, so the partition can be dropped.
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+        out = StringIO()
+        call_command('manage_location_partitions', ahead=0, retention_days=90, stdout=out)
+
+        self.assertIn('1 partitions removed and 1 old locations deleted', out.getvalue())
+        self.assertIsNone(self.partition_of(old_partitioned))
+        self.assertIsNone(self.partition_of(old_default))
+        self.assertIsNotNone(self.partition_of(recent))
+
+    def test_latest_location_falls_back_to_old_history(self):
+        """Check that a user without recent locations still gets its latest one."""
+
+        self.create_location(30, address='Older')
+        self.create_location(20, address='Old')
+
+        self.assertEqual(get_latest_user_location(self.user).address, 'Old')
+
+        self.create_location(0, address='Recent')
+        self.assertEqual(get_latest_user_location(self.user).address, 'Recent')
+
+class LocationBatchTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.driver = get_user_model().objects.create(username='driver1', is_driver=True)
+        self.url = reverse('location_batch')
+
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.driver).access_token))
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def test_batch_creates_locations(self):
+        """Check that a batch is saved in bulk and only the newest point moves the driver."""
+
+        locations = [
+            {'address': f'Point {i}', 'latitude': 4.6 + i * 0.001, 'longitude': -74.1}
+            for i in range(500)
+        ]
+
+        # User lookup, then savepoint, bulk insert, driver state upsert and savepoint release.
+        with self.assertNumQueries(5):
+            response = self.client.post(self.url, {'locations': locations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 500)
+        self.assertEqual(response.data['errors'], [])
+        self.assertEqual(Location.objects.filter(user=self.driver).count(), 500)
+
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertAlmostEqual(state.latitude, 4.6 + 499 * 0.001)
+
+    def test_batch_reports_item_errors(self):
+        """Check that invalid points are reported by position while the valid ones are saved."""
+
+        locations = [
+            {'address': 'Valid', 'latitude': 4.6, 'longitude': -74.1},
+            {'address': 'Invalid', 'latitude': 'north', 'longitude': -74.1},
+            {'latitude': 4.6, 'longitude': -74.1},
+        ]
+
+        response = self.client.post(self.url, {'locations': locations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertIn('latitude', response.data['errors'][0]['errors'])
+        self.assertIn('address', response.data['errors'][1]['errors'])
+
+    def test_batch_keeps_client_timestamps(self):
+        """Check that the time sent with each point is stored and the newest point moves the driver."""
+
+        now = timezone.now()
+        locations = [
+            {'address': 'Newest', 'latitude': 4.62, 'longitude': -74.1, 'created_at': (now - timedelta(minutes=1)).isoformat()},
+            {'address': 'Oldest', 'latitude': 4.6, 'longitude': -74.1, 'created_at': (now - timedelta(hours=3)).isoformat()},
+            {'address': 'Middle', 'latitude': 4.61, 'longitude': -74.1, 'created_at': (now - timedelta(hours=2)).isoformat()},
+        ]
+
+        response = self.client.post(self.url, {'locations': locations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            list(Location.objects.filter(user=self.driver).order_by('created_at').values_list('address', flat=True)),
+            ['Oldest', 'Middle', 'Newest']
+        )
+        oldest = Location.objects.get(user=self.driver, address='Oldest')
+        self.assertAlmostEqual((now - oldest.created_at).total_seconds(), 3 * 3600, delta=1)
+
+        state = DriverState.objects.get(driver=self.driver)
+        self.assertAlmostEqual(state.latitude, 4.62)
+
+        # A batch older than the current position is saved without moving the driver back.
+        response = self.client.post(self.url, {'locations': [
+            {'address': 'Late', 'latitude': 4.7, 'longitude': -74.1, 'created_at': (now - timedelta(hours=1)).isoformat()}
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertAlmostEqual(DriverState.objects.get(driver=self.driver).latitude, 4.62)
+
+    @override_settings(LOCATION_BATCH_MAX_AGE_HOURS=24, LOCATION_BATCH_MAX_CLOCK_SKEW_SECONDS=60)
+    def test_batch_rejects_timestamps_out_of_window(self):
+        """Check that points from the future or older than the accepted window are reported."""
+
+        now = timezone.now()
+        locations = [
+            {'address': 'Valid', 'latitude': 4.6, 'longitude': -74.1, 'created_at': (now - timedelta(hours=23)).isoformat()},
+            {'address': 'Future', 'latitude': 4.6, 'longitude': -74.1, 'created_at': (now + timedelta(minutes=5)).isoformat()},
+            {'address': 'Old', 'latitude': 4.6, 'longitude': -74.1, 'created_at': (now - timedelta(hours=25)).isoformat()},
+            {'address': 'Invalid', 'latitude': 4.6, 'longitude': -74.1, 'created_at': 'yesterday'},
+        ]
+
+        response = self.client.post(self.url, {'locations': locations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2, 3])
+        for error in response.data['errors']:
+            self.assertIn('created_at', error['errors'])
+
+    def test_batch_without_valid_locations(self):
+        """Check that a batch without valid points is rejected."""
+
+        response = self.client.post(self.url, {'locations': [{'address': 'Invalid'}]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Location.objects.exists())
+
+    @override_settings(LOCATION_BATCH_MAX_SIZE=2)
+    def test_batch_too_large(self):
+        """Check that batches over the maximum size are rejected."""
+
+        locations = [{'address': 'Point', 'latitude': 4.6, 'longitude': -74.1}] * 3
+
+        response = self.client.post(self.url, {'locations': locations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('at most 2 locations', response.data['detail'])
+
+class DriverLocationStreamTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.driver = get_user_model().objects.create(username='driver1', is_driver=True)
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.path = '/api/ws/locations/'
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def connect(self, user=None, query_string=b''):
+        """Open a WebSocket to the stream, authenticated with the user access token."""
+
+        headers = []
+        if user is not None:
+            token = str(RefreshToken.for_user(user).access_token)
+            headers.append((b'authorization', f'Bearer {token}'.encode()))
+
+        communicator = ApplicationCommunicator(application, {
+            'type': 'websocket',
+            'path': self.path,
+            'headers': headers,
+            'query_string': query_string,
+        })
+        return communicator
+
+    def check_constraints_immediately(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    async def test_fixes_are_coalesced(self):
+        """Check that only the latest fix of each interval is saved as the driver position."""
+
+        communicator = self.connect(self.driver)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.accept')
+
+        for i in range(10):
+            await communicator.send_input({
+                'type': 'websocket.receive',
+                'text': json.dumps({'latitude': 4.6 + i * 0.001, 'longitude': -74.1})
+            })
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+        await location_stream.coalescer.flush()
+
+        count = await Location.objects.filter(user=self.driver).acount()
+        state = await DriverState.objects.aget(driver=self.driver)
+
+        self.assertEqual(count, 1)
+        self.assertAlmostEqual(state.latitude, 4.609)
+
+    async def test_failed_fix_is_dropped(self):
+        """Check that a fix failing to save is dropped, its socket closed, and the other fixes saved."""
+
+        other = await get_user_model().objects.acreate(username='driver2', is_driver=True)
+
+        communicator = self.connect(self.driver)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.accept')
+
+        await communicator.send_input({
+            'type': 'websocket.receive', 'text': json.dumps({'latitude': 4.6, 'longitude': -74.1})
+        })
+        await communicator.receive_nothing()
+        location_stream.coalescer.add(other.id, {'address': '', 'latitude': 4.7, 'longitude': -74.1})
+
+        # The driver is deleted before its fix is saved. The foreign keys are checked on each
+        # statement, as they would be on the commit of the transaction outside the tests.
+        driver_id = self.driver.id
+        await self.driver.adelete()
+        await sync_to_async(self.check_constraints_immediately)()
+
+        with self.assertLogs('services.streams', 'WARNING') as logs:
+            await location_stream.coalescer.flush()
+
+        self.assertIn(f'Dropped the location fix of driver {driver_id}', '\n'.join(logs.output))
+        self.assertFalse(await Location.objects.filter(user_id=driver_id).aexists())
+        self.assertEqual(await Location.objects.filter(user=other).acount(), 1)
+        self.assertAlmostEqual((await DriverState.objects.aget(driver=other)).latitude, 4.7)
+
+        await communicator.send_input({
+            'type': 'websocket.receive', 'text': json.dumps({'latitude': 4.61, 'longitude': -74.1})
+        })
+        message = await communicator.receive_output()
+        self.assertEqual(message, {'type': 'websocket.close', 'code': 1011})
+        self.assertEqual(location_stream.coalescer.rejected, set())
+
+    async def test_invalid_frame_returns_errors(self):
+        """Check that an invalid frame is answered with its errors and not saved."""
+
+        communicator = self.connect(self.driver)
+        await communicator.send_input({'type': 'websocket.connect'})
+        await communicator.receive_output()
+
+        await communicator.send_input({'type': 'websocket.receive', 'text': json.dumps({'latitude': 'north'})})
+        response = json.loads((await communicator.receive_output())['text'])
+
+        self.assertIn('latitude', response['errors'])
+        self.assertIn('longitude', response['errors'])
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+    async def test_token_in_query_string(self):
+        """Check that the access token can be sent as a query parameter."""
+
+        token = str(RefreshToken.for_user(self.driver).access_token)
+        communicator = self.connect(query_string=f'token={token}'.encode())
+        await communicator.send_input({'type': 'websocket.connect'})
+
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.accept')
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+    async def test_handshake_is_rejected(self):
+        """Check that connections without a valid token or from customers are closed."""
+
+        for communicator, code in [
+            (self.connect(), 4001),
+            (self.connect(query_string=b'token=invalid'), 4001),
+            (self.connect(self.customer), 4003),
+        ]:
+            await communicator.send_input({'type': 'websocket.connect'})
+            message = await communicator.receive_output()
+
+            self.assertEqual(message['type'], 'websocket.close')
+            self.assertEqual(message['code'], code)
+
+
+class AsyncAuthenticationTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.user = get_user_model().objects.create_user(username='customer1', password='password123')
+
+    async def test_valid_credentials(self):
+        """Check that the user is returned for valid credentials."""
+
+        user = await aauthenticate_user('customer1', 'password123')
+
+        self.assertEqual(user, self.user)
+
+    async def test_invalid_credentials(self):
+        """Check that wrong passwords, unknown users and inactive users are rejected."""
+
+        await get_user_model().objects.filter(pk=self.user.pk).aupdate(is_active=True)
+        self.assertIsNone(await aauthenticate_user('customer1', 'wrongpassword'))
+        self.assertIsNone(await aauthenticate_user('nobody', 'password123'))
+
+        await get_user_model().objects.filter(pk=self.user.pk).aupdate(is_active=False)
+        self.assertIsNone(await aauthenticate_user('customer1', 'password123'))
+
+    async def test_password_is_hashed_in_executor(self):
+        """Check that the password hash runs outside the event loop thread."""
+
+        threads = []
+
+        def recording_verify_password(*args):
+            threads.append(threading.current_thread().name)
+            return verify_password(*args)
+
+        with mock.patch('services.authentication.verify_password', recording_verify_password):
+            await aauthenticate_user('customer1', 'password123')
+
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('password-hashing'))
+
+    async def test_failed_login_signal(self):
+        """Check that user_login_failed is sent for wrong credentials."""
+
+        handler = mock.Mock()
+        user_login_failed.connect(handler)
+        try:
+            self.assertIsNone(await aauthenticate_user('customer1', 'wrongpassword'))
+        finally:
+            user_login_failed.disconnect(handler)
+
+        handler.assert_called_once()
+        self.assertEqual(handler.call_args.kwargs['credentials']['username'], 'customer1')
+
+    async def test_password_hash_is_upgraded(self):
+        """Check that a password hashed by an older hasher is hashed again by the preferred one."""
+
+        await get_user_model().objects.filter(pk=self.user.pk).aupdate(
+            password=make_password('password123', hasher='pbkdf2_sha1')
+        )
+
+        self.assertEqual(await aauthenticate_user('customer1', 'password123'), self.user)
+
+        password = (await get_user_model().objects.aget(pk=self.user.pk)).password
+        self.assertTrue(password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(check_password('password123', password))
+
+
+class KeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.client = APIClient()
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.drivers = [
+            get_user_model().objects.create(username=f'driver{i}', is_driver=True, plate=f'ABC{i:03d}')
+            for i in range(5)
+        ]
+        self.client.force_authenticate(self.customer)
+
+    def get_all_pages(self, url):
+        """Follow the next links from the url, returning the pages."""
+
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data)
+            link = response.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        return pages
+
+    def test_drivers_are_paginated(self):
+        """Check that every driver is listed once, oldest first, across the pages."""
+
+        pages = self.get_all_pages(reverse('drivers') + '?page_size=2')
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(
+            [driver['username'] for page in pages for driver in page],
+            [driver.username for driver in self.drivers]
+        )
+
+    def test_rows_with_same_created_at(self):
+        """Check that rows created in the same instant are neither repeated nor skipped."""
+
+        Location.objects.bulk_create([
+            Location(user=self.customer, address=f'Address {i}', latitude=4.6, longitude=-74.1)
+            for i in range(7)
+        ])
+        Location.objects.filter(user=self.customer).update(created_at=timezone.now())
+
+        pages = self.get_all_pages(reverse('locations') + '?page_size=3')
+        ids = [location['id'] for page in pages for location in page]
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(len(set(ids)), 7)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_default_page_size(self):
+        """Check that the page size defaults to the setting."""
+
+        with self.settings(LIST_PAGE_SIZE=3):
+            response = self.client.get(reverse('drivers'))
+
+        self.assertEqual(len(response.data), 3)
+        self.assertIn('rel="next"', response.headers['Link'])
+
+    def test_invalid_cursor(self):
+        """Check that a malformed cursor returns 404."""
+
+        response = self.client.get(reverse('drivers') + '?cursor=invalid')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_location_page_uses_index(self):
+        """Check that a deep page of locations is read from the composite index."""
+
+        location = Location.objects.create(user=self.customer, address='Address', latitude=4.6, longitude=-74.1)
+        queryset = Location.objects.filter(user=self.customer)
+        request = mock.Mock(query_params={'cursor': KeysetPagination().encode_cursor(location)})
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = KeysetPagination().get_page_queryset(queryset, request).explain()
+
+        # Partitions name their copy of the index after its columns.
+        self.assertIn('user_id_created_at_id_idx', plan)
+        self.assertNotIn('Sort', plan)
+
+
+class CachedJWTAuthenticationTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        user_cache.clear()
+
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(username='customer1', password='password123')
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        self.url = reverse('userdetail')
+
+    def tearDown(self):
+        user_cache.clear()
+
+    def test_cached_user_saves_query(self):
+        """Check that only the first request of a token reads the user from the database."""
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['username'], 'customer1')
+
+    def test_user_detail_changes_invalidate_cache(self):
+        """Check that the next request after updating the user sees the new data."""
+
+        self.client.get(self.url)
+        self.client.patch(self.url, {'plate': 'XYZ123'}, format='json')
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['plate'], 'XYZ123')
+
+    def test_deleted_user_is_rejected(self):
+        """Check that the token of a deleted user stops authenticating."""
+
+        self.client.get(self.url)
+        self.client.delete(self.url)
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cache_is_bounded(self):
+        """Check that the least recently used users are evicted and expired users are missed."""
+
+        cache = UserCache(max_size=2, ttl_seconds=30)
+        users = [get_user_model()(username=f'user{i}') for i in range(3)]
+        for user in users:
+            cache.set(user.id, user)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(users[0].id))
+        self.assertEqual(cache.get(users[2].id).username, 'user2')
+
+        cache.ttl_seconds = 0
+        cache.set(users[0].id, users[0])
+        self.assertIsNone(cache.get(users[0].id))
+
+    @override_settings(CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_backend(self):
+        """Check that users cached by another process are read from the shared backend."""
+
+        writer = UserCache(backend='shared')
+        reader = UserCache(backend='shared')
+        writer.set(self.user.id, self.user)
+
+        self.assertEqual(reader.get(self.user.id), self.user)
+
+        writer.invalidate(self.user.id)
+        self.assertIsNone(UserCache(backend='shared').get(self.user.id))
+
+
+class BatchDispatchTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        # Drivers and pickups on the equator, where the per request dispatch gives
+        # the first request the driver that the second one needs.
+        self.drivers = []
+        for i, longitude in enumerate([0.0, 0.02]):
+            driver = get_user_model().objects.create(username=f'driver{i}', is_driver=True)
+            Location.objects.create(user=driver, address='Street', latitude=0.0, longitude=longitude)
+            self.drivers.append(driver)
+
+        self.customers = [
+            get_user_model().objects.create(username=f'customer{i}') for i in range(3)
+        ]
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def create_pending_request(self, customer, longitude):
+        """Service request of the customer without driver, picked up on the equator."""
+
+        return ServiceRequest.objects.create(
+            customer=customer,
+            pickup_latitude=0.0, pickup_longitude=longitude, pickup_address='Street'
+        )
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_request_is_queued(self):
+        """Check that in batch mode the service request is saved pending, without driver."""
+
+        Location.objects.create(user=self.customers[0], address='Street', latitude=0.0, longitude=0.01)
+        client = APIClient()
+        client.force_authenticate(self.customers[0])
+
+        response = client.post(reverse('delivery'))
+        duplicated = client.post(reverse('delivery'))
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertIsNone(ServiceRequest.objects.get(id=response.data['id']).driver)
+        self.assertEqual(duplicated.data['id'], response.data['id'])
+
+    def test_batch_minimises_total_distance(self):
+        """Check that the batch assignment beats the greedy one and marks the drivers busy."""
+
+        first = self.create_pending_request(self.customers[0], 0.011)
+        second = self.create_pending_request(self.customers[1], 0.03)
+
+        stats = dispatch_pending_requests()
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+
+        self.assertEqual(stats['assigned'], 2)
+        self.assertEqual(first.driver, self.drivers[0])
+        self.assertEqual(second.driver, self.drivers[1])
+        self.assertGreater(stats['saved_km'], 0)
+        self.assertAlmostEqual(stats['distance_km'], haversine_distance(0, 0, 0, 0.021), places=1)
+        self.assertFalse(DriverState.objects.filter(is_busy=False).exists())
+        self.assertEqual(len(driver_index), 0)
+
+    def test_oldest_requests_are_served_first(self):
+        """Check that requests exceeding the free drivers stay pending for the next batch."""
+
+        requests = [
+            self.create_pending_request(customer, longitude)
+            for customer, longitude in zip(self.customers, [0.05, 0.0, 0.02])
+        ]
+
+        stats = dispatch_pending_requests()
+
+        self.assertEqual(stats['assigned'], 2)
+        self.assertEqual(
+            [ServiceRequest.objects.get(id=request.id).driver_id is not None for request in requests],
+            [True, True, False]
+        )
+
+    def test_assignments(self):
+        """Check the greedy and optimal assignments of a distance matrix."""
+
+        distances = haversine_matrix([0.0, 0.0], [0.011, 0.03], [0.0, 0.0], [0.0, 0.02])
+
+        self.assertAlmostEqual(distances[1, 0], haversine_distance(0, 0.03, 0, 0))
+        self.assertEqual(greedy_assignment(distances), [(0, 1), (1, 0)])
+        self.assertEqual(optimal_assignment(distances), [(0, 0), (1, 1)])
+
+
+@override_settings(DISPATCH_IN_BACKGROUND=False)
+class PendingDispatchTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.client = APIClient()
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.driver = get_user_model().objects.create(username='driver1', is_driver=True, plate='ABC123')
+        Location.objects.create(user=self.customer, address='Customer Address', latitude=4.6, longitude=-74.1)
+        self.client.force_authenticate(self.customer)
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def test_retries_do_not_queue_again(self):
+        """Check that retrying while the request is pending returns it without a new write."""
+
+        first = self.client.post(reverse('delivery'))
+        second = self.client.post(reverse('delivery'))
+
+        self.assertEqual(first.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(ServiceRequest.objects.filter(customer=self.customer).count(), 1)
+
+    def test_driver_location_dispatches_pending_request(self):
+        """Check that a driver sending its location is assigned to the pending request."""
+
+        service_id = self.client.post(reverse('delivery')).data['id']
+        self.assertEqual(self.client.get(reverse('delivery_status')).data['status'], 'pending')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Location.objects.create(user=self.driver, address='Driver Address', latitude=4.61, longitude=-74.1)
+
+        response = self.client.get(reverse('delivery_status'))
+
+        self.assertEqual(response.data['id'], service_id)
+        self.assertEqual(response.data['status'], 'assigned')
+        self.assertEqual(response.data['driver']['plate'], 'ABC123')
+        self.assertTrue(DriverState.objects.get(driver=self.driver).is_busy)
+
+    def test_closed_service_dispatches_pending_request(self):
+        """Check that the driver freed by closing a service is assigned to the pending request."""
+
+        Location.objects.create(user=self.driver, address='Driver Address', latitude=4.61, longitude=-74.1)
+        other_customer = get_user_model().objects.create(username='customer2')
+        Location.objects.create(user=other_customer, address='Other Address', latitude=4.62, longitude=-74.1)
+
+        other_client = APIClient()
+        other_client.force_authenticate(other_customer)
+        self.assertEqual(other_client.post(reverse('delivery')).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.client.post(reverse('delivery')).status_code, status.HTTP_202_ACCEPTED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other_client.post(reverse('endservice'))
+
+        self.assertEqual(ServiceRequest.objects.get(customer=self.customer).driver, self.driver)
+
+    def test_status_without_service(self):
+        """Check that the status of a customer without active service returns 404."""
+
+        response = self.client.get(reverse('delivery_status'))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_background_dispatches_are_merged(self):
+        """Check that dispatches requested while one is queued run only once."""
+
+        background = BackgroundDispatcher()
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_dispatch():
+            started.set()
+            release.wait(5)
+
+        with mock.patch('services.dispatch.dispatch_pending_requests', side_effect=blocking_dispatch) as dispatch, \
+                mock.patch('services.dispatch.connection'), \
+                override_settings(DISPATCH_IN_BACKGROUND=True):
+            background._submit()
+            started.wait(5)
+            # One dispatch running, the next ones are merged into a single queued dispatch.
+            for _ in range(10):
+                background._submit()
+            release.set()
+            background._executor.shutdown(wait=True)
+
+        self.assertEqual(dispatch.call_count, 2)
+
+
+class ETAProviderTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.graph = os.path.join(self.directory.name, 'graph.csv')
+        self.matrix = os.path.join(self.directory.name, 'eta')
+
+        # Three nodes on a road through the centre of three 0.01 degree cells.
+        with open(self.graph, 'w') as graph_file:
+            graph_file.write('from_lat,from_lon,to_lat,to_lon,minutes\n')
+            graph_file.write('0.005,0.005,0.005,0.015,2\n')
+            graph_file.write('0.005,0.015,0.005,0.025,3\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def build(self, *args):
+        call_command('build_eta_matrix', self.graph, self.matrix, '--bbox', '0', '0', '0.01', '0.03', *args, stdout=StringIO())
+        return GridMatrixETAProvider(self.matrix)
+
+    def test_constant_speed_is_default(self):
+        """Check that the default provider keeps 30 km/h and at least one minute."""
+
+        self.assertEqual(estimated_time(15), 30)
+        self.assertEqual(estimated_time(0.1), 1)
+
+    def test_grid_matrix_lookup(self):
+        """Check that the travel time is the shortest path between the cells of the points."""
+
+        provider = self.build('--two-way')
+
+        self.assertEqual(provider.minutes.shape, (3, 3))
+        self.assertEqual(provider.estimate(3.0, (0.001, 0.001), (0.009, 0.029)), 5)
+        self.assertEqual(provider.estimate(3.0, (0.009, 0.029), (0.001, 0.001)), 5)
+        self.assertEqual(provider.estimate(3.0, (0.005, 0.012), (0.005, 0.018)), 1)
+
+    def test_fallback(self):
+        """Check that points outside the grid and unreachable cells use the constant speed."""
+
+        provider = self.build()
+
+        self.assertEqual(provider.estimate(15, (0.005, 0.005), (0.005, 0.025)), 5)
+        # Segments are one way without --two-way.
+        self.assertEqual(provider.estimate(15, (0.005, 0.025), (0.005, 0.005)), 30)
+        self.assertEqual(provider.estimate(15, (1.0, 1.0), (0.005, 0.005)), 30)
+        self.assertEqual(provider.estimate(15), 30)
+
+    def test_provider_from_settings(self):
+        """Check that estimated_time uses the provider configured in the settings."""
+
+        self.build('--two-way')
+
+        with self.settings(ETA_PROVIDER='services.eta.GridMatrixETAProvider', ETA_PROVIDER_OPTIONS={'path': self.matrix}):
+            self.assertIsInstance(get_eta_provider(), GridMatrixETAProvider)
+            self.assertEqual(estimated_time(3.0, (0.005, 0.005), (0.005, 0.025)), 5)
+
+        self.assertIsInstance(get_eta_provider(), ConstantSpeedETAProvider)
+
+
+class NearbyDriversTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create(username='customer1'))
+        self.url = reverse('drivers_nearby')
+
+        # Drivers 5.2, 1.2 and 50 km north of the pickup point.
+        self.drivers = []
+        for i, distance_km in enumerate([5.2, 1.2, 50]):
+            driver = get_user_model().objects.create(username=f'driver{i}', is_driver=True, plate=f'ABC{i:03d}')
+            Location.objects.create(user=driver, address='Driver Address', latitude=distance_km / 111.195, longitude=0.0)
+            self.drivers.append(driver)
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def test_nearest_drivers_with_eta(self):
+        """Check that the k nearest drivers are returned nearest first with their distance and ETA."""
+
+        response = self.client.get(self.url, {'lat': 0, 'lon': 0, 'k': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [
+            {'id': self.drivers[1].id, 'plate': 'ABC001', 'distance': 1.2, 'eta': 2},
+            {'id': self.drivers[0].id, 'plate': 'ABC000', 'distance': 5.2, 'eta': 10},
+        ])
+
+    def test_radius(self):
+        """Check that drivers farther than radius_km are not returned."""
+
+        response = self.client.get(self.url, {'lat': 0, 'lon': 0, 'k': 20, 'radius_km': 10})
+
+        self.assertEqual([driver['plate'] for driver in response.data], ['ABC001', 'ABC000'])
+
+    def test_invalid_parameters(self):
+        """Check that missing or out of range parameters return 400."""
+
+        for params in [{'lon': 0}, {'lat': 91, 'lon': 0}, {'lat': 0, 'lon': 0, 'k': 0}, {'lat': 0, 'lon': 0, 'radius_km': -1}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class GenerateFakeDataTestCase(TestCase):
+
+    def generate(self, *args):
+        call_command(
+            'generate_fake_data', '--drivers', '12', '--customers', '5', '--locations-per-driver', '3',
+            '--bbox', '4.5', '-74.2', '4.8', '-74.0', '--batch-size', '5', *args, stdout=StringIO()
+        )
+
+    def test_dataset(self):
+        """Check the generated users, their locations inside the box and the current position of the drivers."""
+
+        self.generate('--seed', '1')
+
+        drivers = get_user_model().objects.filter(is_driver=True)
+        customers = get_user_model().objects.filter(is_driver=False)
+
+        self.assertEqual(drivers.count(), 12)
+        self.assertEqual(customers.count(), 5)
+        self.assertEqual(Location.objects.filter(user__is_driver=True).count(), 36)
+        self.assertEqual(Location.objects.filter(user__is_driver=False).count(), 5)
+        self.assertFalse(Location.objects.exclude(latitude__range=(4.5, 4.8), longitude__range=(-74.2, -74.0)).exists())
+        self.assertTrue(customers.first().check_password('password123'))
+
+        # The state of each driver is its latest location.
+        for driver in drivers:
+            state = DriverState.objects.get(driver=driver)
+            self.assertEqual(state.last_seen, get_latest_user_location(driver).created_at)
+
+    def test_seed_repeats_the_dataset(self):
+        """Check that two runs with the same seed generate the same coordinates and addresses."""
+
+        self.generate('--seed', '7')
+        first = set(Location.objects.values_list('latitude', 'longitude', 'address'))
+        self.generate('--seed', '7')
+        both = list(Location.objects.values_list('latitude', 'longitude', 'address'))
+
+        self.assertEqual(len(both), 2 * len(first))
+        self.assertEqual(set(both), first)
+
+
+class QueryPlanTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+        self.random = random.Random(5)
+        self.client = APIClient()
+
+        drivers = get_user_model().objects.bulk_create([
+            get_user_model()(username=f'driver{i}', is_driver=True, plate=f'ABC{i:03d}') for i in range(50)
+        ])
+        customers = get_user_model().objects.bulk_create([
+            get_user_model()(username=f'customer{i}') for i in range(50)
+        ])
+        Location.objects.bulk_create([
+            Location(
+                user=user,
+                address='Address',
+                latitude=4.65 + self.random.uniform(-0.1, 0.1),
+                longitude=-74.1 + self.random.uniform(-0.1, 0.1)
+            )
+            for user in drivers + customers
+            for _ in range(3)
+        ])
+        # Half of the drivers and customers are in an active service.
+        ServiceRequest.objects.bulk_create([
+            ServiceRequest(
+                customer=customer, driver=driver, distance_km=1, time_minutes=2,
+                is_completed=i < 25
+            )
+            for i, (customer, driver) in enumerate(zip(customers, drivers))
+        ])
+        DriverState.objects.bulk_create([
+            DriverState(
+                driver=driver, latitude=4.65, longitude=-74.1 + i / 1000, last_seen=timezone.now(),
+                is_busy=i >= 25
+            )
+            for i, driver in enumerate(drivers)
+        ])
+        self.customer = customers[0]
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def plan_nodes(self, node):
+        yield node
+        for child in node.get('Plans', []):
+            yield from self.plan_nodes(child)
+
+    def assertNoSequentialScans(self, queries):
+        """Explain the captured reads and updates, failing if a table has to be scanned whole."""
+
+        statements = [
+            query['sql'] for query in queries
+            if query['sql'].lstrip().startswith(('SELECT', 'UPDATE', 'DELETE', 'WITH'))
+        ]
+        self.assertTrue(statements)
+
+        with connection.cursor() as cursor:
+            # Without sequential scans the planner uses any usable index, so one is
+            # only left in the plan when no index serves the query.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for sql in statements:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+                plan = cursor.fetchone()[0][0]['Plan']
+
+                for node in self.plan_nodes(plan):
+                    self.assertNotEqual(node['Node Type'], 'Seq Scan', sql)
+                    # A lookup by key done as a filter means a whole index was read instead.
+                    if "id = '" in node.get('Filter', ''):
+                        condition = node.get('Index Cond', node.get('Recheck Cond', ''))
+                        self.assertIn('id = ', condition, f'{sql}\n{node}')
+
+    def test_nearest_driver(self):
+        """Check that every search backend finds the nearest driver through indexes."""
+
+        for backend in ('index', 'python', 'database'):
+            driver_index.clear()
+            with self.subTest(backend=backend), self.settings(DRIVER_SEARCH_BACKEND=backend):
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertIsNotNone(nearest_driver(4.65, -74.1))
+                self.assertNoSequentialScans(queries)
+
+    def test_get_latest_user_location(self):
+        """Check that the latest location of a user is read from an index."""
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNotNone(get_latest_user_location(self.customer))
+
+        self.assertNoSequentialScans(queries)
+
+    def test_create_and_close_service_request(self):
+        """Check that creating and closing a service request only use indexes."""
+
+        self.client.force_authenticate(self.customer)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('delivery'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNoSequentialScans(queries)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('endservice'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNoSequentialScans(queries)
+
+    def test_service_history(self):
+        """Check that the service history of a customer and of a driver is an index only scan of the services."""
+
+        # Histories of 20 services, of a customer and of a driver.
+        drivers = list(get_user_model().objects.filter(is_driver=True)[:20])
+        customers = list(get_user_model().objects.filter(is_driver=False)[:20])
+        ServiceRequest.objects.bulk_create([
+            ServiceRequest(customer=customer, driver=driver, distance_km=1, time_minutes=2, is_completed=True)
+            for customer, driver in [(self.customer, driver) for driver in drivers]
+            + [(customer, drivers[0]) for customer in customers]
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        for user, index in [(self.customer, 'servicerequest_customer_idx'), (drivers[0], 'servicerequest_driver_idx')]:
+            self.client.force_authenticate(user)
+            with self.subTest(index=index):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(reverse('services'), {'page_size': 5, 'status': 'completed'})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(len(queries), 1)
+                self.assertNoSequentialScans(queries)
+
+                with connection.cursor() as cursor:
+                    cursor.execute(f"EXPLAIN (FORMAT JSON) {queries[0]['sql']}")
+                    plan = cursor.fetchone()[0][0]['Plan']
+                self.assertIn(
+                    ('Index Only Scan', index),
+                    [(node['Node Type'], node.get('Index Name')) for node in self.plan_nodes(plan)]
+                )
+
+
+@override_settings(INSTRUMENTATION_ENABLED=True, INSTRUMENTATION_SLOW_REQUEST_MS=10000)
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        # Done on startup for the connections of the server, here the test one is already open.
+        install_query_recorder(connection)
+        self.client = APIClient()
+        self.customer = get_user_model().objects.create(username='customer1')
+        get_user_model().objects.create(username='driver1', is_driver=True)
+        self.client.force_authenticate(self.customer)
+        self.before = self.counters('GET drivers') | self.counters('POST locations')
+
+    def counters(self, view):
+        """Current value of the request metrics of a view."""
+
+        return {
+            (view, name): REGISTRY.get_sample_value(name, {'view': view}) or 0
+            for name in (
+                'delivery_request_seconds_count', 'delivery_request_seconds_sum',
+                'delivery_request_queries_sum', 'delivery_request_sql_seconds_total',
+                'delivery_request_render_seconds_total', 'delivery_slow_requests_total',
+            )
+        }
+
+    def recorded(self, view):
+        """Increase of the request metrics of a view since the start of the test."""
+
+        return {name: value - self.before[view, name] for (_, name), value in self.counters(view).items()}
+
+    def test_counters_per_view(self):
+        """Check that the queries and timings are added to the metrics under the view name."""
+
+        for _ in range(2):
+            response = self.client.get(reverse('drivers'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        stats = self.recorded('GET drivers')
+
+        self.assertEqual(stats['delivery_request_seconds_count'], 2)
+        self.assertEqual(stats['delivery_slow_requests_total'], 0)
+        self.assertGreaterEqual(stats['delivery_request_queries_sum'], 2)
+        self.assertGreater(stats['delivery_request_sql_seconds_total'], 0)
+        self.assertGreater(stats['delivery_request_render_seconds_total'], 0)
+        self.assertGreater(
+            stats['delivery_request_seconds_sum'],
+            stats['delivery_request_sql_seconds_total'] + stats['delivery_request_render_seconds_total']
+        )
+
+    def test_async_view_queries(self):
+        """Check that the queries run by the ORM of an async view are counted."""
+
+        response = self.client.post(reverse('locations'), {
+            'address': 'Address', 'latitude': 4.6, 'longitude': -74.1
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertGreaterEqual(self.recorded('POST locations')['delivery_request_queries_sum'], 1)
+
+    async def test_async_middleware_chain(self):
+        """Check that requests served by the async handler are instrumented too."""
+
+        token = str(RefreshToken.for_user(self.customer).access_token)
+
+        response = await AsyncClient().post(
+            reverse('locations'),
+            {'address': 'Address', 'latitude': 4.6, 'longitude': -74.1},
+            content_type='application/json',
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        stats = self.recorded('POST locations')
+        self.assertEqual(stats['delivery_request_seconds_count'], 1)
+        self.assertGreaterEqual(stats['delivery_request_queries_sum'], 1)
+
+    def test_slow_request_is_logged(self):
+        """Check that a request over the threshold is logged with its queries."""
+
+        with self.settings(INSTRUMENTATION_SLOW_REQUEST_MS=0):
+            client = APIClient()
+            client.force_authenticate(self.customer)
+            with self.assertLogs('services.middleware', 'WARNING') as logs:
+                client.get(reverse('drivers'))
+
+        self.assertIn('GET drivers', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+        self.assertEqual(self.recorded('GET drivers')['delivery_slow_requests_total'], 1)
+
+    def test_metrics_endpoint(self):
+        """Check that the request metrics are served by /metrics."""
+
+        self.client.get(reverse('drivers'))
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'delivery_request_seconds_count{view="GET drivers"}', response.content)
+
+    def test_disabled(self):
+        """Check that nothing is recorded when the instrumentation is disabled."""
+
+        with self.settings(INSTRUMENTATION_ENABLED=False):
+            client = APIClient()
+            client.force_authenticate(self.customer)
+            client.get(reverse('drivers'))
+
+        self.assertEqual(set(self.recorded('GET drivers').values()), {0})
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+        self.client = APIClient()
+        self.customer = get_user_model().objects.create(username='customer1')
+        Location.objects.create(user=self.customer, address='Customer Address', latitude=4.65, longitude=-74.1)
+        self.client.force_authenticate(self.customer)
+        service_state.clear()
+
+    def tearDown(self):
+        driver_index.clear()
+        service_state.clear()
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_assigned_request(self):
+        """Check that the search, the dispatch latency and the pickup distance are recorded."""
+
+        driver = get_user_model().objects.create(username='driver1', is_driver=True)
+        Location.objects.create(user=driver, address='Driver Address', latitude=4.66, longitude=-74.1)
+        searches = self.sample('delivery_driver_search_candidates_count', backend='index')
+        scanned = self.sample('delivery_driver_search_candidates_sum', backend='index')
+        assigned = self.sample('delivery_service_requests_total', outcome='assigned')
+        dispatches = self.sample('delivery_dispatch_seconds_count', outcome='assigned')
+        distance = self.sample('delivery_pickup_distance_km_sum')
+
+        response = self.client.post(reverse('delivery'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(self.sample('delivery_driver_search_candidates_count', backend='index'), searches + 1)
+        self.assertEqual(self.sample('delivery_driver_search_candidates_sum', backend='index'), scanned + 1)
+        self.assertEqual(self.sample('delivery_service_requests_total', outcome='assigned'), assigned + 1)
+        self.assertEqual(self.sample('delivery_dispatch_seconds_count', outcome='assigned'), dispatches + 1)
+        self.assertAlmostEqual(self.sample('delivery_pickup_distance_km_sum') - distance, 1.11, places=2)
+
+        closed = self.sample('delivery_services_closed_total')
+        self.client.post(reverse('endservice'))
+        self.assertEqual(self.sample('delivery_services_closed_total'), closed + 1)
+
+    @override_settings(DISPATCH_IN_BACKGROUND=False)
+    def test_queued_request(self):
+        """Check that a request without a free driver counts as queued."""
+
+        queued = self.sample('delivery_service_requests_total', outcome='queued')
+
+        response = self.client.post(reverse('delivery'))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.assertEqual(self.sample('delivery_service_requests_total', outcome='queued'), queued + 1)
+
+    def test_endpoint(self):
+        """Check that /metrics answers the local scraper, with the state of the services and drivers."""
+
+        driver = get_user_model().objects.create(username='driver1', is_driver=True)
+        Location.objects.create(user=driver, address='Driver Address', latitude=4.66, longitude=-74.1)
+        ServiceRequest.objects.create(customer=self.customer)
+
+        response = APIClient().get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('delivery_active_services 0.0', body)
+        self.assertIn('delivery_pending_services 1.0', body)
+        self.assertIn('delivery_idle_drivers 1.0', body)
+        self.assertIn('delivery_driver_search_seconds_bucket', body)
+
+    @override_settings(METRICS_TOKEN='scraper-token', METRICS_ALLOWED_IPS=['10.0.0.5'])
+    def test_endpoint_access(self):
+        """Check that /metrics only answers the allowed addresses and the scraper token."""
+
+        client = APIClient()
+
+        self.assertEqual(client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        response = client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong-token')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        # A user token is not enough either.
+        response = client.get(
+            reverse('metrics'),
+            HTTP_AUTHORIZATION='Bearer ' + str(RefreshToken.for_user(self.customer).access_token)
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_state_is_cached(self):
+        """Check that the services and drivers are counted once per METRICS_STATE_MAX_AGE_SECONDS."""
+
+        with self.assertNumQueries(3):
+            latest_metrics()
+        ServiceRequest.objects.create(customer=self.customer)
+
+        with self.assertNumQueries(0):
+            body = latest_metrics().decode()
+        self.assertIn('delivery_pending_services 0.0', body)
+
+        with self.settings(METRICS_STATE_MAX_AGE_SECONDS=0), self.assertNumQueries(3):
+            body = latest_metrics().decode()
+        self.assertIn('delivery_pending_services 1.0', body)
+
+    def test_multiprocess_mode(self):
+        """Check that the counters of every worker process are added up."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            environment = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': directory}
+            for _ in range(2):
+                subprocess.run(
+                    [sys.executable, '-c', 'from services.metrics import SERVICES_CLOSED; SERVICES_CLOSED.inc()'],
+                    cwd=settings.BASE_DIR, env=environment, check=True
+                )
+
+            with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+                body = latest_metrics().decode()
+
+        self.assertIn('delivery_services_closed_total 2.0', body)
+        self.assertIn('delivery_idle_drivers 0.0', body)
+
+
+class ProfilingTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(PROFILING_ENABLED=True, PROFILING_DIRECTORY=self.directory.name)
+        self.settings_override.enable()
+
+        self.client = APIClient()
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.client.force_authenticate(self.customer)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.directory.cleanup()
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_signed_header(self):
+        """Check that a request with a valid X-Profile header saves its profile and summary."""
+
+        response = self.client.get(reverse('drivers'), headers={'X-Profile': profiling_token()})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile_id = response['X-Profile-Id']
+        self.assertTrue(profile_id.startswith('GET-drivers.'))
+        self.assertEqual(self.profiles(), [f'{profile_id}.prof', f'{profile_id}.txt'])
+
+        with open(os.path.join(self.directory.name, f'{profile_id}.txt')) as summary:
+            self.assertIn('GET drivers /api/drivers/: 200', summary.readline())
+
+    def test_not_sampled(self):
+        """Check that requests without a valid header are not profiled."""
+
+        response = self.client.get(reverse('drivers'), headers={'X-Profile': 'profile:forged'})
+        self.client.get(reverse('drivers'))
+
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(self.profiles(), [])
+
+    def test_sample_rate(self):
+        """Check that every request is profiled with a sample rate of 1."""
+
+        with self.settings(PROFILING_SAMPLE_RATE=1.0):
+            client = APIClient()
+            client.force_authenticate(self.customer)
+            client.get(reverse('drivers'))
+            client.get(reverse('userdetail'))
+
+        self.assertEqual(len(self.profiles()), 4)
+
+    async def test_async_chain(self):
+        """Check that the ORM work of an async view is in the profile of a request served by the async handler."""
+
+        token = str(RefreshToken.for_user(self.customer).access_token)
+
+        response = await AsyncClient().post(
+            reverse('locations'),
+            {'address': 'Address', 'latitude': 4.6, 'longitude': -74.1},
+            content_type='application/json',
+            headers={'Authorization': f'Bearer {token}', 'X-Profile': profiling_token()}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        stats = pstats.Stats(os.path.join(self.directory.name, f"{response['X-Profile-Id']}.prof"))
+        functions = {name for _, _, name in stats.stats}
+        self.assertIn('execute', functions)
+        self.assertIn('render', functions)
+
+    def test_aggregate_profiles(self):
+        """Check that the command adds up the profiles of each view."""
+
+        for _ in range(2):
+            self.client.get(reverse('drivers'), headers={'X-Profile': profiling_token()})
+        self.client.get(reverse('userdetail'), headers={'X-Profile': profiling_token()})
+
+        out = StringIO()
+        call_command('aggregate_profiles', directory=self.directory.name, limit=5, stdout=out)
+        output = out.getvalue()
+
+        self.assertIn('GET-drivers: 2 profiles', output)
+        self.assertIn('GET-userdetail: 1 profiles', output)
+
+        out = StringIO()
+        call_command('aggregate_profiles', directory=self.directory.name, view='drivers', stdout=out)
+        self.assertNotIn('userdetail', out.getvalue())
+
+@override_settings(DISPATCH_IN_BACKGROUND=False)
+class ServiceStatsTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        driver_index.clear()
+
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.driver = get_user_model().objects.create(username='driver1', is_driver=True, plate='ABC123')
+        Location.objects.create(user=self.customer, address='Pickup', latitude=4.6, longitude=-74.1)
+        Location.objects.create(user=self.driver, address='Street', latitude=4.61, longitude=-74.1)
+
+        self.client = APIClient()
+        self.today = timezone.localdate(timezone.now(), timezone.get_default_timezone())
+
+    def tearDown(self):
+        driver_index.clear()
+
+    def stats(self, user):
+        """Rollup of today of the user, or None."""
+
+        return DailyServiceStats.objects.filter(user=user, day=self.today).values(
+            'services', 'completed', 'distance_km', 'eta_minutes', 'eta_services'
+        ).first()
+
+    def request_and_close_service(self):
+        self.client.force_authenticate(self.customer)
+        response = self.client.post(reverse('delivery'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(reverse('endservice'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_rollups_follow_services(self):
+        """Check that creating and closing a service adds it to the day of its customer and driver."""
+
+        self.client.force_authenticate(self.customer)
+        self.client.post(reverse('delivery'), {}, format='json')
+        service = ServiceRequest.objects.get(customer=self.customer)
+
+        self.assertEqual(self.stats(self.customer)['services'], 1)
+        self.assertEqual(self.stats(self.driver)['completed'], 0)
+
+        self.client.post(reverse('endservice'), {}, format='json')
+
+        for user in (self.customer, self.driver):
+            rollup = self.stats(user)
+            self.assertEqual(rollup['services'], 1)
+            self.assertEqual(rollup['completed'], 1)
+            self.assertAlmostEqual(rollup['distance_km'], service.distance_km)
+            self.assertEqual(rollup['eta_minutes'], service.time_minutes)
+            self.assertEqual(rollup['eta_services'], 1)
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_batch_dispatch_counts_driver(self):
+        """Check that a service assigned by the dispatch of pending requests is counted for its driver."""
+
+        self.client.force_authenticate(self.customer)
+        self.client.post(reverse('delivery'), {}, format='json')
+        self.assertIsNone(self.stats(self.driver))
+
+        dispatch_pending_requests()
+
+        self.assertEqual(self.stats(self.driver)['services'], 1)
+        self.assertEqual(self.stats(self.customer)['services'], 1)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        """Check that the rebuild command recomputes the same rollups from the services."""
+
+        self.request_and_close_service()
+        self.request_and_close_service()
+        # A service of two days ago, closed yesterday.
+        created_at = timezone.now() - timedelta(days=2)
+        ServiceRequest.objects.create(
+            customer=self.customer, driver=self.driver, distance_km=1.5, time_minutes=3, is_completed=True
+        )
+        ServiceRequest.objects.filter(distance_km=1.5).update(
+            created_at=created_at, close_service_at=created_at + timedelta(days=1)
+        )
+
+        incremental = self.stats(self.customer)
+        out = StringIO()
+        call_command('rebuild_service_stats', stdout=out)
+        self.assertIn('6 daily stats rebuilt', out.getvalue())
+
+        self.assertEqual(self.stats(self.customer), incremental)
+        rebuilt = DailyServiceStats.objects.filter(user=self.driver).order_by('day')
+        self.assertEqual(
+            [(rollup.day, rollup.services, rollup.completed) for rollup in rebuilt],
+            [
+                (stats_day(created_at), 1, 0),
+                (stats_day(created_at + timedelta(days=1)), 0, 1),
+                (self.today, 2, 2),
+            ]
+        )
+
+        # Only the days of the period are rebuilt.
+        DailyServiceStats.objects.filter(day=self.today).update(services=100)
+        call_command('rebuild_service_stats', start=self.today - timedelta(days=1), stdout=StringIO())
+        self.assertEqual(DailyServiceStats.objects.get(user=self.driver, day=self.today).services, 2)
+
+    def test_driver_stats(self):
+        """Check that the stats of every day of the period are read from the rollups with their totals."""
+
+        self.request_and_close_service()
+        DailyServiceStats.objects.create(
+            user=self.driver, day=self.today - timedelta(days=2),
+            services=3, completed=2, distance_km=4.0, eta_minutes=10, eta_services=2
+        )
+        url = reverse('driver_stats', args=[self.driver.id])
+        self.client.force_authenticate(self.driver)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'from': self.today - timedelta(days=2), 'to': self.today})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        days = response.data['days']
+        self.assertEqual([day['day'] for day in days], [self.today - timedelta(days=n) for n in (2, 1, 0)])
+        self.assertEqual(days[0], {
+            'day': self.today - timedelta(days=2),
+            'services': 3, 'completed': 2, 'distance_km': 4.0, 'average_eta_minutes': 5.0,
+        })
+        self.assertEqual(days[1]['services'], 0)
+        self.assertIsNone(days[1]['average_eta_minutes'])
+        self.assertEqual(response.data['totals']['services'], 4)
+        self.assertEqual(response.data['totals']['completed'], 3)
+
+        # The last STATS_DEFAULT_DAYS by default.
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['days']), settings.STATS_DEFAULT_DAYS)
+        self.assertEqual(response.data['to'], self.today)
+
+    def test_stats_permissions_and_period(self):
+        """Check that users only read their own stats, of their role, and that the period is validated."""
+
+        self.client.force_authenticate(self.customer)
+
+        response = self.client.get(reverse('driver_stats', args=[self.driver.id]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.client.get(reverse('driver_stats', args=[self.customer.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        url = reverse('customer_stats', args=[self.customer.id])
+        response = self.client.get(url, {'from': self.today, 'to': self.today - timedelta(days=1)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(url, {'from': self.today - timedelta(days=settings.STATS_MAX_DAYS)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(url, {'from': self.today})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['totals']['services'], 0)
+
+class ServiceHistoryTestCase(TestCase):
+
+    def setUp(self):
+        """Data configuration for the test case."""
+
+        self.customer = get_user_model().objects.create(username='customer1')
+        self.drivers = [
+            get_user_model().objects.create(username=f'driver{i}', is_driver=True, plate=f'ABC{i:03d}')
+            for i in range(3)
+        ]
+        # Completed services of an hour apart with each driver, the newest one still active.
+        now = timezone.now()
+        self.services = []
+        for i, driver in enumerate(self.drivers * 2):
+            service = ServiceRequest.objects.create(
+                customer=self.customer, driver=driver, pickup_address=f'Street {i}',
+                distance_km=1.5, time_minutes=3, is_completed=i < 5
+            )
+            ServiceRequest.objects.filter(id=service.id).update(created_at=now - timedelta(hours=6 - i))
+            self.services.append(service)
+        self.pending = ServiceRequest.objects.create(customer=get_user_model().objects.create(username='customer2'))
+
+        self.client = APIClient()
+        self.url = reverse('services')
+
+    def test_customer_history_newest_first(self):
+        """Check that the services of the customer are paginated newest first without a query per driver."""
+
+        self.client.force_authenticate(self.customer)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'page_size': 4})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [service['id'] for service in response.data],
+            [str(service.id) for service in reversed(self.services[2:])]
+        )
+        newest = response.data[0]
+        self.assertEqual(newest['status'], 'assigned')
+        self.assertIsNone(newest['close_service_at'])
+        self.assertEqual(newest['driver'], {
+            'id': str(self.drivers[2].id), 'username': 'driver2', 'plate': 'ABC002'
+        })
+        self.assertEqual(newest['pickup_address'], 'Street 5')
+        self.assertEqual(response.data[1]['status'], 'completed')
+        self.assertIsNotNone(response.data[1]['close_service_at'])
+
+        next_url = response['Link'].split(';')[0].strip('<>')
+        response = self.client.get(next_url)
+        self.assertEqual(
+            [service['id'] for service in response.data],
+            [str(service.id) for service in reversed(self.services[:2])]
+        )
+        self.assertNotIn('Link', response)
+
+    def test_history_filters(self):
+        """Check that the history is filtered by status, and by role for drivers."""
+
+        self.client.force_authenticate(self.customer)
+        response = self.client.get(self.url, {'status': 'completed'})
+        self.assertEqual(len(response.data), 5)
+        response = self.client.get(self.url, {'status': 'pending'})
+        self.assertEqual(response.data, [])
+
+        self.client.force_authenticate(self.drivers[0])
+        response = self.client.get(self.url)
+        self.assertEqual(
+            [service['id'] for service in response.data],
+            [str(self.services[3].id), str(self.services[0].id)]
+        )
+        self.assertEqual(response.data[0]['customer']['username'], 'customer1')
+
+        response = self.client.get(self.url, {'role': 'customer'})
+        self.assertEqual(response.data, [])
+
+        response = self.client.get(self.url, {'status': 'cancelled'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
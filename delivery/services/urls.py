@@ -1,13 +1,19 @@
 from django.urls import path
-from .views import RegisterUser, Login, LocationAssign, ServiceRequestCreate, CloseServiceRequest, DriverList, UserDetail
+from .views import RegisterUser, Login, LocationAssign, LocationBatchAssign, ServiceRequestCreate, ServiceRequestStatus, CloseServiceRequest, DriverList, NearbyDrivers, UserDetail, UserServiceStats, ServiceHistory
 
 urlpatterns = [
     path('register/', RegisterUser.as_view(), name='register'),
     path('login/', Login.as_view(), name='login'),
     path('locations/', LocationAssign.as_view(), name='locations'),
+    path('locations/batch/', LocationBatchAssign.as_view(), name='location_batch'),
     path('locations/<uuid:pk>/', LocationAssign.as_view(), name='location_detail'),
     path('delivery/', ServiceRequestCreate.as_view(), name='delivery'),
+    path('delivery/status/', ServiceRequestStatus.as_view(), name='delivery_status'),
     path('endservice/', CloseServiceRequest.as_view(), name='endservice'),
+    path('services/', ServiceHistory.as_view(), name='services'),
     path('users/me/', UserDetail.as_view(), name='userdetail'),
     path('drivers/', DriverList.as_view(), name='drivers'),
+    path('drivers/nearby/', NearbyDrivers.as_view(), name='drivers_nearby'),
+    path('stats/drivers/<uuid:pk>/', UserServiceStats.as_view(is_driver=True), name='driver_stats'),
+    path('stats/customers/<uuid:pk>/', UserServiceStats.as_view(is_driver=False), name='customer_stats'),
 ]
\ No newline at end of file
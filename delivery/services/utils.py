@@ -1,10 +1,24 @@
 import math
-from .models import Location, ServiceRequest
+import time
+import numpy as np
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import aauthenticate
+from django.db import connection, transaction
+from django.db.models import ExpressionWrapper, F, FloatField
+from django.db.models.functions import ATan2, Cos, Power, Radians, Sin, Sqrt
+from django.utils import timezone
+from .eta import get_eta_provider
+from .metrics import DRIVER_SEARCH_CANDIDATES, DRIVER_SEARCH_SECONDS
+from .models import DriverState, Location, ServiceRequest, User
+from .stats import completed_rows_sql, stats_day, upsert_sql
+
+EARTH_RADIUS_KM = 6371
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate the Haversine distance between two points (in kilometers)."""
 
-    R = 6371  # Earth radius in km
+    R = EARTH_RADIUS_KM
 
     phi1 = math.radians(lat1)
     phi2 = math.radians(lat2)
@@ -17,59 +31,480 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     distance = R * c
     return distance
 
-def estimated_time(distance_km):
-    """Calculate estimated time (in minutes) assuming an average speed of 30km/h."""
-    avg_speed_kmh = 30
-    time_hours = distance_km / avg_speed_kmh
-    time_minutes = int(time_hours * 60)
+def haversine_many(lat, lon, lats, lons):
+    """Calculate the Haversine distance (in kilometers) from one point to arrays of points.
+
+    Vectorised version of haversine_distance, which is kept as the reference implementation.
+    """
+
+    phi1 = math.radians(lat)
+    phi2 = np.radians(np.asarray(lats, dtype=np.float64))
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(np.asarray(lons, dtype=np.float64)) - math.radians(lon)
+
+    a = np.sin(delta_phi/2)**2 + math.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return EARTH_RADIUS_KM * c
+
+def haversine_matrix(lats1, lons1, lats2, lons2):
+    """Calculate the Haversine distance (in kilometers) between every pair of two arrays of points.
+
+    Row i, column j of the result is the distance from point i of the first array to point j of the second.
+    """
+
+    phi1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, np.newaxis]
+    lambda1 = np.radians(np.asarray(lons1, dtype=np.float64))[:, np.newaxis]
+    phi2 = np.radians(np.asarray(lats2, dtype=np.float64))[np.newaxis, :]
+    lambda2 = np.radians(np.asarray(lons2, dtype=np.float64))[np.newaxis, :]
+
+    a = np.sin((phi2 - phi1)/2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin((lambda2 - lambda1)/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return EARTH_RADIUS_KM * c
+
+def bounding_box(latitude, longitude, radius_km):
+    """Return the (min_lat, max_lat, min_lon, max_lon) box enclosing a circle of radius_km."""
+
+    angular_radius = radius_km / EARTH_RADIUS_KM
+    delta_lat = math.degrees(angular_radius)
+    min_lat = latitude - delta_lat
+    max_lat = latitude + delta_lat
+
+    # Near the poles the circle covers every meridian.
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90), min(max_lat, 90), -180, 180
+
+    sin_ratio = math.sin(angular_radius) / math.cos(math.radians(latitude))
+    if sin_ratio >= 1:
+        return min_lat, max_lat, -180, 180
+
+    delta_lon = math.degrees(math.asin(sin_ratio))
+    return min_lat, max_lat, longitude - delta_lon, longitude + delta_lon
 
-    return max(time_minutes, 1)
+def estimated_time(distance_km, origin=None, destination=None):
+    """Calculate estimated time (in minutes) with the provider of the ETA_PROVIDER setting.
+
+    The default provider assumes an average speed of 30km/h. ``origin`` and
+    ``destination`` are the (latitude, longitude) of the driver and the pickup.
+    """
+    return get_eta_provider().estimate(distance_km, origin, destination)
+
+def available_driver_locations():
+    """Current (driver_id, latitude, longitude) of every driver that is not occupied."""
+    return (
+        DriverState.objects
+        .filter(is_busy=False, driver__is_driver=True)
+        .values_list('driver_id', 'latitude', 'longitude')
+    )
+
+def haversine_expression(latitude, longitude, latitude_field='latitude', longitude_field='longitude'):
+    """ORM expression of haversine_distance from a point to the coordinates of each row."""
+
+    phi2 = Radians(latitude_field)
+    delta_phi = Radians(F(latitude_field) - latitude)
+    delta_lambda = Radians(F(longitude_field) - longitude)
+
+    a = (
+        Power(Sin(delta_phi / 2), 2)
+        + math.cos(math.radians(latitude)) * Cos(phi2) * Power(Sin(delta_lambda / 2), 2)
+    )
+
+    return ExpressionWrapper(
+        2 * EARTH_RADIUS_KM * ATan2(Sqrt(a), Sqrt(1 - a)),
+        output_field=FloatField()
+    )
+
+def _nearest_drivers_index(pickup_latitude, pickup_longitude, k, radius_km=None):
+    """Answer from the in-memory index, loading it with a database scan when it is cold.
+
+    The index of each process only sees the writes of that process until it is
+    reloaded, after DRIVER_INDEX_MAX_AGE_SECONDS. Its candidates are checked
+    against the database, and when it has none the database backend answers.
+    """
+
+    from .driver_index import driver_index
+
+    if not driver_index.is_warm:
+        driver_index.load(available_driver_locations())
+
+    scanned = 0
+    while True:
+        candidates, searched = driver_index.search(pickup_latitude, pickup_longitude, k=k, radius_km=radius_km)
+        scanned += searched
+
+        # The index is local to this process, so confirm the drivers still exist and are free.
+        available_ids = set(
+            available_driver_locations()
+            .filter(driver_id__in=[driver_id for _, driver_id, _, _ in candidates])
+            .values_list('driver_id', flat=True)
+        )
+
+        stale_ids = [driver_id for _, driver_id, _, _ in candidates if driver_id not in available_ids]
+
+        if not candidates:
+            # Drivers freed or moved through another worker reach this index only on its
+            # next reload, so an empty answer is checked against the DriverState table.
+            drivers, searched = _nearest_drivers_database(pickup_latitude, pickup_longitude, k, radius_km)
+            for driver in drivers:
+                driver_index.update(driver['user_id'], driver['latitude'], driver['longitude'])
+            return drivers, scanned + searched
+
+        if not stale_ids:
+            return [
+                {
+                    'user_id': driver_id,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'distance': distance
+                }
+                for distance, driver_id, latitude, longitude in candidates
+            ], scanned
+
+        for driver_id in stale_ids:
+            driver_index.remove(driver_id)
+
+def _nearest_drivers_python(pickup_latitude, pickup_longitude, k, radius_km=None):
+    """Scan every available driver, packing the coordinates into arrays.
+
+    Coordinates are read as plain tuples, so no model is instantiated and the
+    k winners are selected with a partial sort.
+    """
+
+    rows = list(available_driver_locations())
+
+    if not rows:
+        return [], 0
+
+    driver_ids = [row[0] for row in rows]
+    latitudes = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    longitudes = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+
+    distances = haversine_many(pickup_latitude, pickup_longitude, latitudes, longitudes)
+
+    candidates = np.arange(len(rows))
+    if radius_km is not None:
+        candidates = np.flatnonzero(distances <= radius_km)
+        if not len(candidates):
+            return [], len(rows)
+
+    k = min(k, len(candidates))
+    selected = candidates[np.argpartition(distances[candidates], k - 1)[:k]]
+    selected = selected[np.argsort(distances[selected])]
+
+    return [
+        {
+            'user_id': driver_ids[i],
+            'latitude': float(latitudes[i]),
+            'longitude': float(longitudes[i]),
+            'distance': float(distances[i])
+        }
+        for i in selected
+    ], len(rows)
+
+def _nearest_drivers_database(pickup_latitude, pickup_longitude, k, radius_km=None):
+    """Rank the drivers in PostgreSQL, growing a bounding box until k drivers are found.
+
+    Only the k winning rows are sent back by the database.
+    """
+
+    drivers = (
+        DriverState.objects
+        .filter(is_busy=False, driver__is_driver=True)
+        .annotate(distance=haversine_expression(pickup_latitude, pickup_longitude))
+        .order_by('distance')
+        .values_list('driver_id', 'latitude', 'longitude', 'distance')
+    )
+
+    # A driver in the corner of the box can be farther than one outside of it,
+    # so only the drivers inside the circle are trusted before growing the box.
+    radii = getattr(settings, 'DRIVER_SEARCH_RADII_KM', (1, 5, 25, 125))
+    if radius_km is not None:
+        radii = [radius for radius in radii if radius < radius_km] + [radius_km]
+
+    rows = []
+    scanned = 0
+    for radius in radii:
+        min_lat, max_lat, min_lon, max_lon = bounding_box(pickup_latitude, pickup_longitude, radius)
+        rows = list(
+            drivers
+            .filter(
+                latitude__range=(min_lat, max_lat),
+                longitude__range=(min_lon, max_lon),
+                distance__lte=radius
+            )[:k]
+        )
+        scanned += len(rows)
+        if len(rows) == k:
+            break
+    else:
+        if radius_km is None:
+            rows = list(drivers[:k])
+            scanned += len(rows)
+
+    return [
+        {
+            'user_id': driver_id,
+            'latitude': latitude,
+            'longitude': longitude,
+            'distance': distance
+        }
+        for driver_id, latitude, longitude, distance in rows
+    ], scanned
+
+# Each backend returns the drivers found and how many candidates it had to rank.
+DRIVER_SEARCH_BACKENDS = {
+    'index': _nearest_drivers_index,
+    'python': _nearest_drivers_python,
+    'database': _nearest_drivers_database,
+}
+
+def nearest_drivers(pickup_latitude, pickup_longitude, k=1, radius_km=None):
+    """Find the k nearest available drivers, nearest first, optionally only within radius_km.
+
+    The search is done by the backend named in the DRIVER_SEARCH_BACKEND setting.
+    """
+
+    name = getattr(settings, 'DRIVER_SEARCH_BACKEND', 'index')
+    started = time.perf_counter()
+    drivers, scanned = DRIVER_SEARCH_BACKENDS[name](pickup_latitude, pickup_longitude, k, radius_km)
+
+    DRIVER_SEARCH_SECONDS.labels(name).observe(time.perf_counter() - started)
+    DRIVER_SEARCH_CANDIDATES.labels(name).observe(scanned)
+    return drivers
 
 def nearest_driver(pickup_latitude, pickup_longitude):
         """Find the nearest driver based on the pickup location."""
 
-        # Bring in the IDs of drivers who already have an active (not completed) service.
-        busy_driver_ids = ServiceRequest.objects.filter(
-            is_completed=False
-        ).values_list('driver_id', flat=True)
-
-        # Get the most recent locations of available drivers (that are not occupied)
-        drivers = (
-            Location.objects
-            .filter(user__is_driver=True)
-            .exclude(user_id__in=busy_driver_ids)
-            .order_by('user', '-created_at')
-            .distinct('user')
-        )
+        drivers = nearest_drivers(pickup_latitude, pickup_longitude, k=1)
 
-        if not drivers.exists():
+        if not drivers:
             return None
 
-        driver_selected = min(
-            drivers,
-            key=lambda location: haversine_distance(
-                pickup_latitude, pickup_longitude,
-                location.latitude, location.longitude
+        driver_selected = drivers[0]
+
+        return {
+            'user': User.objects.get(id=driver_selected['user_id']),
+            'latitude': driver_selected['latitude'],
+            'longitude': driver_selected['longitude'],
+            'distance': driver_selected['distance']
+        }
+
+def reserve_nearest_driver(pickup_latitude, pickup_longitude):
+    """Lock the nearest free driver for the current transaction.
+
+    The DriverState row of each candidate is locked with SELECT ... FOR UPDATE
+    SKIP LOCKED, so a driver being reserved by a concurrent request is skipped
+    in favour of the next nearest one instead of waiting for it. Must be called inside
+    transaction.atomic(); returns the same dict as nearest_driver or None.
+    """
+
+    k = getattr(settings, 'DISPATCH_CANDIDATES', 10)
+    tried = set()
+
+    while True:
+        candidates = nearest_drivers(pickup_latitude, pickup_longitude, k=k)
+
+        for candidate in candidates:
+            if candidate['user_id'] in tried:
+                continue
+            tried.add(candidate['user_id'])
+
+            driver_state = (
+                DriverState.objects
+                .select_for_update(skip_locked=True, of=('self',))
+                .select_related('driver')
+                .filter(driver_id=candidate['user_id'], is_busy=False, driver__is_driver=True)
+                .first()
             )
+
+            # Locked by another dispatch, or assigned since the candidates were read.
+            if driver_state is None:
+                continue
+
+            return {
+                'user': driver_state.driver,
+                'latitude': candidate['latitude'],
+                'longitude': candidate['longitude'],
+                'distance': candidate['distance']
+            }
+
+        # Every available driver was already tried.
+        if len(candidates) < k:
+            return None
+
+        k *= 2
+
+def close_service_request(user_id, service_id=None):
+    """Close the active service of a customer or driver, freeing its driver, in a single statement.
+
+    The service is completed by a conditional UPDATE, so of concurrent closes
+    only one finds it active, and the DriverState of its driver is released
+    and the daily stats of its customer and driver are updated in the same
+    statement. ``service_id`` restricts the close to that service.
+    Returns the (id, close_service_at) of the closed service or None.
+    """
+
+    from .dispatch import dispatcher
+    from .driver_index import driver_index
+
+    # The unique partial indexes allow one active service per customer and per driver.
+    # The service is looked up as customer and as driver, whatever the user is now
+    # (is_driver can change), with one index lookup each instead of an OR.
+    sql = f"""
+        WITH closed AS (
+            UPDATE {ServiceRequest._meta.db_table}
+            SET is_completed = true, close_service_at = %s
+            WHERE NOT is_completed AND id IN (
+                SELECT id FROM {ServiceRequest._meta.db_table} WHERE customer_id = %s AND NOT is_completed
+                UNION ALL
+                SELECT id FROM {ServiceRequest._meta.db_table} WHERE driver_id = %s AND NOT is_completed
+            ) {'AND id = %s' if service_id else ''}
+            RETURNING id, customer_id, driver_id, distance_km, time_minutes, close_service_at
+        ), released AS (
+            UPDATE {DriverState._meta.db_table} AS state
+            SET is_busy = false, current_service_id = NULL
+            FROM closed
+            WHERE state.driver_id = closed.driver_id AND state.current_service_id = closed.id
+            RETURNING state.driver_id, state.latitude, state.longitude
+        ), rollups AS (
+            {upsert_sql(completed_rows_sql('closed', '%s::date'))}
         )
+        SELECT closed.id, closed.close_service_at, released.driver_id, released.latitude, released.longitude
+        FROM closed LEFT JOIN released ON released.driver_id = closed.driver_id
+    """
+    now = timezone.now()
+    params = [now, user_id, user_id] + ([service_id] if service_id else []) + [stats_day(now)]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    closed_id, close_service_at, driver_id, latitude, longitude = row
+
+    # The statement bypasses the post_save signal, so the driver is released here.
+    if driver_id is not None:
+        if driver_index.is_warm:
+            driver_index.update(driver_id, latitude, longitude)
+        # The freed driver can take a request waiting in the queue.
+        dispatcher.schedule()
+
+    return closed_id, close_service_at
+
+def index_available_driver(driver_id):
+    """Put the driver back in the warm index at its current position if it is free."""
+
+    from .driver_index import driver_index
+
+    if not driver_index.is_warm:
+        return
+
+    position = (
+        available_driver_locations()
+        .filter(driver_id=driver_id)
+        .values_list('latitude', 'longitude')
+        .first()
+    )
+    if position:
+        driver_index.update(driver_id, *position)
 
-        distance_to_driver = haversine_distance(
-            pickup_latitude, pickup_longitude,
-            driver_selected.latitude, driver_selected.longitude
+def record_driver_positions(locations):
+    """Make new locations the current position of their drivers, one location per driver."""
+
+    from .dispatch import dispatcher
+    from .driver_index import driver_index
+
+    DriverState.objects.bulk_create(
+        [
+            DriverState(
+                driver_id=location.user_id,
+                latitude=location.latitude,
+                longitude=location.longitude,
+                last_seen=location.created_at
+            )
+            for location in locations
+        ],
+        update_conflicts=True,
+        unique_fields=['driver'],
+        update_fields=['latitude', 'longitude', 'last_seen']
+    )
+
+    for location in locations:
+        if location.user_id in driver_index:
+            driver_index.update(location.user_id, location.latitude, location.longitude)
+        else:
+            index_available_driver(location.user_id)
+
+    # A driver reporting its position may be the one a waiting request needs.
+    dispatcher.schedule()
+
+def delete_location(location):
+    """Delete a location, moving the driver back to its previous location if it was the current one.
+
+    Deleting a user removes its locations and its DriverState in bulk, so
+    only the deletes of a single location need the driver state fixed.
+    """
+
+    from .driver_index import driver_index
+
+    with transaction.atomic():
+        location.delete()
+
+        states = DriverState.objects.filter(driver_id=location.user_id, last_seen=location.created_at)
+        if not states.exists():
+            return
+
+        previous_location = get_latest_user_location(location.user_id)
+
+        if previous_location is None:
+            states.delete()
+            driver_index.remove(location.user_id)
+            return
+
+        states.update(
+            latitude=previous_location.latitude,
+            longitude=previous_location.longitude,
+            last_seen=previous_location.created_at
         )
 
-        return {
-            'user': driver_selected.user,
-            'latitude': driver_selected.latitude,
-            'longitude': driver_selected.longitude,
-            'distance': distance_to_driver
-        }
+    if location.user_id in driver_index:
+        driver_index.update(location.user_id, previous_location.latitude, previous_location.longitude)
 
-def get_latest_user_location(user):
-    """Get the latest location of the user."""
-    return (
+def latest_user_locations(user):
+    """Recent and complete location history of the user, newest first.
+
+    Only the recent partitions of the location history are searched first,
+    the whole history is read just for users without recent locations.
+    """
+    locations = (
         Location.objects
         .filter(user=user)
         .order_by('-created_at')
-        .first()
-    )
\ No newline at end of file
+    )
+    recent_since = timezone.now() - timedelta(days=getattr(settings, 'LOCATION_RECENT_DAYS', 7))
+
+    return locations.filter(created_at__gte=recent_since), locations
+
+def get_latest_user_location(user):
+    """Get the latest location of the user."""
+    recent_locations, locations = latest_user_locations(user)
+    return recent_locations.first() or locations.first()
+
+async def aget_latest_user_location(user):
+    """Async version of get_latest_user_location."""
+    recent_locations, locations = latest_user_locations(user)
+    return await recent_locations.afirst() or await locations.afirst()
+
+async def aauthenticate_user(username, password):
+    """Check the credentials of an active user, returning the user or None.
+
+    Runs the authentication backends of django.contrib.auth, which fire
+    user_login_failed and upgrade the hash of the password. The one of the
+    project (services.authentication.PasswordExecutorBackend) hashes it in
+    a bounded pool of threads.
+    """
+
+    return await aauthenticate(username=username, password=password)
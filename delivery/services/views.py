@@ -1,15 +1,23 @@
+from adrf.views import APIView
+from asgiref.sync import sync_to_async
 from rest_framework import status, permissions, viewsets
 from rest_framework.response import Response
-from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.contrib.auth import authenticate
-from django.utils import timezone
-import json
-from .serializers import UserSerializer, LocationSerializer, ServiceRequestSerializer
-from .utils import nearest_driver, estimated_time, get_latest_user_location
-from .models import ServiceRequest, User, Location
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+import hmac
+import time
+from .serializers import UserSerializer, LocationSerializer, LocationBatchItemSerializer, NearbyDriversQuerySerializer, ServiceRequestSerializer, CloseServiceRequestSerializer, ServiceStatsQuerySerializer, ServiceHistorySerializer, ServiceHistoryQuerySerializer
+from .metrics import SERVICES_CLOSED, latest_metrics, record_dispatch
+from .pagination import KeysetPagination
+from .stats import daily_stats, record_service_created
+from .utils import reserve_nearest_driver, nearest_drivers, estimated_time, aget_latest_user_location, aauthenticate_user, record_driver_positions, close_service_request, delete_location
+from .models import HISTORY_COLUMNS, DriverState, ServiceRequest, User, Location
 
 
 class RegisterUser(APIView):
@@ -34,12 +42,53 @@ class DriverList(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        """Retrieve all drivers"""
+        """Retrieve the drivers, one page at a time"""
 
-        drivers = User.objects.filter(is_driver=True)
+        paginator = KeysetPagination()
+        drivers = paginator.paginate_queryset(User.objects.filter(is_driver=True), request)
         serializer = UserSerializer(drivers, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return paginator.get_paginated_response(serializer.data, status=status.HTTP_200_OK)
     
+class NearbyDrivers(APIView):
+    """View to list the nearest available drivers to a point"""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Retrieve the k nearest available drivers, optionally within radius_km"""
+
+        query = NearbyDriversQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        latitude = query.validated_data['lat']
+        longitude = query.validated_data['lon']
+
+        drivers = nearest_drivers(
+            latitude, longitude,
+            k=query.validated_data['k'],
+            radius_km=query.validated_data.get('radius_km')
+        )
+        plates = dict(
+            User.objects
+            .filter(id__in=[driver['user_id'] for driver in drivers])
+            .values_list('id', 'plate')
+        )
+
+        return Response([
+            {
+                'id': driver['user_id'],
+                'plate': plates.get(driver['user_id']),
+                'distance': round(driver['distance'], 2),
+                'eta': estimated_time(
+                    driver['distance'],
+                    origin=(driver['latitude'], driver['longitude']),
+                    destination=(latitude, longitude)
+                )
+            }
+            for driver in drivers
+        ], status=status.HTTP_200_OK)
+
 class UserDetail(APIView):
     """Retrieve, update, or delete a user"""
 
@@ -100,7 +149,7 @@ class Login(APIView):
 
     permission_classes = [permissions.AllowAny]
 
-    def post(self, request):
+    async def post(self, request):
         # Obtaining username and password from the request data
         username = request.data.get('username')
         password = request.data.get('password')
@@ -109,8 +158,8 @@ class Login(APIView):
         if not username or not password:
             return Response({"detail": "Username and password are mandatory."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Authenticate the user with the provided credentials
-        user = authenticate(request, username=username, password=password)
+        # Authenticate the user with the provided credentials, hashing the password out of the event loop
+        user = await aauthenticate_user(username, password)
 
         if user is not None:
             # JWT token generation if the authentication is successful
@@ -122,39 +171,50 @@ class Login(APIView):
 
         return Response({"detail": "Invalid credentials."}, status=status.HTTP_401_UNAUTHORIZED)
 
+def save_if_valid(serializer):
+    """Validate and save a serializer in one transaction with the driver state changes, returning whether it was valid."""
+
+    if not serializer.is_valid():
+        return False
+
+    with transaction.atomic():
+        serializer.save()
+    return True
+
 class LocationAssign(APIView):
     """Assigns, retrieves, updates, or deletes a location for the authenticated user."""
 
     permission_classes = [IsAuthenticated]
 
-    def get(self, request):
-        """Get all locations for the authenticated user."""
-        locations = Location.objects.filter(user=request.user)
+    async def get(self, request):
+        """Get the locations of the authenticated user, one page at a time."""
+        paginator = KeysetPagination()
+        locations = await paginator.apaginate_queryset(Location.objects.filter(user=request.user), request)
 
-        if locations.exists():
+        if locations or not paginator.is_first_page:
             serializer = LocationSerializer(locations, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            return paginator.get_paginated_response(serializer.data, status=status.HTTP_200_OK)
         else:
             return Response({"detail": "No locations found."}, status=status.HTTP_404_NOT_FOUND)
 
-    def post(self, request):
+    async def post(self, request):
         """Assign a new location to the authenticated user."""
         data = request.data
         data['user'] = request.user.id  # Ensure the location is linked to the authenticated user
 
         serializer = LocationSerializer(data=data)
 
-        if serializer.is_valid():
-            location = serializer.save()
+        # The driver state is updated in the same transaction as the location.
+        if await sync_to_async(save_if_valid)(serializer):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def put(self, request, pk=None):
+    async def put(self, request, pk=None):
         """Update a specific location of the authenticated user."""
-        try:
-            location = Location.objects.get(id=pk, user=request.user)
-        except Location.DoesNotExist:
+        location = await Location.objects.filter(id=pk, user=request.user).afirst()
+
+        if location is None:
             return Response({"detail": "Location not found or not owned by you."}, status=status.HTTP_404_NOT_FOUND)
 
         data = request.data.copy()
@@ -162,43 +222,108 @@ class LocationAssign(APIView):
 
         serializer = LocationSerializer(location, data=data, partial=False)  # Full update
 
-        if serializer.is_valid():
-            serializer.save()
+        if await sync_to_async(save_if_valid)(serializer):
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def patch(self, request, pk=None):
+    async def patch(self, request, pk=None):
         """Update part of a specific location of the authenticated user."""
-        try:
-            location = Location.objects.get(id=pk, user=request.user)
-        except Location.DoesNotExist:
+        location = await Location.objects.filter(id=pk, user=request.user).afirst()
+
+        if location is None:
             return Response({"detail": "Location not found or not owned by you."}, status=status.HTTP_404_NOT_FOUND)
 
         serializer = LocationSerializer(location, data=request.data, partial=True)  # Partial update
 
-        if serializer.is_valid():
-            serializer.save()
+        if await sync_to_async(save_if_valid)(serializer):
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def delete(self, request, pk=None):
+    async def delete(self, request, pk=None):
         """Delete a specific location of the authenticated user."""
-        try:
-            location = Location.objects.get(id=pk, user=request.user)
-        except Location.DoesNotExist:
+        location = await Location.objects.filter(id=pk, user=request.user).afirst()
+
+        if location is None:
             return Response({"detail": "Location not found or not owned by you."}, status=status.HTTP_404_NOT_FOUND)
 
-        location.delete()
+        # Deleting runs in a transaction with the driver state changes.
+        await sync_to_async(delete_location)(location)
         return Response({"detail": "Location deleted successfully."}, status=status.HTTP_204_NO_CONTENT)
 
+class LocationBatchAssign(APIView):
+    """Assigns many locations buffered by the client to the authenticated user in one request."""
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        """Validate and save a batch of locations, reporting the errors of each invalid one."""
+
+        items = request.data.get('locations') if isinstance(request.data, dict) else None
+        max_size = settings.LOCATION_BATCH_MAX_SIZE
+
+        if not isinstance(items, list) or not items:
+            return Response({"detail": "A non empty list of locations is mandatory."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if len(items) > max_size:
+            return Response({"detail": f"A batch can have at most {max_size} locations."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        locations = []
+        errors = []
+        timestamped = False
+        item_serializer = LocationBatchItemSerializer()
+
+        for index, item in enumerate(items):
+            try:
+                data = item_serializer.run_validation(item)
+            except ValidationError as exc:
+                errors.append({'index': index, 'errors': exc.detail})
+                continue
+            timestamped = timestamped or 'created_at' in data
+            locations.append(Location(user=request.user, **data))
+
+        if not locations:
+            return Response({'created': 0, 'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Only the newest location moves the driver, unless it is older than its current position.
+        newest = max(locations, key=lambda location: location.created_at)
+        moves_driver = request.user.is_driver and not (
+            timestamped and
+            DriverState.objects.filter(driver=request.user, last_seen__gt=newest.created_at).exists()
+        )
+
+        with transaction.atomic():
+            Location.objects.bulk_create(locations, batch_size=1000)
+
+            if moves_driver:
+                record_driver_positions([newest])
+
+        return Response({'created': len(locations), 'errors': errors}, status=status.HTTP_201_CREATED)
+
+def pickup_fields(location):
+    """Pickup location of a service request, with its point copied in the service."""
+
+    return {
+        'pickup_location': location,
+        'pickup_latitude': location.latitude,
+        'pickup_longitude': location.longitude,
+        'pickup_address': location.address,
+    }
+
+def pending_response(service_id):
+    """Answer for a service request waiting for a driver."""
+
+    return Response({'id': service_id, 'status': 'pending'}, status=status.HTTP_202_ACCEPTED)
+
 class ServiceRequestCreate(APIView):
     """Allows only non-driver users to create a service request, assigning the nearest driver."""
 
     permission_classes = [IsAuthenticated]
 
-    def post(self, request):
+    async def post(self, request):
         """Create a new service request if user is not a driver."""
 
         user = request.user
@@ -208,99 +333,277 @@ class ServiceRequestCreate(APIView):
                             status=status.HTTP_403_FORBIDDEN)
 
          # Get latest user location
-        latest_location = get_latest_user_location(user)
+        latest_location = await aget_latest_user_location(user)
 
         if not latest_location:
             return Response({"detail": "You must have at least one location registered."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        pickup_latitude = latest_location.latitude
-        pickup_longitude = latest_location.longitude
+        # Check if there's already an uncompleted service request of this customer
+        existing_request = await ServiceRequest.objects.filter(
+            customer=user, is_completed=False
+        ).values('id', 'driver_id').afirst()
 
-        # Check if there's already an uncompleted service request with this customer and driver
-        existing_request = ServiceRequest.objects.filter(
-            customer=user, driver__isnull=False, is_completed=False
-        ).first()
+        # Retries of a queued request get the same answer without writing again.
+        if existing_request and existing_request['driver_id'] is None:
+            return pending_response(existing_request['id'])
 
         if existing_request:
             return Response({
                 "detail": "You already have an uncompleted service request with a driver."
             }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Find nearest driver
-        driver = nearest_driver(pickup_latitude, pickup_longitude)
 
-        if driver is None:
-            return Response({"detail": "No available drivers found."},
-                            status=status.HTTP_404_NOT_FOUND)
+        if settings.DISPATCH_MODE == 'batch':
+            started = time.perf_counter()
+            response = await sync_to_async(self.queue_request)(request, latest_location)
+            if response.status_code == status.HTTP_202_ACCEPTED:
+                record_dispatch('batched', started)
+            return response
 
-        driver_user = driver['user']
-        distance_to_driver = driver['distance']
+        # Locking rows needs a transaction, which the async ORM does not support.
+        return await sync_to_async(self.assign_driver)(request, latest_location)
 
-        # Calculate estimated time
-        time_to_location = estimated_time(distance_to_driver)
+    def queue_request(self, request, latest_location):
+        """Save the service request without driver, to be assigned by the dispatch of pending requests."""
 
-        # Prepare data
-        data = request.data.copy()
-        data['customer'] = user.id
-        data['pickup_location'] = json.dumps({
-            "id": str(latest_location.id),
-            "address":latest_location.address,
-            "latitude":latest_location.latitude,
-            "longitude":latest_location.longitude
-        })
-        data['driver'] = driver['user'].id
-        data['time_minutes'] = time_to_location
-        data['distance_km'] = round(distance_to_driver,2)
-
-        serializer = ServiceRequestSerializer(data=data)
+        try:
+            with transaction.atomic():
+                service = ServiceRequest.objects.create(
+                    customer=request.user,
+                    **pickup_fields(latest_location)
+                )
+                record_service_created(service)
+        except IntegrityError:
+            return Response({
+                "detail": "You already have an uncompleted service request."
+            }, status=status.HTTP_400_BAD_REQUEST)
 
-        if serializer.is_valid():
-            serializer.save()
+        return pending_response(service.id)
 
-            response_data = {
-                'driver': {
-                    'id': driver_user.id,
-                    'username': driver_user.username,
-                    'plate': driver_user.plate,
-                },
-                'estimated_time_minutes': time_to_location
-            }
-            
-            return Response(response_data, status=status.HTTP_201_CREATED)
+    def assign_driver(self, request, latest_location):
+        """Reserve the nearest driver and save the service request in one transaction."""
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        user = request.user
+        pickup_latitude = latest_location.latitude
+        pickup_longitude = latest_location.longitude
+        started = time.perf_counter()
+
+        try:
+            # The driver row stays locked until the service is saved, so concurrent
+            # requests skip it instead of being assigned the same driver.
+            with transaction.atomic():
+                driver = reserve_nearest_driver(pickup_latitude, pickup_longitude)
+
+                # The request waits until a driver is freed or reports its location.
+                if driver is None:
+                    response = self.queue_request(request, latest_location)
+                    if response.status_code == status.HTTP_202_ACCEPTED:
+                        record_dispatch('queued', started)
+                    return response
+
+                driver_user = driver['user']
+                distance_to_driver = driver['distance']
+
+                # Calculate estimated time
+                time_to_location = estimated_time(
+                    distance_to_driver,
+                    origin=(driver['latitude'], driver['longitude']),
+                    destination=(pickup_latitude, pickup_longitude)
+                )
+
+                # Prepare data
+                data = request.data.copy()
+                data['customer'] = user.id
+                data['driver'] = driver['user'].id
+                data['time_minutes'] = time_to_location
+                data['distance_km'] = round(distance_to_driver,2)
+
+                serializer = ServiceRequestSerializer(data=data)
+
+                if not serializer.is_valid():
+                    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+                service = serializer.save(**pickup_fields(latest_location))
+                record_service_created(service)
+        except IntegrityError:
+            # A concurrent request of the same customer was saved first.
+            return Response({
+                "detail": "You already have an uncompleted service request with a driver."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        record_dispatch('assigned', started, distance_km=distance_to_driver)
+
+        response_data = {
+            'driver': {
+                'id': driver_user.id,
+                'username': driver_user.username,
+                'plate': driver_user.plate,
+            },
+            'estimated_time_minutes': time_to_location
+        }
+
+        return Response(response_data, status=status.HTTP_201_CREATED)
     
+class ServiceRequestStatus(APIView):
+    """Status of the active service request of the authenticated customer."""
+
+    permission_classes = [IsAuthenticated]
+
+    async def get(self, request):
+        """Return whether the active service request is pending or its assigned driver."""
+
+        service = await (
+            ServiceRequest.objects
+            .filter(customer=request.user, is_completed=False)
+            .select_related('driver')
+            .afirst()
+        )
+
+        if service is None:
+            return Response({"detail": "No active service request found."},
+                            status=status.HTTP_404_NOT_FOUND)
+
+        if service.driver is None:
+            return Response({'id': service.id, 'status': 'pending'}, status=status.HTTP_200_OK)
+
+        return Response({
+            'id': service.id,
+            'status': 'assigned',
+            'driver': {
+                'id': service.driver.id,
+                'username': service.driver.username,
+                'plate': service.driver.plate,
+            },
+            'estimated_time_minutes': service.time_minutes
+        }, status=status.HTTP_200_OK)
+
 class CloseServiceRequest(APIView):
     """Close service request."""
 
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        """Close the service request for the authenticated user."""
+        """Close the service request for the authenticated user, optionally the one with the given id."""
 
         user = request.user
 
-        # Fetch the active service request for the user
-        active_service_request = ServiceRequest.objects.filter(customer=user, is_completed=False).first()
-
-        if not active_service_request:
-            active_service_request = ServiceRequest.objects.filter(driver=user, is_completed=False).first()
+        serializer = CloseServiceRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        service_id = serializer.validated_data.get('id')
+
+        # Complete the active service and release its driver in one statement
+        closed = close_service_request(user.id, service_id)
+
+        if closed is None and service_id:
+            # Retries of a close of this service get the same answer.
+            closed = (
+                ServiceRequest.objects
+                .filter(Q(customer=user) | Q(driver=user), id=service_id, is_completed=True)
+                .values_list('id', 'close_service_at')
+                .first()
+            )
+        elif closed is not None:
+            SERVICES_CLOSED.inc()
 
         # Check if there is an active service request
-        if not active_service_request:
+        if closed is None:
             return Response({"detail": "No active service request found."},
                             status=status.HTTP_404_NOT_FOUND)
 
-        # Mark the service request as completed and set the close_at date
-        active_service_request.is_completed = True
-        active_service_request.close_service_at = timezone.now()  # Set current date and time for close_at
-        active_service_request.save()
+        service_id, close_service_at = closed
 
         # Return the response indicating that the request was closed
         response_data = {
-            "id": active_service_request.id,
-            "close_service_at": active_service_request.close_service_at.isoformat()  # Return the close_service_at date in ISO format
+            "id": service_id,
+            "close_service_at": close_service_at.isoformat()  # Return the close_service_at date in ISO format
         }
 
-        return Response(response_data, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response(response_data, status=status.HTTP_200_OK)
+
+class ServiceHistory(APIView):
+    """View to list the services of the authenticated customer or driver"""
+
+    permission_classes = [IsAuthenticated]
+
+    # Filters of each status, the completed services are most of the history.
+    status_filters = {
+        'pending': {'driver__isnull': True, 'is_completed': False},
+        'assigned': {'driver__isnull': False, 'is_completed': False},
+        'completed': {'is_completed': True},
+    }
+
+    async def get(self, request):
+        """Retrieve the services as customer or driver, newest first, one page at a time"""
+
+        query = ServiceHistoryQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        role = query.validated_data.get('role') or ('driver' if request.user.is_driver else 'customer')
+        services = (
+            ServiceRequest.objects
+            .filter(**{role: request.user}, **self.status_filters.get(query.validated_data.get('status'), {}))
+            .select_related('customer', 'driver')
+            # Only the columns in the index of the role, so the services are read with an index only scan.
+            .only(
+                'id', 'created_at', *HISTORY_COLUMNS,
+                'customer__username', 'customer__plate', 'driver__username', 'driver__plate'
+            )
+        )
+
+        paginator = KeysetPagination(newest_first=True)
+        services = await paginator.apaginate_queryset(services, request)
+        serializer = ServiceHistorySerializer(services, many=True)
+        return paginator.get_paginated_response(serializer.data, status=status.HTTP_200_OK)
+
+class UserServiceStats(APIView):
+    """Daily service stats of a driver or customer, read from the rollups"""
+
+    permission_classes = [IsAuthenticated]
+    is_driver = True
+
+    def get(self, request, pk):
+        """Retrieve the services, completed services, pickup km and average ETA of each day of the period"""
+
+        if request.user.id != pk and not request.user.is_staff:
+            raise PermissionDenied("You can only view your own stats.")
+
+        query = ServiceStatsQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        user = User.objects.filter(id=pk, is_driver=self.is_driver).first()
+        if user is None:
+            return Response({"detail": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        start = query.validated_data['from']
+        end = query.validated_data['to']
+
+        return Response({
+            'id': user.id,
+            'from': start,
+            'to': end,
+            **daily_stats(user, start, end)
+        }, status=status.HTTP_200_OK)
+
+class IsMetricsScraper(permissions.BasePermission):
+    """Allows the addresses of METRICS_ALLOWED_IPS and the requests with the METRICS_TOKEN bearer token."""
+
+    def has_permission(self, request, view):
+        if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', []):
+            return True
+
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+
+class Metrics(APIView):
+    """Metrics of the dispatch in the Prometheus text format."""
+
+    # The scraper is not a user, its token is checked by the permission.
+    authentication_classes = []
+    permission_classes = [IsMetricsScraper]
+
+    def get(self, request):
+        return HttpResponse(latest_metrics(), content_type=CONTENT_TYPE_LATEST)
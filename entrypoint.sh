@@ -8,8 +8,13 @@ export PYTHONPATH=/app/delivery
 # Performs the respective migrations of the application.
 python delivery/manage.py makemigrations
 python delivery/manage.py migrate
+python delivery/manage.py manage_location_partitions
 python delivery/manage.py generate_fake_data
 
+# Metrics of every worker are written here and added up by /metrics.
+export PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 # Run the service.
 exec gunicorn delivery.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
 